@@ -0,0 +1,70 @@
+"""
+Time a toPandas-heavy workload with the previous and the generated settings.
+
+Run in a container of the Spark stack, e.g. with a limit of 4 CPUs and 8 GB:
+
+    docker run --cpus 4 --memory 8g <image> python topandas_benchmark.py
+
+The previous settings are Spark's own defaults, which the stack used to run
+with: 200 shuffle partitions and no Arrow. The generated ones are read from
+spark-defaults.conf, as written by wt-spark-defaults at login. The master and
+the driver memory are fixed once the session runs, so both runs share them.
+"""
+import sys
+import time
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+REPEAT = 3
+
+PREVIOUS = {
+    "spark.sql.shuffle.partitions": "200",
+    "spark.sql.execution.arrow.enabled": "false",
+}
+
+
+def workload(spark):
+    df = spark.range(ROWS).select(
+        (F.col("id") % 1000).alias("station"),
+        (F.col("id") * 0.5).alias("value"),
+        F.rand(seed=42).alias("noise"),
+    )
+    # A shuffle, then the collection to pandas of both the result and the rows
+    df.groupBy("station").agg(F.avg("value"), F.max("noise")).toPandas()
+    df.toPandas()
+
+
+def best_time(spark):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        workload(spark)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    spark = SparkSession.builder.appName("topandas-benchmark").getOrCreate()
+    conf = spark.sparkContext.getConf()
+    generated = {key: spark.conf.get(key) for key in PREVIOUS}
+    print(
+        "master {}, driver memory {}".format(
+            conf.get("spark.master"), conf.get("spark.driver.memory", "1g")
+        )
+    )
+
+    results = {}
+    for name, settings in (("previous", PREVIOUS), ("generated", generated)):
+        for key, value in settings.items():
+            spark.conf.set(key, value)
+        results[name] = best_time(spark)
+        print("{:>9}: {:.2f}s {}".format(name, results[name], settings))
+    print("speedup: {:.1f}x".format(results["previous"] / results["generated"]))
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,4 @@
-from repo2docker_wholetale import (
-    RockerWTStackBuildPack,
-    JupyterWTStackBuildPack,
-    RJupyterWTStackBuildPack,
-    JupyterSparkWTStackBuildPack,
-    OpenRefineWTStackBuildPack,
-    MatlabWTStackBuildPack,
-    StataWTStackBuildPack,
-)
+from repo2docker_wholetale import WholeTaleBuildPackSelector
 
-c.Repo2Docker.buildpacks.insert(2, RockerWTStackBuildPack)
-c.Repo2Docker.buildpacks.insert(2, JupyterWTStackBuildPack)
-c.Repo2Docker.buildpacks.insert(2, JupyterSparkWTStackBuildPack)
-c.Repo2Docker.buildpacks.insert(2, RJupyterWTStackBuildPack)
-c.Repo2Docker.buildpacks.insert(2, OpenRefineWTStackBuildPack)
-c.Repo2Docker.buildpacks.insert(2, MatlabWTStackBuildPack)
-c.Repo2Docker.buildpacks.insert(2, StataWTStackBuildPack)
+# Picks the Whole Tale buildpack configured in environment.json, if any
+c.Repo2Docker.buildpacks.insert(2, WholeTaleBuildPackSelector)
@@ -2,16 +2,35 @@
 
 """Top-level package for repo2docker-wholetale."""
 
-from .rocker import RockerWTStackBuildPack
-from .jupyter import JupyterWTStackBuildPack
-from .spark import JupyterSparkWTStackBuildPack
-from .openrefine import OpenRefineWTStackBuildPack
-from .rkernel import RJupyterWTStackBuildPack
-from .matlab import MatlabWTStackBuildPack
-from .stata import StataWTStackBuildPack
-from .julia import JuliaProjectWTBuildPack
+import importlib
 
+from .registry import WholeTaleBuildPackSelector
+
+# Buildpacks are imported on first use, as they pull in repo2docker and jinja2
+_LAZY = {
+    "RockerWTStackBuildPack": "rocker",
+    "JupyterWTStackBuildPack": "jupyter",
+    "JupyterSparkWTStackBuildPack": "spark",
+    "OpenRefineWTStackBuildPack": "openrefine",
+    "RJupyterWTStackBuildPack": "rkernel",
+    "MatlabWTStackBuildPack": "matlab",
+    "StataWTStackBuildPack": "stata",
+    "JuliaProjectWTBuildPack": "julia",
+}
+
+__all__ = ["WholeTaleBuildPackSelector"] + list(_LAZY)
 
 __author__ = """Kacper Kowalik"""
 __email__ = 'xarthisius.kk@gmail.com'
 __version__ = '0.0.1'
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        module = importlib.import_module("." + _LAZY[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
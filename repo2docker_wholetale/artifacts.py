@@ -0,0 +1,55 @@
+"""Files downloaded by the build scripts, cached by their checksum."""
+import os
+import re
+import shlex
+
+FETCH_SCRIPT = os.path.join(os.path.dirname(__file__), "base/fetch.sh")
+# Algorithm -> length of its hex digest
+ALGORITHMS = {"md5": 32, "sha1": 40, "sha256": 64, "sha512": 128}
+# Anything that would end the quoted URL in the shell, or run a command
+UNSAFE_URL = re.compile(r'["`\\\s]|\$\(')
+# Fetch stages only need curl, and the image is small to pull
+FETCH_IMAGE = "buildpack-deps:bionic-curl"
+# Where fetch stages leave their artifacts
+ARTIFACTS_DIR = "/artifacts"
+
+
+class Artifact:
+    """
+    A fixed file downloaded during the build, e.g. a .deb or a tarball.
+
+    ``checksum`` is "<algorithm>:<hex digest>". Artifacts are fetched by
+    wt-fetch, which serves them from the node's cache or mirror when it can.
+    """
+
+    def __init__(self, url, checksum):
+        # Both end up in the shell of the build steps
+        if UNSAFE_URL.search(url):
+            raise ValueError("Invalid artifact URL {!r}".format(url))
+        self.url = url
+        algorithm, _, digest = (checksum or "").partition(":")
+        digest = digest.lower()
+        length = ALGORITHMS.get(algorithm)
+        if len(digest) != length or not re.match(r"^[0-9a-f]+\Z", digest):
+            raise ValueError(
+                "Invalid checksum {!r} of {}, expected <algorithm>:<hex digest> "
+                "with one of: {}".format(checksum, url, ", ".join(ALGORITHMS))
+            )
+        self.checksum = "{}:{}".format(algorithm, digest)
+
+    def fetch(self, dest, mirror=None):
+        """Shell command downloading the artifact to ``dest``."""
+        # The URL may refer to variables of the build (e.g. versions)
+        command = 'wt-fetch "{}" {} {}'.format(
+            self.url, self.checksum, shlex.quote(dest)
+        )
+        if mirror:
+            command = "WT_ARTIFACT_MIRROR={} {}".format(shlex.quote(mirror), command)
+        return command
+
+
+def artifacts_mount(stage):
+    """RUN option mounting the artifacts of a fetch stage, read only."""
+    return "--mount=type=bind,from={0},source={1},target={1}".format(
+        stage, ARTIFACTS_DIR
+    )
@@ -0,0 +1,57 @@
+#!/bin/sh
+# Download a file used by the build, identified by its checksum:
+#
+#   wt-fetch URL ALGORITHM:DIGEST DEST
+#
+# The file is served from the cache (WT_ARTIFACT_CACHE, a BuildKit cache
+# mount) if it's there, then from the mirror (WT_ARTIFACT_MIRROR, any URL
+# curl understands, file:// included, laid out as <algorithm>/<digest>) and
+# only then downloaded from URL. Whatever its source, the checksum is
+# verified before use.
+set -e
+
+url=$1
+algorithm=${2%%:*}
+digest=${2#*:}
+dest=$3
+cache=${WT_ARTIFACT_CACHE:-}
+mirror=${WT_ARTIFACT_MIRROR:-}
+
+verify() {
+    echo "$digest  $1" | "${algorithm}sum" --check --status -
+}
+
+download() {
+    if command -v curl > /dev/null; then
+        curl --silent --show-error --location --fail --retry 3 --output "$2" "$1"
+    else
+        wget --quiet --output-document "$2" "$1"
+    fi
+}
+
+tmp=$(mktemp "$dest.XXXXXX")
+trap 'rm -f "$tmp"' EXIT
+
+cached=
+if [ -n "$cache" ] && [ -f "$cache/$algorithm/$digest" ] \
+        && cp "$cache/$algorithm/$digest" "$tmp" && verify "$tmp"; then
+    cached=1
+elif [ -n "$mirror" ] && download "$mirror/$algorithm/$digest" "$tmp" 2> /dev/null \
+        && verify "$tmp"; then
+    echo "wt-fetch: $url from $mirror" >&2
+else
+    download "$url" "$tmp"
+    if ! verify "$tmp"; then
+        echo "wt-fetch: $algorithm checksum of $url doesn't match $digest" >&2
+        exit 1
+    fi
+fi
+
+if [ -n "$cache" ] && [ -z "$cached" ]; then
+    # Concurrent builds may share the cache, only ever move complete files in
+    mkdir -p "$cache/$algorithm"
+    cp "$tmp" "$cache/$algorithm/$digest.$$"
+    mv "$cache/$algorithm/$digest.$$" "$cache/$algorithm/$digest"
+fi
+mv "$tmp" "$dest"
+trap - EXIT
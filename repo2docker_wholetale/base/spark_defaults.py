@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Write spark-defaults.conf for the CPUs and memory of the container.
+
+Run at login (see /etc/profile.d/wt-spark-defaults.sh), so that the settings
+follow the limits the container was started with rather than the machine it
+was built on:
+
+* spark.master: local[N], N being the CPUs of the cgroup quota
+* spark.driver.memory: WT_SPARK_MEMORY_FRACTION (default 0.5) of the memory
+  limit, the rest being left to Python and pandas
+* spark.driver.maxResultSize: half of the driver memory, for toPandas()
+* spark.sql.shuffle.partitions and spark.default.parallelism: 2 * N, rather
+  than 200 partitions mostly left empty in local mode
+* Arrow-based conversion from and to pandas, falling back to the row based
+  one for unsupported types
+
+WT_SPARK_MASTER, WT_SPARK_DRIVER_MEMORY, WT_SPARK_SHUFFLE_PARTITIONS and
+WT_SPARK_ARROW (true or false) override the computed values. The file is
+written to $SPARK_CONF_DIR (default $SPARK_HOME/conf) unless a path is given.
+"""
+import os
+import sys
+
+# Anything above this is the kernel's way of saying "no limit"
+UNLIMITED = 1 << 60
+MIN_DRIVER_MEMORY = 512
+
+
+def cgroup_cpus(root):
+    """CPUs of the cgroup quota, None without one."""
+    try:
+        with open(os.path.join(root, "cpu.max")) as fp:
+            quota, period = fp.read().split()
+    except (OSError, ValueError):
+        try:
+            with open(os.path.join(root, "cpu/cpu.cfs_quota_us")) as fp:
+                quota = fp.read().strip()
+            with open(os.path.join(root, "cpu/cpu.cfs_period_us")) as fp:
+                period = fp.read().strip()
+        except OSError:
+            return None
+    if quota == "max" or int(quota) <= 0:
+        return None
+    return max(1, -(-int(quota) // int(period)))
+
+
+def cgroup_memory(root):
+    """Memory limit of the cgroup in bytes, None without one."""
+    for name in ("memory.max", "memory/memory.limit_in_bytes"):
+        try:
+            with open(os.path.join(root, name)) as fp:
+                limit = fp.read().strip()
+        except OSError:
+            continue
+        if limit == "max" or int(limit) >= UNLIMITED:
+            return None
+        return int(limit)
+    return None
+
+
+def total_memory():
+    """Memory of the machine in bytes."""
+    with open("/proc/meminfo") as fp:
+        for line in fp:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("No MemTotal in /proc/meminfo")
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def spark_defaults(environ=os.environ):
+    """Settings of spark-defaults.conf, as a list of (key, value)."""
+    root = environ.get("WT_CGROUP_ROOT", "/sys/fs/cgroup")
+    cpus = available_cpus()
+    quota = cgroup_cpus(root)
+    if quota is not None:
+        cpus = min(cpus, quota)
+    memory = cgroup_memory(root) or total_memory()
+
+    fraction = float(environ.get("WT_SPARK_MEMORY_FRACTION", "0.5"))
+    driver_memory = max(MIN_DRIVER_MEMORY, int(memory * fraction) >> 20)
+    driver_memory = environ.get(
+        "WT_SPARK_DRIVER_MEMORY", "{}m".format(driver_memory)
+    )
+    partitions = environ.get("WT_SPARK_SHUFFLE_PARTITIONS", str(2 * cpus))
+    arrow = environ.get("WT_SPARK_ARROW", "true").lower()
+
+    # Arrow settings were renamed in Spark 3
+    if int(environ.get("APACHE_SPARK_VERSION", "2").split(".")[0]) < 3:
+        arrow_prefix = "spark.sql.execution.arrow"
+    else:
+        arrow_prefix = "spark.sql.execution.arrow.pyspark"
+    return [
+        ("spark.master", environ.get("WT_SPARK_MASTER", "local[{}]".format(cpus))),
+        ("spark.driver.memory", driver_memory),
+        ("spark.driver.maxResultSize", max_result_size(driver_memory)),
+        ("spark.sql.shuffle.partitions", partitions),
+        ("spark.default.parallelism", partitions),
+        (arrow_prefix + ".enabled", arrow),
+        (arrow_prefix + ".fallback.enabled", "true"),
+    ]
+
+
+def max_result_size(driver_memory):
+    """Half of the driver memory, given with a unit (k, m, g or t)."""
+    units = "kmgt"
+    value = driver_memory.strip().lower().rstrip("b")
+    if value and value[-1] in units:
+        scale = 1024 ** (units.index(value[-1]) + 1)
+        value = value[:-1]
+    else:
+        scale = 1
+    return "{}m".format(max(1, int(float(value) * scale) >> 21))
+
+
+def main(argv):
+    if len(argv) > 1:
+        path = argv[1]
+    else:
+        conf_dir = os.environ.get("SPARK_CONF_DIR") or os.path.join(
+            os.environ.get("SPARK_HOME", "/usr/local/spark"), "conf"
+        )
+        path = os.path.join(conf_dir, "spark-defaults.conf")
+    lines = ["# Generated by wt-spark-defaults, changes are overwritten at login"]
+    lines += ["{} {}".format(key, value) for key, value in spark_defaults()]
+    tmp = "{}.{}".format(path, os.getpid())
+    with open(tmp, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+    print("\n".join(lines[1:]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,169 @@
+"""Content-addressed cache of built images."""
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import threading
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return sha256 hexdigest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def workspace_digest(path="."):
+    """
+    Return sha256 hexdigest of a whole workspace, as copied into an image.
+
+    Covers the names, content and executable bit of the files, and the
+    targets of the symlinks.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        # Symlinks to directories are listed, but not walked, as directories
+        links = [name for name in dirs if os.path.islink(os.path.join(root, name))]
+        for name in sorted(names + links):
+            fname = os.path.join(root, name)
+            rel = os.path.relpath(fname, path)
+            if os.path.islink(fname):
+                entry = "link:{}={}".format(rel, os.readlink(fname))
+            else:
+                executable = os.stat(fname).st_mode & 0o111 != 0
+                entry = "file:{}={}:{}".format(rel, file_digest(fname), executable)
+            digest.update("\0{}".format(entry).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_cache_key(dockerfile, build_args, files, secret_args=(), workspace=None):
+    """
+    Compute the cache key of an image.
+
+    The key covers the rendered Dockerfile, the build args (apart from the
+    secret ones, e.g. license keys, which must not leak into image names)
+    and the content of the files copied into the image. ``files`` maps the
+    path the file is copied from (or to) onto the path on the host.
+    ``workspace`` is the workspace_digest() of a workspace copied as a
+    whole, if it is.
+    """
+    digest = hashlib.sha256()
+    digest.update(dockerfile.encode("utf-8"))
+    if workspace is not None:
+        digest.update("\0workspace:{}".format(workspace).encode("utf-8"))
+    for key in sorted(build_args or {}):
+        if key in secret_args:
+            continue
+        digest.update("\0arg:{}={}".format(key, build_args[key]).encode("utf-8"))
+    for name in sorted(files):
+        digest.update(
+            "\0file:{}={}".format(name, file_digest(files[name])).encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Lookup and store built images by their cache key.
+
+    Images are tagged as ``<repository>:<key>`` in the local image store and,
+    if a registry repository is configured, pushed there so that other build
+    nodes can pull them instead of building.
+    """
+
+    _lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    def __init__(self, docker_cli="docker", repository="", registry="", stats_file=""):
+        self.docker_cli = docker_cli
+        self.repository = repository
+        self.registry = registry
+        self.stats_file = stats_file
+
+    def _docker(self, *args):
+        proc = subprocess.run(
+            [self.docker_cli] + list(args),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return proc.returncode == 0
+
+    def refs(self, key):
+        """Local and (optional) registry references of a key."""
+        local = "{}:{}".format(self.repository, key)
+        remote = "{}:{}".format(self.registry, key) if self.registry else None
+        return local, remote
+
+    def lookup(self, key):
+        """Return a reference to an existing image for the key, or None."""
+        local, remote = self.refs(key)
+        if self._docker("image", "inspect", local):
+            ref = local
+        elif remote and self._docker("pull", remote):
+            ref = remote
+        else:
+            ref = None
+        self._record(ref is not None)
+        return ref
+
+    def retag(self, ref, tag):
+        return self._docker("tag", ref, tag)
+
+    def store(self, key, tag):
+        """Make a freshly built image available under the key."""
+        local, remote = self.refs(key)
+        stored = self._docker("tag", tag, local)
+        if stored and remote:
+            stored = self._docker("tag", tag, remote) and self._docker("push", remote)
+        return stored
+
+    def _record(self, hit):
+        with self._lock:
+            if hit:
+                ResultCache.hits += 1
+            else:
+                ResultCache.misses += 1
+        if not self.stats_file:
+            return
+        # Counters shared by all builds using the same stats file
+        with open(self.stats_file, "a+") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                stats = dict(json.loads(fp.read() or "{}"))
+            except (ValueError, TypeError):
+                stats = {}
+            stats["hits"] = stats.get("hits", 0) + int(hit)
+            stats["misses"] = stats.get("misses", 0) + int(not hit)
+            stats["hit_rate"] = stats["hits"] / (stats["hits"] + stats["misses"])
+            fp.seek(0)
+            fp.truncate()
+            json.dump(stats, fp)
+
+    def stats(self):
+        """
+        Hit and miss counts, from the stats file if one is used.
+
+        Falls back to the counts of this process if the file can't be read.
+        """
+        hits, misses = ResultCache.hits, ResultCache.misses
+        if self.stats_file and os.path.exists(self.stats_file):
+            with open(self.stats_file) as fp:
+                # Not while another build rewrites it
+                fcntl.flock(fp, fcntl.LOCK_SH)
+                try:
+                    stats = json.loads(fp.read() or "{}")
+                    hits, misses = int(stats["hits"]), int(stats["misses"])
+                except (ValueError, KeyError, TypeError):
+                    pass
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,216 @@
+"""Shared xpra/xfce desktop of the MATLAB and Stata stacks."""
+
+from .artifacts import ARTIFACTS_DIR, artifacts_mount
+from .jupyter import JupyterWTStackBuildPack
+
+
+# WT_DESKTOP_VERSION -> definition of the desktop stage
+DESKTOP_VERSIONS = {
+    "1": {
+        "base": "buildpack-deps:bionic",
+        "packages": [
+            "apt-transport-https",
+            "dbus-x11",
+            "firefox",
+            "gnupg",
+            "mousepad",
+            "python-websockify",
+            "software-properties-common",
+            "wget",
+            "x11-apps",
+            "x11-utils",
+            "xfce4",
+            "xfce4-goodies",
+            "xfce4-panel",
+            "xfonts-base",
+            "xubuntu-icon-theme",
+            "xvfb",
+        ],
+        "xpra_repo": "deb https://xpra.org/ bionic main",
+        # No checksum is published for it, WT_XPRA_KEY_SHA256 pins it
+        "xpra_key": "https://xpra.org/gpg.asc",
+    },
+}
+DEFAULT_DESKTOP_VERSION = "1"
+
+# Fetch stage of the signing key of the xpra repository
+XPRA_KEY_STAGE = "wt-fetch-xpra-key"
+
+XFCE_PANEL = """\
+<?xml version='1.0' encoding='UTF-8'?>
+<channel name='xfce4-panel' version='1.0'>
+  <property name='configver' type='int' value='2'/>
+  <property name='panels' type='array'>
+    <value type='int' value='1'/>
+    <property name='panel-1' type='empty'>
+      <property name='position' type='string' value='p=8;x=720;y=750'/>
+      <property name='length' type='uint' value='100'/>
+      <property name='position-locked' type='bool' value='false'/>
+      <property name='size' type='uint' value='36'/>
+      <property name='plugin-ids' type='array'>
+        <value type='int' value='1'/>
+        <value type='int' value='3'/>
+        <value type='int' value='15'/>
+        <value type='int' value='6'/>
+      </property>
+      <property name='disable-struts' type='bool' value='false'/>
+      <property name='nrows' type='uint' value='1'/>
+      <property name='length-adjust' type='bool' value='true'/>
+    </property>
+  </property>
+  <property name='plugins' type='empty'>
+    <property name='plugin-1' type='string' value='applicationsmenu'/>
+    <property name='plugin-3' type='string' value='tasklist'/>
+    <property name='plugin-15' type='string' value='separator'>
+      <property name='expand' type='bool' value='true'/>
+      <property name='style' type='uint' value='0'/>
+    </property>
+    <property name='plugin-6' type='string' value='systray'/>
+  </property>
+</channel>
+"""
+
+
+def write_file(path, content):
+    """Shell command writing ``content`` to ``path``, expanding variables in it."""
+    lines = []
+    for line in content.splitlines():
+        for char in '\\"`':
+            line = line.replace(char, "\\" + char)
+        lines.append('"{}"'.format(line))
+    # printf '%s\n' doesn't interpret the lines as formats, e.g. "firefox %u"
+    return "printf '%s\\n' \\\n    {} \\\n    > {}".format(
+        " \\\n    ".join(lines), path
+    )
+
+
+def desktop_entry(name, command, icon, path, terminal=False):
+    """Content of the .desktop file of a launcher."""
+    return "\n".join(
+        [
+            "[Desktop Entry]",
+            "Version=1.0",
+            "Type=Application",
+            "Name={}".format(name),
+            "Comment=",
+            "Exec={}".format(command),
+            "Icon={}".format(icon),
+            "Path={}".format(path),
+            "Terminal={}".format(str(terminal).lower()),
+            "StartupNotify=false",
+        ]
+    )
+
+
+def desktop_launcher(name, command, icon, terminal=False):
+    """Build script adding the launcher of an application to the user's desktop."""
+    entry = desktop_entry(name, command, icon, "${HOME}/work/workspace", terminal)
+    path = "${{HOME}}/Desktop/{}.desktop".format(name)
+    return (
+        "${NB_USER}",
+        "mkdir -p ${{HOME}}/Desktop && \\\n{} && \\\nchmod +x {}".format(
+            write_file(path, entry), path
+        ),
+    )
+
+
+def desktop_stage(version=DEFAULT_DESKTOP_VERSION):
+    """
+    Dockerfile stage with the desktop, named wt-desktop-<version>.
+
+    Its content only depends on the version, so the builder caches it once
+    for all the tales using it. The launchers and the panel layout go into
+    /etc/skel, from where they are copied to the home of the user created
+    by the image. The xpra key comes from the XPRA_KEY_STAGE stage.
+    """
+    try:
+        desktop = DESKTOP_VERSIONS[version]
+    except KeyError:
+        raise ValueError(
+            "Unknown WT_DESKTOP_VERSION {!r}, expected one of: {}".format(
+                version, ", ".join(sorted(DESKTOP_VERSIONS))
+            )
+        )
+    workspace = "/home/${NB_USER}/work/workspace"
+    xfconf = "/etc/skel/.config/xfce4/xfconf/xfce-perchannel-xml"
+    skel = [
+        "mkdir -p /etc/skel/Desktop {}".format(xfconf),
+        write_file(
+            "/etc/skel/Desktop/Terminal.desktop",
+            desktop_entry(
+                "Terminal",
+                "exo-open --launch TerminalEmulator",
+                "utilities-terminal",
+                workspace,
+            ),
+        ),
+        write_file(
+            "/etc/skel/Desktop/Firefox.desktop",
+            desktop_entry("Firefox", "firefox %u", "firefox", ""),
+        ),
+        "chmod +x /etc/skel/Desktop/*.desktop",
+        write_file(xfconf + "/xfce4-panel.xml", XFCE_PANEL),
+    ]
+    return "\n".join(
+        [
+            "FROM {} AS wt-desktop-{}".format(desktop["base"], version),
+            "ARG NB_USER",
+            "ARG NB_UID",
+            "ENV DEBIAN_FRONTEND=noninteractive",
+            "RUN {} \\".format(artifacts_mount(XPRA_KEY_STAGE)),
+            "    apt-get -qq update && \\",
+            "    apt-get -qq install --yes --no-install-recommends \\",
+            "        {} \\".format(" ".join(desktop["packages"])),
+            "        > /dev/null && \\",
+            "    apt-key add {}/xpra.asc && \\".format(ARTIFACTS_DIR),
+            '    add-apt-repository "{}" && \\'.format(desktop["xpra_repo"]),
+            "    apt-get -qq install --yes xpra xpra-html5 > /dev/null && \\",
+            "    apt-get -qq purge && \\",
+            "    apt-get -qq clean && \\",
+            "    rm -rf /var/lib/apt/lists/* && \\",
+            "    mkdir -p /run/xpra && chmod 755 /run/xpra && \\",
+            "    mkdir -p /run/user/${NB_UID} && \\",
+            "    chown ${NB_UID} /run/user/${NB_UID} && \\",
+            "    chmod 700 /run/user/${NB_UID}",
+            "RUN {}".format(" && \\\n".join(skel)),
+            "",
+        ]
+    )
+
+
+class DesktopWTStackBuildPack(JupyterWTStackBuildPack):
+    """
+    Jupyter stack with an xpra/xfce desktop.
+
+    The image starts from the shared desktop stage selected by
+    WT_DESKTOP_VERSION, or from a prebuilt image of it set by
+    WT_DESKTOP_IMAGE.
+    """
+
+    @property
+    def with_desktop(self):
+        """Whether the image has the desktop at all."""
+        return True
+
+    @property
+    def desktop_version(self):
+        return self.wt_env.get("WT_DESKTOP_VERSION", DEFAULT_DESKTOP_VERSION)
+
+    @property
+    def base_stage(self):
+        if not self.with_desktop:
+            return None
+        return self.wt_env.get("WT_DESKTOP_IMAGE") or "wt-desktop-{}".format(
+            self.desktop_version
+        )
+
+    def get_stages(self):
+        if not self.with_desktop or self.wt_env.get("WT_DESKTOP_IMAGE"):
+            return []
+        stage = desktop_stage(self.desktop_version)
+        key = self.pinned_artifact(
+            DESKTOP_VERSIONS[self.desktop_version]["xpra_key"],
+            "sha256",
+            "WT_XPRA_KEY_SHA256",
+        )
+        return [self.fetch_stage(XPRA_KEY_STAGE, key, "xpra.asc"), stage]
@@ -1,16 +1,293 @@
 """Docker container engine for repo2docker using docker-cli."""
+import contextlib
+import hashlib
+import json
 import os
+import re
 import subprocess
-import shutil
 import tarfile
 import tempfile
+import threading
+
+from traitlets import Bool, Dict, Enum, Integer, Unicode
 
 from repo2docker.docker import DockerEngine
 
+from .cache import ResultCache
+from .progress import BuildKitProgress
+from .scheduler import BuildScheduler
+
+# Schedulers are shared by every engine in the process with the same settings
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+class _ContextDigest:
+    """
+    sha256 of a build context, computed as the build reads it.
+
+    Builds coalesced under the same flight key compare the digest of their own
+    context to the one of the running build, see BuildScheduler.run().
+    """
+
+    def __init__(self, fileobj, chunk_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._sha256 = hashlib.sha256()
+        self._digest = None
+        self._done = threading.Event()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self._sha256.update(data)
+        elif size != 0:
+            self._digest = self._sha256.hexdigest()
+            self._done.set()
+        return data
+
+    def drain(self):
+        """Read (and hash) the rest of the context."""
+        while self.read(self.chunk_size):
+            pass
+
+    def close(self):
+        """No more reads, the digest stays unknown if the context wasn't read."""
+        self._done.set()
+
+    def wait(self):
+        """Digest of the whole context once it was read, None if it never was."""
+        self._done.wait()
+        return self._digest
+
+    def compute(self):
+        """Digest of the context, read ahead of the build."""
+        if not self.fileobj.seekable():
+            return None
+        start = self.fileobj.tell()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: self.fileobj.read(self.chunk_size), b""):
+            digest.update(chunk)
+        self.fileobj.seek(start)
+        return digest.hexdigest()
+
 
 class DockerCLIEngine(DockerEngine):
     """Docker container engine using docker-cli, currently only for build()."""
 
+    docker_cli = Unicode(
+        "docker",
+        help="Name of (or path to) the docker-cli executable.",
+        config=True,
+    )
+
+    max_concurrent_builds = Integer(
+        0,
+        help="""
+        Maximum number of `docker build` processes run concurrently by this
+        process. Builds over the limit wait for a free slot. 0 means no limit.
+        """,
+        config=True,
+    )
+
+    coalesce_builds = Bool(
+        True,
+        help="""
+        Run identical builds (same Dockerfile, build args and build context)
+        submitted at the same time only once. The other submitters get the
+        output of the running build and its image is tagged for them as well.
+        """,
+        config=True,
+    )
+
+    progress = Enum(
+        ["plain", "rawjson"],
+        "plain",
+        help="""
+        BuildKit progress output format. With "rawjson" the output is parsed
+        into structured step events that are yielded under the "progress" key
+        next to the human readable "stream" (requires docker-buildx >= 0.12).
+        """,
+        config=True,
+    )
+
+    read_chunk_size = Integer(
+        64 * 1024,
+        help="""
+        Maximum number of bytes read from docker-cli at once. All complete
+        lines in a chunk are reported as a single batch.
+        """,
+        config=True,
+    )
+
+    cache_backend = Enum(
+        ["none", "local", "registry"],
+        "none",
+        help="""
+        Where BuildKit layer cache is exported to and imported from, so that
+        it can be shared between build nodes. "local" uses a directory per
+        cache scope under cache_dir, "registry" uses a tag per cache scope of
+        the cache_registry repository. The cache scope is provided by the
+        Whole Tale buildpacks and identifies the stack and its version.
+        """,
+        config=True,
+    )
+
+    cache_dir = Unicode(
+        "/var/cache/wholetale/buildkit",
+        help="Directory (e.g. a shared mount) holding the local BuildKit cache.",
+        config=True,
+    )
+
+    cache_registry = Unicode(
+        "",
+        help="Repository used for the registry cache, e.g. localhost:5000/wt-cache",
+        config=True,
+    )
+
+    cache_mode = Enum(
+        ["min", "max"],
+        "max",
+        help="Export only the layers of the final stage (min) or all of them (max).",
+        config=True,
+    )
+
+    builder = Unicode(
+        "",
+        help="""
+        Name of the buildx builder to use. Cache export usually needs a
+        builder using the docker-container driver; images built by it are
+        loaded back into the docker image store.
+        """,
+        config=True,
+    )
+
+    result_cache = Bool(
+        False,
+        help="""
+        Reuse an existing image instead of building, if one was already built
+        from the same Dockerfile, build args and dependency files. The key is
+        computed by the Whole Tale buildpacks.
+        """,
+        config=True,
+    )
+
+    result_cache_repository = Unicode(
+        "wholetale/build-cache",
+        help="Local image repository that cached images are tagged into.",
+        config=True,
+    )
+
+    result_cache_registry = Unicode(
+        "",
+        help="""
+        Registry repository (e.g. localhost:5000/wt-build-cache) that cached
+        images are pushed to and pulled from, shared by all build nodes.
+        """,
+        config=True,
+    )
+
+    result_cache_stats_file = Unicode(
+        "",
+        help="JSON file accumulating the hit and miss counts of the result cache.",
+        config=True,
+    )
+
+    stream_context = Bool(
+        True,
+        help="""
+        Pipe the build context tarball to `docker build -` instead of
+        extracting it to a temporary directory first.
+
+        The extraction is still used if the Dockerfile cannot be resolved
+        inside of the tarball (e.g. an absolute path was requested).
+        """,
+        config=True,
+    )
+
+    stream_chunk_size = Integer(
+        1024 * 1024,
+        help="Size (in bytes) of the chunks written to `docker build` stdin.",
+        config=True,
+    )
+
+    copy_workspace = Bool(
+        True,
+        help="""
+        Copy the whole workspace of a tale into the image built by the Whole
+        Tale buildpacks. It's overshadowed by the Whole Tale mount at runtime,
+        so without it only the files read by the build steps are staged, and
+        the steps installing the tale itself as a package are left out.
+        """,
+        config=True,
+    )
+
+    use_cache_mounts = Bool(
+        False,
+        help="""
+        Keep the downloads of apt, pip, conda and the fetched artifacts of the
+        Whole Tale buildpacks on BuildKit cache mounts, so that repeated builds
+        on a node reuse them.
+        """,
+        config=True,
+    )
+
+    coalesce_runs = Bool(
+        False,
+        help="""
+        Merge adjacent RUN steps of the same user in the Dockerfiles of the
+        Whole Tale buildpacks, so that images have fewer layers to snapshot,
+        export and pull. Downloads and installs keep their own steps.
+        """,
+        config=True,
+    )
+
+    artifact_mirror = Unicode(
+        "",
+        help="""
+        URL of a mirror of the files downloaded by the Whole Tale buildpacks
+        (e.g. https://mirror.example.org/wt or file:///mnt/wt), tried before
+        their origin. Files are looked up as <algorithm>/<hex digest>.
+        """,
+        config=True,
+    )
+
+    artifact_checksums = Dict(
+        {},
+        help="""
+        Checksums ("<algorithm>:<hex digest>") of files downloaded by the Whole
+        Tale buildpacks that don't come with one, by URL, e.g. the libpng12
+        package of the Stata stack. Files without a known checksum are not
+        downloaded at all.
+        """,
+        config=True,
+    )
+
+    def _can_stream(self, fileobj, dockerfile):
+        """Check if the context can be sent to docker-cli as is."""
+        if not self.stream_context or fileobj is None:
+            return False
+        # docker-cli resolves -f relative to the root of the tarball, anything
+        # pointing outside of it needs an extracted context.
+        return not (os.path.isabs(dockerfile) or dockerfile.startswith(".."))
+
+    def _feed_context(self, fileobj, stdin):
+        """Copy the context tarball to docker-cli stdin in bounded chunks."""
+        try:
+            while True:
+                chunk = fileobj.read(self.stream_chunk_size)
+                if not chunk:
+                    break
+                stdin.write(chunk)
+        except BrokenPipeError:
+            # docker-cli exited early, the error is reported through stdout
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
     def build(
         self,
         *,
@@ -23,67 +300,261 @@ class DockerCLIEngine(DockerEngine):
         fileobj=None,
         path="",
         labels=None,
+        content_key=None,
         **kwargs,
     ):
         """Build docker container using docker-cli with BUILDKIT."""
-        build_cmd = "docker build --progress plain"
+        cache = None
+        if content_key and self.result_cache:
+            cache = ResultCache(
+                docker_cli=self.docker_cli,
+                repository=self.result_cache_repository,
+                registry=self.result_cache_registry,
+                stats_file=self.result_cache_stats_file,
+            )
+            ref = cache.lookup(content_key)
+            if ref is not None and cache.retag(ref, tag):
+                yield {"stream": "Reusing cached image {} as {}\n".format(ref, tag)}
+                yield {"stream": self._cache_stats(cache)}
+                return
 
-        if tag is not None:
-            build_cmd = build_cmd + " --tag " + tag
+        key = self._flight_key(fileobj, dockerfile, buildargs)
+        digest = None
+        if key is not None:
+            digest = _ContextDigest(fileobj, self.stream_chunk_size)
 
-        if path:
-            os.chdir(path)
+        def build():
+            failed = False
+            for event in self._build(
+                buildargs=buildargs,
+                cache_from=cache_from,
+                container_limits=container_limits,
+                tag=tag,
+                dockerfile=dockerfile,
+                fileobj=fileobj,
+                path=path,
+                digest=digest,
+                **kwargs,
+            ):
+                failed = failed or "error" in event
+                yield event
 
-        if dockerfile:
-            build_cmd = build_cmd + " -f " + dockerfile
+            # Only run by the build that was not coalesced, the others just
+            # get its image tagged
+            if cache is not None and tag and not failed:
+                cache.store(content_key, tag)
+                yield {"stream": self._cache_stats(cache)}
+
+        yield from self.scheduler.run(key, tag, build, digest)
+
+    @staticmethod
+    def _cache_stats(cache):
+        stats = cache.stats()
+        return "Build cache: {} hits, {} misses ({:.0%} hit rate)\n".format(
+            stats["hits"], stats["misses"], stats["hit_rate"]
+        )
+
+    @property
+    def scheduler(self):
+        """The process wide scheduler running builds of this engine."""
+        key = (self.docker_cli, self.max_concurrent_builds)
+        with _schedulers_lock:
+            if key not in _schedulers:
+                _schedulers[key] = BuildScheduler(
+                    max_concurrent=self.max_concurrent_builds, retag=self._tag
+                )
+            return _schedulers[key]
+
+    def build_metrics(self):
+        """Queue depth, wait times and deduplication counters of the scheduler."""
+        return self.scheduler.metrics()
+
+    def _tag(self, image, tag):
+        proc = subprocess.run(
+            [self.docker_cli, "tag", image, tag],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return proc.returncode == 0
 
-        tempdir = tempfile.mkdtemp()
-        if fileobj is not None:
-            tar = tarfile.open(fileobj=fileobj, mode="r")
-            tar.extractall(tempdir)
-            tar.close()
-            path = tempdir
+    def _flight_key(self, fileobj, dockerfile, buildargs):
+        """
+        Identify a build, so that identical concurrent builds are run once.
+
+        The key only covers the size of the context, the contexts themselves
+        are hashed when two builds with the same key actually meet.
+        """
+        if not self.coalesce_builds or fileobj is None or not fileobj.seekable():
+            return None
+        start = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - start
+        fileobj.seek(start)
+        key = json.dumps([size, dockerfile, buildargs or {}], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _build_cmd(
+        self,
+        context,
+        buildargs=None,
+        cache_from=None,
+        container_limits=None,
+        tag="",
+        dockerfile="",
+        cache_scope=None,
+        **kwargs,
+    ):
+        """Assemble the argv for `docker build`."""
+        cmd = [self.docker_cli, "build", "--progress", self.progress]
+
+        if self.builder:
+            cmd += ["--builder", self.builder, "--load"]
+
+        if tag:
+            cmd += ["--tag", tag]
+
+        if dockerfile:
+            cmd += ["--file", dockerfile]
 
         if buildargs is not None:
             for key, value in buildargs.items():
-                build_cmd = build_cmd + " --build-arg " + key + "=" + value
+                cmd += ["--build-arg", "{}={}".format(key, value)]
 
         # TODO: Handle extra_build_kwargs?
 
         if kwargs.get("forcerm"):
-            build_cmd = build_cmd + " --force-rm"
+            cmd.append("--force-rm")
 
         if kwargs.get("rm"):
-            build_cmd = build_cmd + " --rm"
+            cmd.append("--rm")
 
         if container_limits is not None:
             if "memlimit" in container_limits:
-                build_cmd = build_cmd + " --memory " + container_limits["memlimit"]
+                cmd += ["--memory", str(container_limits["memlimit"])]
+
+        for cache in cache_from or []:
+            cmd += ["--cache-from", cache]
+
+        if cache_scope:
+            cmd += self._cache_args(cache_scope)
+
+        cmd.append(context)
+        return cmd
+
+    def _cache_args(self, scope):
+        """Return --cache-from/--cache-to flags for the given cache scope."""
+        scope = re.sub(r"[^A-Za-z0-9_.-]", "-", scope)[:128]
+        if self.cache_backend == "local":
+            location = os.path.join(self.cache_dir, scope)
+            args = []
+            # Importing a cache that hasn't been exported yet is an error
+            if os.path.exists(os.path.join(location, "index.json")):
+                args += ["--cache-from", "type=local,src={}".format(location)]
+            return args + [
+                "--cache-to",
+                "type=local,dest={},mode={}".format(location, self.cache_mode),
+            ]
+        if self.cache_backend == "registry" and self.cache_registry:
+            ref = "{}:{}".format(self.cache_registry, scope)
+            return [
+                "--cache-from",
+                "type=registry,ref={}".format(ref),
+                "--cache-to",
+                "type=registry,ref={},mode={}".format(ref, self.cache_mode),
+            ]
+        return []
 
-        if cache_from:
-            build_cmd = build_cmd + " --cache-from"
-            for cache in cache_from:
-                build_cmd = build_cmd + " " + cache
+    def _build(self, fileobj=None, path="", dockerfile="", digest=None, **kwargs):
+        stream = self._can_stream(fileobj, dockerfile)
+        with contextlib.ExitStack() as stack:
+            if digest is not None:
+                stack.callback(digest.close)
+            if stream:
+                context = "-"
+                if digest is not None:
+                    # Hashed on its way to docker-cli
+                    fileobj = digest
+            elif fileobj is not None:
+                if digest is not None:
+                    start = fileobj.tell()
+                    digest.drain()
+                    fileobj.seek(start)
+                context = stack.enter_context(tempfile.TemporaryDirectory())
+                with tarfile.open(fileobj=fileobj, mode="r") as tar:
+                    tar.extractall(context)
+            else:
+                context = os.path.abspath(path or os.curdir)
 
-        build_cmd = build_cmd + " " + path
+            if dockerfile and not os.path.isabs(dockerfile) and not stream:
+                # Relative Dockerfile paths are resolved against the context,
+                # not the working directory of this process.
+                dockerfile = os.path.join(context, dockerfile)
 
+            cmd = self._build_cmd(context, dockerfile=dockerfile, **kwargs)
+            yield from self._run(cmd, fileobj if stream else None)
+
+    def _run(self, cmd, fileobj=None):
+        """Run docker-cli, yielding its output in the docker-py format."""
         with subprocess.Popen(
-            build_cmd,
-            shell=True,
+            cmd,
+            stdin=subprocess.PIPE if fileobj is not None else subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            env={"DOCKER_BUILDKIT": "1", "PROGRESS_NO_TRUNC": "1"},
+            env=dict(os.environ, DOCKER_BUILDKIT="1", PROGRESS_NO_TRUNC="1"),
         ) as p:
 
-            while True:
-                line = p.stdout.readline()
-                if p.poll() is not None:
-                    break
-                yield {"stream": line}
+            feeder = None
+            if fileobj is not None:
+                feeder = threading.Thread(
+                    target=self._feed_context, args=(fileobj, p.stdin), daemon=True
+                )
+                feeder.start()
+
+            if self.progress == "rawjson":
+                yield from self._rawjson_output(p, feeder)
+            else:
+                yield from self._plain_output(p, feeder)
+
+    def _batches(self, stdout):
+        """Read docker-cli output in chunks, yielding lists of complete lines."""
+        pending = b""
+        while True:
+            chunk = stdout.read1(self.read_chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            if lines:
+                yield [line.decode("utf-8", errors="replace") + "\n" for line in lines]
+        if pending:
+            yield [pending.decode("utf-8", errors="replace")]
+
+    def _wait(self, p, feeder):
+        rc = p.wait()
+        if feeder is not None:
+            feeder.join()
+        return rc
+
+    def _plain_output(self, p, feeder):
+        line = ""
+        for lines in self._batches(p.stdout):
+            line = lines[-1]
+            yield {"stream": "".join(lines)}
+
+        if self._wait(p, feeder) != 0:
+            yield {"error": line}
 
-            rc = p.poll()
-            if rc != 0:
-                yield {"error": line}
+    def _rawjson_output(self, p, feeder):
+        parser = BuildKitProgress()
+        line = ""
+        for lines in self._batches(p.stdout):
+            text, events = [], []
+            for line in lines:
+                log, new_events = parser.feed(line)
+                text.append(log)
+                events += new_events
+            yield {"stream": "".join(text), "progress": events}
 
-        shutil.rmtree(tempdir)
+        if self._wait(p, feeder) != 0:
+            yield {"error": parser.error() or line}
+        else:
+            yield {"stream": "", "timings": parser.timings()}
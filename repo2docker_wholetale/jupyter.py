@@ -2,7 +2,6 @@
 
 """Main module."""
 
-import json
 import os
 
 from .wholetale import WholeTaleRBuildPack
@@ -10,14 +9,6 @@ from .wholetale import WholeTaleRBuildPack
 
 class JupyterWTStackBuildPack(WholeTaleRBuildPack):
 
-    @property
-    def wt_env(self):
-        if self._wt_env is None:
-            with open(self.binder_path("environment.json"), "r") as fp:
-                env = json.load(fp)
-            self._wt_env = dict([_.split("=") for _ in env["config"]["environment"]])
-        return self._wt_env
-
     def detect(self, buildpack="PythonBuildPack"):
         return super().detect(buildpack=buildpack)
 
@@ -1,8 +1,89 @@
-import os
-from .jupyter import JupyterWTStackBuildPack
+import re
 
+from .desktop import DesktopWTStackBuildPack, desktop_launcher
 
-class MatlabWTStackBuildPack(JupyterWTStackBuildPack):
+# Libraries needed by MATLAB (and its installer), based on:
+# https://github.com/mathworks-ref-arch/matlab-dockerfile/
+MATLAB_PACKAGES = {
+    "ca-certificates",
+    "curl",
+    "lsb-release",
+    "libasound2",
+    "libatk1.0-0",
+    "libc6",
+    "libcairo2",
+    "libcap2",
+    "libcomerr2",
+    "libcups2",
+    "libdbus-1-3",
+    "libfontconfig1",
+    "libgconf-2-4",
+    "libgcrypt20",
+    "libgdk-pixbuf2.0-0",
+    "libgssapi-krb5-2",
+    "libgstreamer-plugins-base1.0-0",
+    "libgstreamer1.0-0",
+    "libglib2.0-0",
+    "libgtk2.0-0",
+    "libk5crypto3",
+    "libkrb5-3",
+    "libnspr4",
+    "libnspr4-dbg",
+    "libnss3",
+    "libpam0g",
+    "libpango-1.0-0",
+    "libpangocairo-1.0-0",
+    "libpangoft2-1.0-0",
+    "libselinux1",
+    "libsm6",
+    "libsndfile1",
+    "libudev1",
+    "libx11-6",
+    "libx11-xcb1",
+    "libxcb1",
+    "libxcomposite1",
+    "libxcursor1",
+    "libxdamage1",
+    "libxext6",
+    "libxfixes3",
+    "libxft2",
+    "libxi6",
+    "libxmu6",
+    "libxrandr2",
+    "libxrender1",
+    "libxslt1.1",
+    "libxss1",
+    "libxt6",
+    "libxtst6",
+    "libxxf86vm1",
+    "procps",
+    "python3-pip",
+    "xkb-data",
+    "x11vnc",
+    "sudo",
+    "zlib1g",
+    "locales",
+    "locales-all",
+    "gcc",
+    "g++",
+    "gfortran",
+    "csh",
+}
+# Not needed by the engine and the kernel: VNC, MEX compilers and the rest
+# of the tooling of the desktop
+MATLAB_DESKTOP_PACKAGES = {
+    "csh",
+    "g++",
+    "gcc",
+    "gfortran",
+    "python3-pip",
+    "sudo",
+    "x11vnc",
+}
+MATLAB_PROFILES = ("desktop", "headless")
+
+
+class MatlabWTStackBuildPack(DesktopWTStackBuildPack):
     """
     Setup Matlab for use with a repository.
 
@@ -14,9 +95,16 @@ class MatlabWTStackBuildPack(JupyterWTStackBuildPack):
     * `toolboxes.txt` containing a valid product string for the
        selected version.  See `installer_input.txt` from the Matlab
        install media.
+    * `WT_MATLAB_PROFILE=headless` in the environment of `environment.json`
+       for tales using only the Jupyter kernel or batch mode. The image
+       then has no xfce/xpra desktop, no MATLAB desktop launcher,
+       matlab-support or jupyter-matlab-proxy, and none of
+       MATLAB_DESKTOP_PACKAGES. All of these layers are left out of the
+       image to build and pull, and no Xvfb or desktop session runs at
+       startup. The default profile is `desktop`.
 
     Prerequisites:
-    * Docker with buildkit support
+    * Docker with buildkit support (and COPY --link, i.e. Docker 23+)
     * `repo2docker` with the `repo2docker_wholetale` plugin
     * `matlab-install:<version>` image build using the
       [matlab-install](https://github.com/whole-tale/matlab-install
@@ -27,23 +115,39 @@ class MatlabWTStackBuildPack(JupyterWTStackBuildPack):
             --config ./repo2docker_config.py ./path-to-repo
     """
 
-    _wt_env = None
+    secret_build_args = ("FILE_INSTALLATION_KEY",)
+    default_version = "R2020a"
 
     def detect(self):
         return super().detect(buildpack="MatlabBuildPack")
 
+    @property
+    def matlab_profile(self):
+        profile = self.wt_env.get("WT_MATLAB_PROFILE", "desktop")
+        if profile not in MATLAB_PROFILES:
+            raise ValueError(
+                "Unknown WT_MATLAB_PROFILE {!r}, expected one of: {}".format(
+                    profile, ", ".join(MATLAB_PROFILES)
+                )
+            )
+        return profile
+
+    @property
+    def with_desktop(self):
+        return self.matlab_profile == "desktop"
+
     def get_build_env(self):
         # MLM_LICENSE_FILE specifies the path to the license at runtime
-        return super().get_build_env() + [
-            ("MLM_LICENSE_FILE", "/licenses/matlab/network.lic"),
-            ("BASE_URL", "/matlab"),
-            ("APP_PORT", "8888")
-        ]
+        env = [("MLM_LICENSE_FILE", "/licenses/matlab/network.lic")]
+        if self.with_desktop:
+            # Settings of jupyter-matlab-proxy
+            env += [("BASE_URL", "/matlab"), ("APP_PORT", "8888")]
+        return super().get_build_env() + env
 
     def get_path(self):
         """Adds path to Matlab binaries to user's PATH."""
         return super().get_path() + [
-            "/usr/local/MATLAB/{}/bin".format(self.wt_env.get("VERSION", "R2020a"))
+            "/usr/local/MATLAB/{}/bin".format(self.stack_version)
         ]
 
     def get_build_args(self):
@@ -53,52 +157,100 @@ class MatlabWTStackBuildPack(JupyterWTStackBuildPack):
         """
         return super().get_build_args() | {"FILE_INSTALLATION_KEY": "some_key"}
 
+    def get_toolboxes(self):
+        """Sorted products listed in toolboxes.txt."""
+        toolboxes_path = self.binder_path("toolboxes.txt")
+        if not self.repo_index.exists(toolboxes_path):
+            return []
+        toolboxes = set()
+        with open(toolboxes_path) as f:
+            for line in f:
+                toolbox = line.strip()
+                if not toolbox:
+                    continue
+                # Passed to the installer in a shell command
+                if not re.match(r"^[A-Za-z0-9_.]+$", toolbox):
+                    raise ValueError(
+                        "Found invalid product {} in toolboxes.txt".format(toolbox)
+                    )
+                toolboxes.add(toolbox)
+        toolboxes.discard("product.MATLAB")
+        return sorted(toolboxes)
+
+    def get_stages(self):
+        """
+        Installs MATLAB and all the toolboxes in a stage of its own.
+
+        Installer image, version and products are all the stage depends
+        on, so tales with the same toolboxes share its cache.
+        """
+        matlab_version = self.stack_version
+        products = " ".join(
+            "-" + product for product in ["product.MATLAB"] + self.get_toolboxes()
+        )
+        # This is ugly, but I couldn't think of a better way. The Matlab
+        # install script outputs the secret install key and succeeds on error.
+        # So, I'm grepping out the secret key and grepping for the success
+        # message. The tee is there so that output isn't consumed by grep.
+        stage = "\n".join(
+            [
+                "FROM {} AS wt-matlab".format(self.base_image),
+                "ARG FILE_INSTALLATION_KEY",
+                "ENV DEBIAN_FRONTEND=noninteractive",
+                "RUN apt-get -qq update && \\",
+                "    apt-get -qq install --yes --no-install-recommends \\",
+                "        {} \\".format(" ".join(sorted(MATLAB_PACKAGES))),
+                "        > /dev/null && \\",
+                "    rm -rf /var/lib/apt/lists/*",
+                "RUN --mount=type=bind,target=/matlab-install,"
+                "source=/matlab-install/,from=matlab-install:{} \\".format(
+                    matlab_version
+                ),
+                "    cd /matlab-install && ./install -mode silent "
+                "-outputFile /dev/stdout \\",
+                "    -destinationFolder /usr/local/MATLAB/{} \\".format(
+                    matlab_version
+                ),
+                "    -licensePath /matlab-install/network.lic -agreeToLicense yes \\",
+                "    -fileInstallationKey ${FILE_INSTALLATION_KEY} \\",
+                "    {} \\".format(products),
+                "    | grep --line-buffered -v fileInstallationKey \\",
+                "    | tee /dev/stderr | grep 'End - Successful'",
+                "",
+            ]
+        )
+        return super().get_stages() + [stage]
+
+    def get_linked_copies(self):
+        """MATLAB, from its installation stage."""
+        return super().get_linked_copies() + [
+            ("wt-matlab", "/usr/local/MATLAB", "/usr/local/MATLAB")
+        ]
+
     def get_build_scripts(self):
         """
-        Uses Docker builtkit to mount matlab install image to
-        install MATLAB core product. Installs Python engine and
-        Jupyter kernel.
+        Installs Python engine and Jupyter kernel, and with the desktop the
+        MATLAB launcher.
         """
         matlab_proxy_version = self.wt_env.get("WT_MATLAB_PROXY_VERSION", "v0.3.2")
         ipykernel_version = self.wt_env.get("WT_IPYKERNEL", "5.5.6")
         metakernel_version = self.wt_env.get("WT_METAKERNEL", "0.28.2")
         matlabkernel_version = self.wt_env.get("WT_MATLABKERNEL", "0.16.11")
 
-        return super().get_build_scripts() + [
-            (
-                "root",
-                r"""
-                wget -q https://xpra.org/gpg.asc -O- | apt-key add - && \
-                add-apt-repository "deb https://xpra.org/ bionic main" && \
-                DEBIAN_FRONTEND=noninteractive apt-get install -y  xpra xpra-html5 && \
-                mkdir -p /run/xpra && chmod 755 /run/xpra && \
-                mkdir -p /run/user/${NB_UID} && chown ${NB_UID} /run/user/${NB_UID} && chmod 700 /run/user/${NB_UID}
-                """,
-            ),
-            (
-                "root",
-                "--mount=type=bind,target=/matlab-install,source=/matlab-install/,"
-                "from=matlab-install:{matlab_version} "
-                "cd /matlab-install &&  ./install -mode silent -outputFile /dev/stdout "
-                "-destinationFolder /usr/local/MATLAB/{matlab_version} "
-                "-licensePath /matlab-install/network.lic -agreeToLicense yes "
-                "-fileInstallationKey ${{FILE_INSTALLATION_KEY}} -product.MATLAB "
-                "| grep --line-buffered -v fileInstallationKey "
-                "| tee /dev/stderr | grep 'End - Successful' ".format(
-                    matlab_version=self.wt_env.get("VERSION", "R2020a")
-                ),
-            ),
+        kernel_packages = "ipykernel=={} metakernel=={} matlab_kernel=={}".format(
+            ipykernel_version, metakernel_version, matlabkernel_version
+        )
+        if self.with_desktop:
+            kernel_packages += " jupyter-matlab-proxy=={}".format(
+                matlab_proxy_version
+            )
+
+        scripts = [
             (
                 "${NB_USER}",
-                r"""
-                ${{NB_PYTHON_PREFIX}}/bin/pip install ipykernel=={ipykernel_version} \
-                    metakernel=={metakernel_version} matlab_kernel=={matlabkernel_version} \
-                    jupyter-matlab-proxy=={matlab_proxy_version}
-                """.format(
-                    matlab_proxy_version=matlab_proxy_version,
-                    ipykernel_version=ipykernel_version,
-                    metakernel_version=metakernel_version,
-                    matlabkernel_version=matlabkernel_version,
+                self.with_cache_mounts(
+                    "${{NB_PYTHON_PREFIX}}/bin/pip install {}".format(kernel_packages),
+                    "pip",
                 ),
             ),
             (
@@ -107,214 +259,29 @@ class MatlabWTStackBuildPack(JupyterWTStackBuildPack):
                 cd /usr/local/MATLAB/*/extern/engines/python && python setup.py install
                 """,
             ),
-            (
-                "${NB_USER}",
-                r"""
-                mkdir -p ${HOME}/Desktop && \
-                printf "[Desktop Entry]\n\
-                Version=1.0\n\
-                Type=Application\n\
-                Name=MATLAB\n\
-                Comment=\n\
-                Exec=matlab –desktop\n\
-                Icon=matlab\n\
-                Path=${HOME}/work/workspace\n\
-                Terminal=true\n\
-                StartupNotify=false\n"\
-                > ${HOME}/Desktop/MATLAB.desktop && \
-                printf "[Desktop Entry]\n\
-                Version=1.0\n\
-                Type=Application\n\
-                Name=Terminal\n\
-                Comment=\n\
-                Exec=exo-open --launch TerminalEmulator\n\
-                Icon=utilities-terminal\n\
-                Path=${HOME}/work/workspace\n\
-                Terminal=false\n\
-                StartupNotify=false\n"\
-                > ${HOME}/Desktop/Terminal.desktop && \
-                printf "[Desktop Entry]\n\
-                Version=1.0\n\
-                Type=Application\n\
-                Name=Firefox\n\
-                Comment=\n\
-                Exec=firefox %u\n\
-                Icon=firefox\n\
-                Path=\n\
-                Terminal=false\n\
-                StartupNotify=false\n"\
-                > ${HOME}/Desktop/Firefox.desktop && \
-                chmod +x ${HOME}/Desktop/*.desktop
-                """,
-            ),
-            (
-                "${NB_USER}",
-                r"""
-                mkdir -p ${HOME}/.config/xfce4/xfconf/xfce-perchannel-xml/ && \
-                printf "<?xml version='1.0' encoding='UTF-8'?> \
-                <channel name='xfce4-panel' version='1.0'> \
-                  <property name='configver' type='int' value='2'/> \
-                  <property name='panels' type='array'> \
-                    <value type='int' value='1'/> \
-                    <property name='panel-1' type='empty'> \
-                      <property name='position' type='string' value='p=8;x=720;y=750'/> \
-                      <property name='length' type='uint' value='100'/> \
-                      <property name='position-locked' type='bool' value='false'/> \
-                      <property name='size' type='uint' value='36'/> \
-                      <property name='plugin-ids' type='array'> \
-                        <value type='int' value='1'/> \
-                        <value type='int' value='3'/> \
-                        <value type='int' value='15'/> \
-                        <value type='int' value='6'/> \
-                      </property> \
-                      <property name='disable-struts' type='bool' value='false'/> \
-                      <property name='nrows' type='uint' value='1'/> \
-                      <property name='length-adjust' type='bool' value='true'/> \
-                    </property> \
-                  </property> \
-                  <property name='plugins' type='empty'> \
-                    <property name='plugin-1' type='string' value='applicationsmenu'/> \
-                    <property name='plugin-3' type='string' value='tasklist'/> \
-                    <property name='plugin-15' type='string' value='separator'> \
-                      <property name='expand' type='bool' value='true'/> \
-                      <property name='style' type='uint' value='0'/> \
-                    </property> \
-                    <property name='plugin-6' type='string' value='systray'/> \
-                  </property> \
-                </channel>\n" \
-                > ${HOME}/.config/xfce4/xfconf/xfce-perchannel-xml/xfce4-panel.xml
-                """,
-            ),
-            (
-                "root",
-                r"""
+        ]
+        if self.with_desktop:
+            # The package lists were cleaned up in the desktop stage
+            matlab_support = r"""
+                apt-get -qq update && \
                 DEBIAN_FRONTEND=noninteractive apt-get install -y  matlab-support && \
                 chown -R ${NB_USER}:${NB_USER} ${HOME}/.matlab
-                """,
-            )
-        ]
-
-    def get_preassemble_scripts(self):
-        """
-        Introduces toolboxes.txt to specify required Matlab
-        toolboxes.
-        """
-        scripts = []
-
-        toolboxes_path = self.binder_path("toolboxes.txt")
-        if os.path.exists(toolboxes_path):
-            with open(toolboxes_path) as f:
-                toolboxes = f.read().splitlines()
-
-            toolboxes = map(lambda m: "-" + m, toolboxes)
-
-            # This is ugly, but I couldn't think of a better way. The Matlab
-            # install script outputs the secret install key and succeeds on error.
-            # So, I'm grepping out the secret key and grepping for the success
-            # message. The tee is there so that output isn't consumed by grep.
+                """
+            if not self.use_cache_mounts:
+                matlab_support = matlab_support.rstrip() + r""" && \
+                apt-get -qq clean && \
+                rm -rf /var/lib/apt/lists/*
+                """
             scripts += [
-                (
-                    "root",
-                    "--mount=type=bind,target=/matlab-install,source=/matlab-install/,"
-                    "from=matlab-install:{matlab_version} "
-                    "cd /matlab-install &&  ./install -mode silent -outputFile /dev/stdout "
-                    "-destinationFolder /usr/local/MATLAB/{matlab_version} "
-                    "-licensePath /matlab-install/network.lic -agreeToLicense yes "
-                    "-fileInstallationKey ${{FILE_INSTALLATION_KEY}} ".format(
-                        matlab_version=self.wt_env.get("VERSION", "R2020a")
-                    )
-                    + " ".join(toolboxes)
-                    + " | grep --line-buffered -v fileInstallationKey "
-                    " | tee /dev/stderr | grep 'End - Successful'",
-                )
+                desktop_launcher(
+                    "MATLAB", "matlab –desktop", "matlab", terminal=True
+                ),
+                ("root", self.with_cache_mounts(matlab_support, "apt")),
             ]
-
-        return super().get_preassemble_scripts() + scripts
+        return super().get_build_scripts() + scripts
 
     def get_base_packages(self):
-        """
-        Based on:
-        https://github.com/mathworks-ref-arch/matlab-dockerfile/
-        """
-        return {
-            "apt-transport-https",
-            "ca-certificates",
-            "curl",
-            "dbus-x11",
-            "gnupg",
-            "lsb-release",
-            "libasound2",
-            "libatk1.0-0",
-            "libc6",
-            "libcairo2",
-            "libcap2",
-            "libcomerr2",
-            "libcups2",
-            "libdbus-1-3",
-            "libfontconfig1",
-            "libgconf-2-4",
-            "libgcrypt20",
-            "libgdk-pixbuf2.0-0",
-            "libgssapi-krb5-2",
-            "libgstreamer-plugins-base1.0-0",
-            "libgstreamer1.0-0",
-            "libglib2.0-0",
-            "libgtk2.0-0",
-            "libk5crypto3",
-            "libkrb5-3",
-            "libnspr4",
-            "libnspr4-dbg",
-            "libnss3",
-            "libpam0g",
-            "libpango-1.0-0",
-            "libpangocairo-1.0-0",
-            "libpangoft2-1.0-0",
-            "libselinux1",
-            "libsm6",
-            "libsndfile1",
-            "libudev1",
-            "libx11-6",
-            "libx11-xcb1",
-            "libxcb1",
-            "libxcomposite1",
-            "libxcursor1",
-            "libxdamage1",
-            "libxext6",
-            "libxfixes3",
-            "libxft2",
-            "libxi6",
-            "libxmu6",
-            "libxrandr2",
-            "libxrender1",
-            "libxslt1.1",
-            "libxss1",
-            "libxt6",
-            "libxtst6",
-            "libxxf86vm1",
-            "procps",
-            "python3-pip",
-            "python-websockify",
-            "software-properties-common",
-            "wget",
-            "xfonts-base",
-            "xkb-data",
-            "xvfb",
-            "x11-apps",
-            "x11-utils",
-            "x11vnc",
-            "xvfb",
-            "sudo",
-            "zlib1g",
-            "locales",
-            "locales-all",
-            "gcc",
-            "g++",
-            "gfortran",
-            "csh",
-            'xubuntu-icon-theme',
-            'firefox',
-            'mousepad',
-            'xfce4',
-            'xfce4-goodies',
-            'xfce4-panel'
-        }.union(super().get_base_packages())
+        packages = MATLAB_PACKAGES
+        if not self.with_desktop:
+            packages = packages - MATLAB_DESKTOP_PACKAGES
+        return packages.union(super().get_base_packages())
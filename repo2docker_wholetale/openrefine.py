@@ -2,38 +2,45 @@
 
 """Main module."""
 
-import jinja2
-import json
-import os
+import re
 import textwrap
 
+from .artifacts import ARTIFACTS_DIR
+from .render import render_template
 from .wholetale import WholeTaleBuildPack
 
+OPENREFINE_URL = (
+    "https://github.com/OpenRefine/OpenRefine/releases/download/"
+    "{version}/openrefine-linux-{version}.tar.gz"
+)
+# Version -> sha256 of the release archive, WT_OPENREFINE_SHA256 for others
+OPENREFINE_SHA256 = {}
+# OpenRefine major version -> Java release of the runtime
+OPENREFINE_JAVA = {"2": "8", "3": "11"}
+DEFAULT_OPENREFINE_JAVA = "17"
+
 
 class OpenRefineWTStackBuildPack(WholeTaleBuildPack):
+    """
+    OpenRefine, from its release archive.
+
+    `VERSION` in the environment of `environment.json` selects the release
+    (default 2.8), `WT_OPENREFINE_SHA256` its checksum unless pinned. The archive
+    is fetched and unpacked in a stage of its own, the image only has the
+    Java runtime and the unpacked release. Needs Docker with buildkit support
+    (and COPY --link, i.e. Docker 23+).
+    """
+
+    default_version = "2.8"
 
     DOCKERFILE_TEMPLATE = textwrap.dedent(
         r"""
-        FROM ubuntu:xenial-20180726
+        FROM {{ base_image }}
 
         EXPOSE 3333
 
-        WORKDIR /app
-
         ENV OR_VER={{version}}
 
-        RUN apt-get update -qqy && \
-          apt-get install -y wget ant openjdk-8-jdk && \
-          wget https://github.com/OpenRefine/OpenRefine/archive/${OR_VER}.tar.gz && \
-          tar xf ${OR_VER}.tar.gz && \
-          OpenRefine-${OR_VER}/refine build && \
-          rm -rf ${OR_VER}.tar.gz && \
-          apt-get remove -y ant openjdk-8-jdk && \
-          apt-get install -y openjdk-8-jre-headless && \
-          apt autoremove -qy && \
-          apt-get clean && \
-          rm -rf /var/lib/apt/lists/*
-
         RUN useradd -m -g 100 -G 100 -u 1000 -s /bin/bash wtuser
 
         VOLUME /wholetale
@@ -42,23 +49,66 @@ class OpenRefineWTStackBuildPack(WholeTaleBuildPack):
         RUN chown 1000:100 /wholetale
         USER wtuser
 
-        CMD /app/OpenRefine-${OR_VER}/refine -i 0.0.0.0 -d /wholetale/workspace/openrefine
+        CMD /app/openrefine/refine -i 0.0.0.0 -d /wholetale/workspace/openrefine
         """
     )
 
     def detect(self):
-        if not os.path.exists(self.binder_path("environment.json")):
-            return False
-
-        with open(self.binder_path("environment.json"), "r") as fp:
-            env = json.load(fp)
-
-        try:
-            return env["config"]["buildpack"] == "OpenRefineBuildPack"
-        except (KeyError, TypeError):
-            return False
+        return self.detect_buildpack("OpenRefineBuildPack")
+
+    @property
+    def stack_version(self):
+        version = super().stack_version
+        # Ends up in URLs and paths
+        if not re.match(r"^[0-9][0-9A-Za-z.-]*$", version):
+            raise ValueError("Invalid OpenRefine VERSION {!r}".format(version))
+        return version
+
+    @property
+    def base_image(self):
+        java = OPENREFINE_JAVA.get(
+            self.stack_version.split(".")[0], DEFAULT_OPENREFINE_JAVA
+        )
+        # Noble based images already have a user 1000
+        return "eclipse-temurin:{}-jre-jammy".format(java)
+
+    @property
+    def openrefine(self):
+        """The release archive, checked against OPENREFINE_SHA256."""
+        return self.pinned_artifact(
+            OPENREFINE_URL.format(version=self.stack_version),
+            "sha256",
+            "WT_OPENREFINE_SHA256",
+            OPENREFINE_SHA256.get(self.stack_version),
+        )
+
+    def get_stages(self):
+        """Downloads and unpacks the release, no JDK or build needed."""
+        return super().get_stages() + [
+            self.fetch_stage(
+                "wt-openrefine",
+                self.openrefine,
+                "openrefine.tar.gz",
+                r"""
+                mkdir openrefine && \
+                tar xzf openrefine.tar.gz -C openrefine --strip-components 1 \
+                    --no-same-owner && \
+                rm openrefine.tar.gz
+                """,
+            )
+        ]
+
+    def get_linked_copies(self):
+        """The unpacked release, from its fetch stage."""
+        return super().get_linked_copies() + [
+            ("wt-openrefine", ARTIFACTS_DIR + "/openrefine", "/app/openrefine")
+        ]
 
     def render(self, build_args=None):
-        t = jinja2.Template(self.DOCKERFILE_TEMPLATE)
-
-        return t.render(version='2.8')  # TODO: fixme
+        return self.with_stages(
+            render_template(
+                self.DOCKERFILE_TEMPLATE,
+                base_image=self.base_image,
+                version=self.stack_version,
+            )
+        )
@@ -0,0 +1,175 @@
+"""Parser for BuildKit's machine-readable (rawjson) progress output."""
+import base64
+import datetime
+import json
+import re
+
+STEP_STARTED = "step_started"
+STEP_CACHED = "step_cached"
+STEP_FINISHED = "step_finished"
+TRANSFER = "transfer"
+
+_FRACTION = re.compile(r"(\.\d{1,6})\d*")
+
+
+def parse_timestamp(value):
+    """Convert a RFC3339 timestamp with nanoseconds to a POSIX timestamp."""
+    if not value:
+        return None
+    value = _FRACTION.sub(r"\1", value.replace("Z", "+00:00"), count=1)
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+class BuildKitProgress:
+    """
+    Turn `docker build --progress rawjson` output into typed events.
+
+    Every line of rawjson output is a SolveStatus message carrying updates
+    for a set of vertexes (build steps), their statuses (transfers) and logs.
+    BuildKit repeats vertex updates, so the parser keeps the state of each
+    step and emits every event only once. Events are plain dicts with a
+    ``type`` and the ``digest`` of the step they belong to.
+    """
+
+    def __init__(self, log_tail=10):
+        self.steps = {}
+        self.order = []
+        self.log_tail = log_tail
+        self._logs = {}
+
+    def _step(self, digest, name=""):
+        if digest not in self.steps:
+            self.steps[digest] = {
+                "digest": digest,
+                "name": name,
+                "started": None,
+                "completed": None,
+                "duration": None,
+                "cached": False,
+                "error": None,
+            }
+            self.order.append(digest)
+        step = self.steps[digest]
+        if name and not step["name"]:
+            step["name"] = name
+        return step
+
+    def feed(self, line):
+        """
+        Parse a single line of rawjson output.
+
+        Returns a tuple of log text and a list of new events. Lines that
+        aren't JSON (e.g. messages printed by docker-cli itself) are passed
+        through as log text.
+        """
+        try:
+            status = json.loads(line)
+        except ValueError:
+            return line, []
+        if not isinstance(status, dict):
+            return line, []
+
+        events = []
+        text = []
+        for vertex in status.get("vertexes") or []:
+            events += self._vertex(vertex, text)
+        for item in status.get("statuses") or []:
+            step = self._step(item.get("vertex", ""))
+            events.append(
+                {
+                    "type": TRANSFER,
+                    "digest": step["digest"],
+                    "id": item.get("id", ""),
+                    "name": item.get("name", ""),
+                    "current": item.get("current", 0),
+                    "total": item.get("total", 0),
+                }
+            )
+        for log in status.get("logs") or []:
+            data = base64.b64decode(log.get("data", "")).decode(
+                "utf-8", errors="replace"
+            )
+            digest = log.get("vertex", "")
+            tail = self._logs.setdefault(digest, [])
+            tail += data.splitlines()
+            del tail[: -self.log_tail]
+            text.append(data)
+        return "".join(text), events
+
+    def _vertex(self, vertex, text):
+        step = self._step(vertex.get("digest", ""), vertex.get("name", ""))
+        events = []
+        started = parse_timestamp(vertex.get("started"))
+        if started is not None and step["started"] is None:
+            step["started"] = started
+            events.append(
+                {
+                    "type": STEP_STARTED,
+                    "digest": step["digest"],
+                    "name": step["name"],
+                    "timestamp": started,
+                }
+            )
+            text.append("[+] {}\n".format(step["name"]))
+        if vertex.get("cached") and not step["cached"]:
+            step["cached"] = True
+            events.append(
+                {"type": STEP_CACHED, "digest": step["digest"], "name": step["name"]}
+            )
+        completed = parse_timestamp(vertex.get("completed"))
+        if completed is not None and step["completed"] is None:
+            step["completed"] = completed
+            step["error"] = vertex.get("error") or None
+            if step["started"] is None:
+                step["started"] = completed
+            step["duration"] = duration = completed - step["started"]
+            events.append(
+                {
+                    "type": STEP_FINISHED,
+                    "digest": step["digest"],
+                    "name": step["name"],
+                    "timestamp": completed,
+                    "duration": duration,
+                    "cached": step["cached"],
+                    "error": step["error"],
+                }
+            )
+            text.append(
+                "[{}] {} {:.1f}s{}\n".format(
+                    "x" if step["error"] else "=",
+                    step["name"],
+                    duration,
+                    " CACHED" if step["cached"] else "",
+                )
+            )
+        return events
+
+    def timings(self):
+        """List of finished steps, the slowest first."""
+        timings = []
+        for digest in self.order:
+            step = self.steps[digest]
+            if step["completed"] is None:
+                continue
+            timings.append(
+                {
+                    "digest": digest,
+                    "name": step["name"],
+                    "duration": step["duration"],
+                    "cached": step["cached"],
+                }
+            )
+        return sorted(timings, key=lambda step: step["duration"], reverse=True)
+
+    def error(self):
+        """Describe the failed step together with the tail of its logs."""
+        for digest in self.order:
+            step = self.steps[digest]
+            if step["error"]:
+                lines = ["{}: {}".format(step["name"], step["error"])]
+                lines += self._logs.get(digest, [])
+                return "\n".join(lines) + "\n"
+        return None
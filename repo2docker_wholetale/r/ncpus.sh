@@ -0,0 +1,34 @@
+#!/bin/sh
+# Print the number of parallel jobs to use for compiling R packages: the CPUs
+# available to the build (cgroup quota included), but no more than one job
+# per WT_R_JOB_MEMORY MiB (default 2048) of the memory limit.
+cgroup=${WT_CGROUP_ROOT:-/sys/fs/cgroup}
+job_memory=${WT_R_JOB_MEMORY:-2048}
+
+jobs=$(nproc 2>/dev/null || echo 1)
+
+quota=
+if [ -r "$cgroup/cpu.max" ]; then
+    read -r quota period < "$cgroup/cpu.max"
+elif [ -r "$cgroup/cpu/cpu.cfs_quota_us" ]; then
+    quota=$(cat "$cgroup/cpu/cpu.cfs_quota_us")
+    period=$(cat "$cgroup/cpu/cpu.cfs_period_us")
+fi
+if [ -n "$quota" ] && [ "$quota" != "max" ] && [ "$quota" -gt 0 ]; then
+    cpus=$(( (quota + period - 1) / period ))
+    [ "$cpus" -lt "$jobs" ] && jobs=$cpus
+fi
+
+memory=
+if [ -r "$cgroup/memory.max" ]; then
+    memory=$(cat "$cgroup/memory.max")
+elif [ -r "$cgroup/memory/memory.limit_in_bytes" ]; then
+    memory=$(cat "$cgroup/memory/memory.limit_in_bytes")
+fi
+if [ -n "$memory" ] && [ "$memory" != "max" ]; then
+    fit=$(( memory / (job_memory * 1024 * 1024) ))
+    [ "$fit" -lt "$jobs" ] && jobs=$fit
+fi
+
+[ "$jobs" -lt 1 ] && jobs=1
+echo "$jobs"
@@ -0,0 +1,57 @@
+"""Lookup of the buildpack configured for a tale."""
+import importlib
+import os
+
+from .repoindex import RepoIndex
+from .taleconfig import TaleConfig
+
+# config.buildpack of environment.json -> "module:class" implementing it
+BUILDPACKS = {
+    "StataBuildPack": "stata:StataWTStackBuildPack",
+    "MatlabBuildPack": "matlab:MatlabWTStackBuildPack",
+    "OpenRefineBuildPack": "openrefine:OpenRefineWTStackBuildPack",
+    "RBuildPack": "rkernel:RJupyterWTStackBuildPack",
+    "SparkBuildPack": "spark:JupyterSparkWTStackBuildPack",
+    "PythonBuildPack": "jupyter:JupyterWTStackBuildPack",
+    "RockerBuildPack": "rocker:RockerWTStackBuildPack",
+}
+
+
+def load_buildpack(name):
+    """Import the buildpack class registered for ``name``, None if there's none."""
+    try:
+        module, cls = BUILDPACKS[name].split(":")
+    except KeyError:
+        return None
+    return getattr(importlib.import_module("." + module, __package__), cls)
+
+
+def tale_config(path="."):
+    """Configuration of the tale in ``path``, None if there's none."""
+    index = RepoIndex.load(path)
+    config = index.binder_path("environment.json")
+    if not index.isfile(config):
+        return None
+    return TaleConfig.load(os.path.join(path, config))
+
+
+class WholeTaleBuildPackSelector:
+    """
+    Stand-in for all the Whole Tale buildpacks in repo2docker's list.
+
+    Instantiating it returns the buildpack configured for the tale in the
+    current directory, importing only its module, so that selection is a
+    single lookup rather than a detect() of every buildpack. For anything
+    that isn't a tale it returns an instance that detects nothing, leaving
+    the repository to repo2docker's own buildpacks.
+    """
+
+    def __new__(cls):
+        config = tale_config()
+        buildpack = load_buildpack(config.buildpack) if config else None
+        if buildpack is None:
+            return super().__new__(cls)
+        return buildpack()
+
+    def detect(self):
+        return False
@@ -0,0 +1,180 @@
+"""Shared renderer of the Dockerfile templates of the stacks."""
+import collections
+import hashlib
+import json
+import re
+import textwrap
+import threading
+
+import jinja2
+
+
+def script_directives(scripts):
+    """Turn a list of (user, script) into RUN (and USER) directives."""
+    directives = []
+    last_user = "root"
+    for user, script in scripts:
+        if last_user != user:
+            directives.append("USER {}".format(user))
+            last_user = user
+        directives.append("RUN {}".format(textwrap.dedent(script.strip("\n"))))
+    return directives
+
+
+# Steps worth a layer of their own: mounts only apply to the RUN carrying
+# them, and downloads and installs are the steps the layer cache must keep
+# when a neighbouring step changes
+CACHE_SENSITIVE = re.compile(
+    r"^--mount=|apt-get install|pip install|(conda|mamba) (install|env)|"
+    r"install-base-env|Rscript|install\.packages|install_deps|install_local|"
+    r"dpkg -i|curl |wget |wt-fetch "
+)
+
+
+def coalesce_scripts(scripts):
+    """
+    Merge adjacent (user, script) steps of the same user into a single one.
+
+    Each step runs in its own subshell, so that a cd or export doesn't leak
+    into the next one. Cache sensitive steps are never merged.
+    """
+    groups = []
+    mergeable = False
+    for user, script in scripts:
+        script = textwrap.dedent(script.strip("\n")).strip()
+        sensitive = CACHE_SENSITIVE.search(script) is not None
+        if mergeable and not sensitive and groups[-1][0] == user:
+            groups[-1][1].append(script)
+        else:
+            groups.append((user, [script]))
+            mergeable = not sensitive
+
+    coalesced = []
+    for user, group in groups:
+        if len(group) > 1:
+            group = ["( {} )".format(script) for script in group]
+        coalesced.append((user, " && \\\n".join(group)))
+    return coalesced
+
+
+STAGE_FROM = re.compile(r"^FROM\s+(\S+)(?:\s+AS\s+(\S+))?", re.IGNORECASE)
+STAGE_REFERENCE = re.compile(r"[-,]from=([^\s,]+)")
+
+
+def stage_graph(dockerfile):
+    """
+    Steps of the stages of a Dockerfile, in order: name -> [(uses, run)].
+
+    ``uses`` are the stages a step needs, ``run`` whether it's a RUN step.
+    Unnamed stages are named by their index, the last one is "image". Only
+    references to stages of the Dockerfile count, not to other images.
+    """
+    graph = collections.OrderedDict()
+    steps = None
+    continued = False
+    for line in dockerfile.splitlines():
+        match = STAGE_FROM.match(line)
+        if match:
+            base, name = match.groups()
+            steps = graph[name or "stage-{}".format(len(graph))] = []
+            steps.append(({base} & set(graph), False))
+        elif steps is not None and line.strip() and not line.startswith("#"):
+            uses = set(STAGE_REFERENCE.findall(line)) & set(graph)
+            if continued:
+                steps[-1][0].update(uses)
+            else:
+                steps.append((uses, line.startswith("RUN ")))
+        continued = line.endswith("\\")
+    if graph:
+        graph["image"] = graph.popitem()[1]
+    return graph
+
+
+def stage_dependencies(graph):
+    """
+    Stages each stage of a stage_graph() waits for: name -> [(step, stage)].
+
+    ``step`` is the index of the first step using ``stage``, 0 being FROM.
+    BuildKit builds the stages concurrently, a stage only waits for another
+    one at the step using it.
+    """
+    dependencies = collections.OrderedDict()
+    for name, steps in graph.items():
+        seen = set()
+        dependencies[name] = []
+        for step, (uses, _) in enumerate(steps):
+            dependencies[name] += [(step, use) for use in sorted(uses - seen)]
+            seen |= uses
+    return dependencies
+
+
+def _key(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return str(obj)
+
+
+class Renderer:
+    """
+    Render templates, memoizing the output by a hash of the inputs.
+
+    Templates are compiled once per process by a shared jinja2 Environment,
+    which also keeps the compiled bytecode on disk for the next processes.
+    """
+
+    def __init__(self, max_size=256, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._environment = None
+        self._output = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def environment(self):
+        if self._environment is None:
+            self._environment = jinja2.Environment(
+                loader=jinja2.DictLoader({}),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(self.cache_dir),
+                # Templates are named by the hash of their source
+                auto_reload=False,
+            )
+        return self._environment
+
+    def template(self, source):
+        """Compiled template for the source."""
+        name = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        environment = self.environment
+        environment.loader.mapping.setdefault(name, source)
+        return environment.get_template(name)
+
+    def render(self, source, **context):
+        key = hashlib.sha256(
+            json.dumps([source, context], sort_keys=True, default=_key).encode("utf-8")
+        ).hexdigest()
+        with self._lock:
+            if key in self._output:
+                self.hits += 1
+                self._output.move_to_end(key)
+                return self._output[key]
+            self.misses += 1
+
+        output = self.template(source).render(**context)
+        with self._lock:
+            self._output[key] = output
+            while len(self._output) > self.max_size:
+                self._output.popitem(last=False)
+        return output
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._output)}
+
+
+renderer = Renderer()
+
+
+def render_template(source, **context):
+    """Render a template with the shared renderer."""
+    return renderer.render(source, **context)
@@ -0,0 +1,108 @@
+"""Index of the files in a repository and its config directory."""
+import os
+import threading
+
+CONFIG_DIRS = (".wholetale", "binder")
+
+
+def _scan(path):
+    """Map the names in a directory onto whether they are files."""
+    entries = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                entries[entry.name] = entry.is_file()
+            except OSError:
+                entries[entry.name] = False
+    return entries
+
+
+class RepoIndex:
+    """
+    Names of the files at the top of a repository and in its config directory.
+
+    Buildpacks ask for the same handful of files (apt.txt, install.R,
+    postBuild...) over and over while detecting and rendering. The index
+    lists both directories once with scandir and answers all of these
+    questions from memory. ``load`` shares an index between buildpacks of
+    the same repository for as long as neither directory changes.
+    """
+
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path, entries, config_dir=None, config_entries=None):
+        self.path = path
+        self.entries = entries
+        self.config_dir = config_dir
+        self.config_entries = config_entries or {}
+
+    @classmethod
+    def scan(cls, path="."):
+        entries = _scan(path)
+        # .wholetale takes precedence over default binder behaviour
+        config_dir = next((name for name in CONFIG_DIRS if name in entries), None)
+        config_entries = None
+        if config_dir is not None and not entries[config_dir]:
+            config_entries = _scan(os.path.join(path, config_dir))
+        return cls(path, entries, config_dir, config_entries)
+
+    @staticmethod
+    def _stamp(path):
+        stamp = []
+        for name in ("",) + CONFIG_DIRS:
+            try:
+                stamp.append(os.stat(os.path.join(path, name)).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    @classmethod
+    def load(cls, path="."):
+        """Index of ``path``, rescanned only if the directories were modified."""
+        path = os.path.abspath(path)
+        stamp = cls._stamp(path)
+        with cls._lock:
+            cached = cls._cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        index = cls.scan(path)
+        with cls._lock:
+            cls._cache[path] = (stamp, index)
+        return index
+
+    def binder_path(self, name):
+        """Location of a config file, relative to the repository."""
+        if self.config_dir is None:
+            return name
+        return os.path.join(self.config_dir, name)
+
+    def _lookup(self, path):
+        head, name = os.path.split(os.path.normpath(path))
+        if not head:
+            return self.entries.get(name)
+        if head == self.config_dir:
+            return self.config_entries.get(name)
+        # Not indexed
+        if os.path.isfile(os.path.join(self.path, path)):
+            return True
+        return False if os.path.exists(os.path.join(self.path, path)) else None
+
+    def exists(self, path):
+        """Whether ``path`` (relative to the repository) exists."""
+        return self._lookup(path) is not None
+
+    def isfile(self, path):
+        """Whether ``path`` (relative to the repository) is a file."""
+        return bool(self._lookup(path))
+
+    def isdir(self, path):
+        """Whether ``path`` (relative to the repository) is a directory."""
+        return self._lookup(path) is False
+
+    @property
+    def config_files(self):
+        """Files in the config directory (or the top level without one)."""
+        if self.config_dir is None:
+            return sorted(name for name, isfile in self.entries.items() if isfile)
+        return sorted(name for name, isfile in self.config_entries.items() if isfile)
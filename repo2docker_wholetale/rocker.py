@@ -2,14 +2,16 @@
 
 """Main module."""
 
-import jinja2
-import json
 import os
 import textwrap
 
 from distutils.version import LooseVersion as V
 
-from .wholetale import WholeTaleBuildPack
+from repo2docker.buildpacks.r import RBuildPack
+
+from .artifacts import ARTIFACTS_DIR, Artifact, artifacts_mount
+from .render import render_template, script_directives
+from .wholetale import WholeTaleBuildPack, r_binary_repo, r_setup_script
 
 
 class RockerWTStackBuildPack(WholeTaleBuildPack):
@@ -86,8 +88,13 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
         ENV PATH ${HOME}/.local/bin:${REPO_DIR}/.local/bin:${PATH}
 
         USER root
-        # Copy cwd, to get aux files, it's going to be overshadowed with WT mount
-        COPY src/ ${REPO_DIR}
+        {% if assemble_files -%}
+        # Copy only the files read by the assemble scripts, so that changes to
+        # the rest of the workspace don't invalidate the dependency layers
+        {% for src in assemble_files -%}
+        COPY src/{{ src }} ${REPO_DIR}/{{ src }}
+        {% endfor -%}
+        {% endif -%}
         # Must chown for build (i.e., install.R)
         RUN chown -R ${NB_USER}:${NB_USER} ${REPO_DIR}
 
@@ -104,6 +111,13 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
         {{ sd }}
         {% endfor %}
 
+        # Copy cwd, to get aux files, it's going to be overshadowed with WT mount
+        USER root
+        COPY --chown=${NB_USER}:${NB_USER} src/ ${REPO_DIR}
+        {% for sd in workspace_script_directives -%}
+        {{ sd }}
+        {% endfor %}
+
         # Container image Labels!
         # Put these at the end, since we don't want to rebuild everything
         # when these change! Did I mention I hate Dockerfile cache semantics?
@@ -139,18 +153,23 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
     )
 
     def detect(self):
-        if not os.path.exists(self.binder_path("environment.json")):
-            return False
+        return self.detect_buildpack("RockerBuildPack")
 
-        with open(self.binder_path("environment.json"), "r") as fp:
-            env = json.load(fp)
+    @property
+    def stack_version(self):
+        return self.wt_env.get("WT_ROCKER_VER", "3.5.1")
 
-        try:
-            return env["config"]["buildpack"] == "RockerBuildPack"
-        except (KeyError, TypeError):
-            return False
+    # The checkpoint date of runtime.txt, parsed as repo2docker does
+    runtime = RBuildPack.runtime
+    checkpoint_date = RBuildPack.checkpoint_date
 
-    def get_build_scripts(self):
+    @property
+    def base_image(self):
+        return "rocker/geospatial:{}".format(self.stack_version)
+
+    @property
+    def rstudio(self):
+        """The RStudio Server package, WT_RSTUDIO_URL and WT_RSTUDIO_MD5."""
         rstudio_url = self.wt_env.get(
             "WT_RSTUDIO_URL",
             (
@@ -161,7 +180,15 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
         rstudio_checksum = self.wt_env.get(
             "WT_RSTUDIO_MD5", "1d2bbd588f9a3ac00580939d4812a7d1"
         )
+        return Artifact(rstudio_url, "md5:" + rstudio_checksum)
+
+    def get_stages(self):
+        """Downloads RStudio while the base image is set up."""
+        return super().get_stages() + [
+            self.fetch_stage("wt-fetch-rstudio", self.rstudio, "rstudio.deb")
+        ]
 
+    def get_build_scripts(self):
         scripts = [
             (
                 "root",
@@ -174,13 +201,11 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
                 "root",
                 # Install RStudio!
                 r"""
-                curl --silent --location --fail {rstudio_url} > /tmp/rstudio.deb && \
-                echo '{rstudio_checksum} /tmp/rstudio.deb' | md5sum -c - && \
-                dpkg -i /tmp/rstudio.deb && \
-                rm /tmp/rstudio.deb && \
+                {} \
+                dpkg -i {}/rstudio.deb && \
                 chown -R rstudio:rstudio /var/lib/rstudio-server
                 """.format(
-                    rstudio_url=rstudio_url, rstudio_checksum=rstudio_checksum
+                    artifacts_mount("wt-fetch-rstudio"), ARTIFACTS_DIR
                 ),
             ),
             (
@@ -192,15 +217,29 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
             ),
         ]
 
+        # Rocker images come with their own (dated) repository, which a {date}
+        # in WT_R_BINARY_REPO only replaces for the date of runtime.txt
+        repo = r_binary_repo(self.wt_env.get("WT_R_BINARY_REPO"), self.checkpoint_date)
+        scripts.append(r_setup_script(repo))
+
         return super().get_build_scripts() + scripts
 
+    def build_user_id(self, build_args):
+        # The rstudio user of the image, whatever NB_UID is
+        return 1000
+
     def get_env(self):
         return super().get_env() + [('PASSWORD', 'thispasswordisnotusedanywhere')]
 
     def get_build_script_files(self):
         """Dict of files to be copied to the container image for use in building
         """
-        files = {os.path.join(os.path.dirname(__file__), "r/start.sh"): "/start.sh"}
+        files = {
+            os.path.join(os.path.dirname(__file__), "r/start.sh"): "/start.sh",
+            os.path.join(os.path.dirname(__file__), "r/ncpus.sh"): (
+                "/usr/local/bin/wt-ncpus"
+            ),
+        }
         files.update(super().get_build_script_files())
         return files
 
@@ -216,6 +255,35 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
         ]
         return super().get_assemble_scripts() + assemble_scripts
 
+    def get_assemble_files(self):
+        """
+        List of files of the tale read by the assemble scripts.
+
+        They are copied before the assemble scripts run, the rest of the
+        workspace only after them. apt.txt is not on the list, its content
+        ends up in the Dockerfile itself.
+        """
+        files = []
+        if self.installR_assemble_script() is not None:
+            files.append(self.binder_path("install.R"))
+        if self.descriptionR_assemble_script() is not None:
+            files.append("DESCRIPTION")
+        return files
+
+    def get_workspace_scripts(self):
+        """Scripts run once the whole workspace is copied into the image."""
+        scripts = []
+        # Without the workspace there's no package source to install
+        if self.copy_workspace and self.descriptionR_assemble_script() is not None:
+            scripts.append(
+                (
+                    "${NB_USER}",
+                    'R --quiet -e "devtools::install_local(getwd(), '
+                    'dependencies = FALSE)"',
+                )
+            )
+        return scripts
+
     def get_packages(self):
         packages = ["curl"]
         if V(self.wt_env.get("WT_ROCKER_VER", "3.5.1")) <= V("3.5.3"):
@@ -232,52 +300,37 @@ class RockerWTStackBuildPack(WholeTaleBuildPack):
         return super().get_path() + ['/usr/lib/rstudio-server/bin/']
 
     def render(self, build_args=None):
-
-        postbuild_file = start_file = None
         files = {'postBuild': None, 'start': None}
 
         for filename in files:
-            if os.path.exists(self.binder_path(filename)):
+            if self.repo_index.exists(self.binder_path(filename)):
                 files[filename] = self.binder_path(filename)
 
-        t = jinja2.Template(RockerWTStackBuildPack.DOCKERFILE_TEMPLATE)
-
-        build_script_directives = []
-        last_user = 'root'
-        for user, script in self.get_build_scripts():
-            if last_user != user:
-                build_script_directives.append("USER {}".format(user))
-                last_user = user
-            build_script_directives.append(
-                "RUN {}".format(textwrap.dedent(script.strip('\n')))
-            )
-
-        assemble_script_directives = []
-        last_user = 'root'
-        for user, script in self.get_assemble_scripts():
-            if last_user != user:
-                assemble_script_directives.append("USER {}".format(user))
-                last_user = user
-            assemble_script_directives.append(
-                "RUN {}".format(textwrap.dedent(script.strip('\n')))
-            )
-
         build_script_files = {
             self.generate_build_context_filename(k)[0]: v
             for k, v in self.get_build_script_files().items()
         }
 
-        return t.render(
+        dockerfile = render_template(
+            self.DOCKERFILE_TEMPLATE,
             image_spec=self.wt_env.get("WT_ROCKER_VER", "3.5.1"),
             files=files,
             labels={},
             path=self.get_path(),
             env=self.get_env(),
             base_packages=self.get_packages(),
-            assemble_script_directives=assemble_script_directives,
+            assemble_files=self.get_assemble_files(),
+            assemble_script_directives=script_directives(
+                self.coalesced(self.get_assemble_scripts())
+            ),
+            workspace_script_directives=script_directives(
+                self.coalesced(self.get_workspace_scripts())
+            ),
             build_script_files=build_script_files,
-            build_scripts=self.get_build_scripts(),
-            build_script_directives=build_script_directives,
+            build_script_directives=script_directives(
+                self.coalesced(self.get_build_scripts())
+            ),
             post_build_scripts=self.get_post_build_scripts(),
             start_script="/start.sh",
         )
+        return self.with_stages(dockerfile)
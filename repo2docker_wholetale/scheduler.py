@@ -0,0 +1,182 @@
+"""Build scheduler coalescing identical builds and bounding concurrency."""
+import threading
+import time
+
+
+class _Flight:
+    """State of a build shared by its leader and all the coalesced waiters."""
+
+    def __init__(self, tag, digest=None):
+        self.tag = tag
+        self.digest = digest
+        self.events = []
+        self.failed = False
+        self.done = False
+        self.cond = threading.Condition()
+
+    def publish(self, event):
+        with self.cond:
+            self.events.append(event)
+            self.failed = self.failed or "error" in event
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def replay(self):
+        """Yield the events of the build as they are published."""
+        seen = 0
+        while True:
+            with self.cond:
+                while seen == len(self.events) and not self.done:
+                    self.cond.wait()
+                events = self.events[seen:]
+                seen = len(self.events)
+                done = self.done
+            yield from events
+            if done and seen == len(self.events):
+                return
+
+
+class BuildScheduler:
+    """
+    Run builds with at most ``max_concurrent`` of them at the same time.
+
+    Builds are identified by a key (e.g. hash of the Dockerfile and the
+    build context). A build submitted while another one with the same key is
+    in flight doesn't run at all, it follows the running one instead: it gets
+    all of its output and, once it succeeds, the resulting image is tagged
+    for it too. ``max_concurrent`` of 0 means no limit.
+
+    A key that doesn't cover the whole context can come with a digest of the
+    context, which is only compared when two builds with the same key meet.
+    """
+
+    def __init__(self, max_concurrent=0, retag=None):
+        self.max_concurrent = max_concurrent
+        self.retag = retag
+        self._slots = (
+            threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        )
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.queued = 0
+        self.running = 0
+        self.max_queue_depth = 0
+        self.builds = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def run(self, key, tag, build, digest=None):
+        """
+        Run ``build()`` (a generator of build events) under ``key``.
+
+        Yields the events of the build, or of the identical build that was
+        already in flight. ``digest`` identifies the context of the build:
+        ``digest.compute()`` hashes it ahead of the build, ``digest.wait()``
+        returns the hash taken while ``build()`` read it (or None), and
+        ``digest.close()`` is called once the build is over.
+        """
+        with self._lock:
+            flight = self._flights.get(key) if key else None
+            leader = flight is None
+            if leader:
+                flight = _Flight(tag, digest)
+                if key:
+                    self._flights[key] = flight
+
+        if not leader and not self._same_context(flight, digest):
+            # Same key, different context: run it on its own
+            leader = True
+            flight = _Flight(tag, digest)
+        if not leader:
+            with self._lock:
+                self.coalesced += 1
+
+        if leader:
+            yield from self._lead(key, flight, build)
+        else:
+            yield from self._follow(flight, tag)
+
+    @staticmethod
+    def _same_context(flight, digest):
+        if flight.digest is None or digest is None:
+            return flight.digest is digest
+        # Waits until the running build has read its context
+        mine = digest.compute()
+        return mine is not None and flight.digest.wait() == mine
+
+    def _lead(self, key, flight, build):
+        completed = False
+        try:
+            queued_at = time.monotonic()
+            if self._slots is not None and not self._slots.acquire(blocking=False):
+                with self._lock:
+                    self.queued += 1
+                    self.max_queue_depth = max(self.max_queue_depth, self.queued)
+                    depth = self.queued
+                event = {
+                    "stream": "Waiting for a build slot ({} queued)\n".format(depth)
+                }
+                flight.publish(event)
+                try:
+                    yield event
+                    self._slots.acquire()
+                finally:
+                    with self._lock:
+                        self.queued -= 1
+            waited = time.monotonic() - queued_at
+            with self._lock:
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.running += 1
+                self.builds += 1
+            try:
+                for event in build():
+                    flight.publish(event)
+                    yield event
+                completed = True
+            finally:
+                with self._lock:
+                    self.running -= 1
+                if self._slots is not None:
+                    self._slots.release()
+        finally:
+            with self._lock:
+                if key and self._flights.get(key) is flight:
+                    del self._flights[key]
+            if not completed:
+                # The leader was abandoned, don't let the waiters use its tag
+                error = "Build of {} was interrupted\n".format(flight.tag)
+                flight.publish({"error": error})
+            if flight.digest is not None:
+                flight.digest.close()
+            flight.finish()
+
+    def _follow(self, flight, tag):
+        yield {"stream": "Waiting for identical build of {}\n".format(flight.tag)}
+        yield from flight.replay()
+        if flight.failed or not tag or tag == flight.tag:
+            return
+        if self.retag is None or not self.retag(flight.tag, tag):
+            yield {"error": "Failed to tag {} as {}\n".format(flight.tag, tag)}
+        else:
+            yield {"stream": "Tagged {} as {}\n".format(flight.tag, tag)}
+
+    def metrics(self):
+        """Queue depth, wait time and deduplication counters."""
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "running": self.running,
+                "queue_depth": self.queued,
+                "max_queue_depth": self.max_queue_depth,
+                "builds": self.builds,
+                "coalesced": self.coalesced,
+                "wait_time_total": self.wait_total,
+                "wait_time_max": self.wait_max,
+                "wait_time_mean": self.wait_total / self.builds if self.builds else 0.0,
+            }
@@ -1,77 +1,207 @@
 import os
+import re
+
+from .artifacts import ARTIFACTS_DIR, Artifact, artifacts_mount
 from .jupyter import JupyterWTStackBuildPack
 
+# (Spark, Hadoop) -> sha512 of the release from archive.apache.org. Other
+# releases need WT_SPARK_SHA512.
+SPARK_VERSIONS = {
+    ("2.4.3", "2.7"): (
+        "E8B7F9E1DEC868282CADCAD81599038A22F48FB597D44AF1B13FCC76B7DACD2A"
+        "1CAF431F95E394E1227066087E3CE6C2137C4ABAF60C60076B78F959074FF2AD"
+    ),
+}
+DEFAULT_SPARK_VERSION = "2.4.3"
+DEFAULT_HADOOP_VERSION = "2.7"
+SPARK_URL = (
+    "https://archive.apache.org/dist/spark/spark-{spark}/"
+    "spark-{spark}-bin-hadoop{hadoop}.tgz"
+)
+# Settings of base/spark_defaults.py taken from environment.json
+SPARK_OVERRIDES = (
+    "WT_SPARK_MASTER",
+    "WT_SPARK_DRIVER_MEMORY",
+    "WT_SPARK_MEMORY_FRACTION",
+    "WT_SPARK_SHUFFLE_PARTITIONS",
+    "WT_SPARK_ARROW",
+)
+
 
 class JupyterSparkWTStackBuildPack(JupyterWTStackBuildPack):
+    """
+    Jupyter with Apache Spark in local mode.
+
+    Settings in the environment of `environment.json`:
+
+    * `WT_SPARK_VERSION` and `WT_HADOOP_VERSION` select the release
+      (default 2.4.3 with Hadoop 2.7). Releases missing from SPARK_VERSIONS
+      need its sha512 in `WT_SPARK_SHA512`.
+    * `WT_SPARK_MESOS=1` adds the Mesos native library, from the mesosphere
+      repository, for tales running on a Mesos cluster.
+    * `WT_SPARK_*` overrides of the runtime settings, see SPARK_OVERRIDES.
+    """
+
+    default_version = DEFAULT_SPARK_VERSION
 
     def detect(self):
         return super().detect(buildpack="SparkBuildPack")
 
+    @property
+    def stack_version(self):
+        return self.spark_version
+
+    @property
+    def spark_version(self):
+        return self._version("WT_SPARK_VERSION", DEFAULT_SPARK_VERSION)
+
+    @property
+    def hadoop_version(self):
+        return self._version("WT_HADOOP_VERSION", DEFAULT_HADOOP_VERSION)
+
+    def _version(self, key, default):
+        version = self.wt_env.get(key, default)
+        # Ends up in URLs, paths and shell commands
+        if not re.match(r"^[0-9][0-9A-Za-z.-]*$", version):
+            raise ValueError("Invalid {} {!r}".format(key, version))
+        return version
+
+    @property
+    def spark_dir(self):
+        return "spark-{}-bin-hadoop{}".format(self.spark_version, self.hadoop_version)
+
+    @property
+    def spark_artifact(self):
+        """The release archive, checked against SPARK_VERSIONS or WT_SPARK_SHA512."""
+        versions = (self.spark_version, self.hadoop_version)
+        checksum = self.wt_env.get("WT_SPARK_SHA512") or SPARK_VERSIONS.get(versions)
+        if checksum is None:
+            raise ValueError(
+                "No checksum known for Spark {} with Hadoop {}, set WT_SPARK_SHA512 "
+                "or use one of: {}".format(
+                    *versions,
+                    ", ".join("{}/{}".format(*v) for v in sorted(SPARK_VERSIONS))
+                )
+            )
+        return Artifact(
+            SPARK_URL.format(spark=versions[0], hadoop=versions[1]),
+            "sha512:" + checksum,
+        )
+
+    @property
+    def with_mesos(self):
+        return self.wt_env.get("WT_SPARK_MESOS", "0").lower() in ("1", "true", "yes")
+
+    @property
+    def spark2(self):
+        return self.spark_version.split(".")[0] == "2"
+
+    def get_stages(self):
+        """Downloads and unpacks Spark while the base image is set up."""
+        return super().get_stages() + [
+            self.fetch_stage(
+                "wt-spark",
+                self.spark_artifact,
+                "spark.tgz",
+                "tar xzf spark.tgz --owner root --group root --no-same-owner && "
+                "rm spark.tgz",
+            )
+        ]
+
     def get_build_scripts(self):
         env_prefix = "${KERNEL_PYTHON_PREFIX}" if self.py2 else "${NB_PYTHON_PREFIX}"
-        return super().get_build_scripts() + [
+        if self.spark2:
+            # Spark 2.4 supports pyarrow >= 0.15 only with the legacy IPC
+            # format, and no pyarrow >= 1.0 at all
+            pyarrow_spec = "pyarrow>=0.15,<1"
+        else:
+            pyarrow_spec = "pyarrow>=1"
+        pyarrow = r"""conda install --quiet -p {0} -y '{1}'""".format(
+            env_prefix, pyarrow_spec
+        )
+        if not self.use_cache_mounts:
+            pyarrow += r""" && \
+    conda clean --all -f -y"""
+        scripts = [
             (
                 "root",
-                r"""cd /tmp && \
-    wget -q http://archive.apache.org/dist/spark/spark-${APACHE_SPARK_VERSION}/spark-${APACHE_SPARK_VERSION}-bin-hadoop${HADOOP_VERSION}.tgz && \
-    echo "E8B7F9E1DEC868282CADCAD81599038A22F48FB597D44AF1B13FCC76B7DACD2A1CAF431F95E394E1227066087E3CE6C2137C4ABAF60C60076B78F959074FF2AD *spark-${APACHE_SPARK_VERSION}-bin-hadoop${HADOOP_VERSION}.tgz" | sha512sum -c - && \
-    tar xzf spark-${APACHE_SPARK_VERSION}-bin-hadoop${HADOOP_VERSION}.tgz -C /usr/local --owner root --group root --no-same-owner && \
-    rm spark-${APACHE_SPARK_VERSION}-bin-hadoop${HADOOP_VERSION}.tgz""",
+                # Copied this late, the image doesn't wait for the download.
+                # The name of the py4j archive changes with the release.
+                r"""
+                {} \
+                cp -a {}/{} /usr/local/ && \
+                cd /usr/local && ln -s {} spark && \
+                ln -s $(basename spark/python/lib/py4j-*-src.zip) spark/python/lib/py4j-src.zip
+                """.format(
+                    artifacts_mount("wt-spark"),
+                    ARTIFACTS_DIR,
+                    self.spark_dir,
+                    self.spark_dir,
+                ),
             ),
             (
                 "root",
+                # spark-defaults.conf follows the limits of the container
                 r"""
-                cd /usr/local && ln -s spark-${APACHE_SPARK_VERSION}-bin-hadoop${HADOOP_VERSION} spark
+                chown -R ${NB_USER}:${NB_USER} ${SPARK_HOME}/conf && \
+                echo 'wt-spark-defaults > /dev/null || true' > /etc/profile.d/wt-spark-defaults.sh
                 """,
             ),
-            (
-                "root",
-                r"""apt-get -qqy update && \
+        ]
+        if self.with_mesos:
+            mesos = r"""apt-get -qqy update && \
     apt-get install --no-install-recommends -y gnupg libcurl3 && \
     apt-key add /tmp/mesos.key && \
     echo "deb http://repos.mesosphere.io/ubuntu xenial main" > /etc/apt/sources.list.d/mesosphere.list && \
     apt-get -qqy update && \
     apt-get --no-install-recommends -y install mesos=1.2\* && \
-    apt-get purge -qqy && \
-    rm -rf /var/lib/apt/lists/*""",
-            ),
-            (
-                "${NB_USER}",
-                r"""conda install --quiet -p {0} -y 'pyarrow' && \
-    conda clean --all -f -y""".format(
-                    env_prefix
-                ),
-            ),
-        ]
+    apt-get purge -qqy"""
+            if not self.use_cache_mounts:
+                mesos += r""" && \
+    rm -rf /var/lib/apt/lists/*"""
+            scripts.append(("root", self.with_cache_mounts(mesos, "apt")))
+        scripts.append(("${NB_USER}", self.with_cache_mounts(pyarrow, "conda")))
+        return super().get_build_scripts() + scripts
 
     def get_build_script_files(self):
         scripts = {
-            os.path.join(os.path.dirname(__file__), "mesos.key"): "/tmp/mesos.key"
+            os.path.join(os.path.dirname(__file__), "base/spark_defaults.py"): (
+                "/usr/local/bin/wt-spark-defaults"
+            ),
         }
+        if self.with_mesos:
+            scripts[os.path.join(os.path.dirname(__file__), "mesos.key")] = (
+                "/tmp/mesos.key"
+            )
         scripts.update(super().get_build_script_files())
         return scripts
 
     def get_base_packages(self):
-        return {
-            'openjdk-8-jre-headless',
-            'ca-certificates-java',
-            'gnupg',
-        }.union(super().get_base_packages())
+        packages = {'openjdk-8-jre-headless', 'ca-certificates-java'}
+        if self.with_mesos:
+            packages.add('gnupg')
+        return packages.union(super().get_base_packages())
 
     def get_build_env(self):
-        return [
-            ("APACHE_SPARK_VERSION", "2.4.3"),
-            ("HADOOP_VERSION", "2.7"),
+        env = [
+            ("APACHE_SPARK_VERSION", self.spark_version),
+            ("HADOOP_VERSION", self.hadoop_version),
             ("SPARK_HOME", "/usr/local/spark"),
-            ("MESOS_NATIVE_LIBRARY", "/usr/local/lib/libmesos.so"),
-            (
-                "SPARK_OPTS",
-                "--driver-java-options=-Xms1024M "
-                "--driver-java-options=-Xmx4096M "
-                "--driver-java-options=-Dlog4j.logLevel=info",
-            ),
+            # The driver memory is set by wt-spark-defaults
+            ("SPARK_OPTS", "--driver-java-options=-Dlog4j.logLevel=info"),
             (
                 "PYTHONPATH",
-                "$SPARK_HOME/python:$SPARK_HOME/python/lib/py4j-0.10.7-src.zip",
+                "$SPARK_HOME/python:$SPARK_HOME/python/lib/py4j-src.zip",
             ),
-        ] + super().get_build_env()
+        ]
+        if self.spark2:
+            env.append(("ARROW_PRE_0_15_IPC_FORMAT", "1"))
+        if self.with_mesos:
+            env.append(("MESOS_NATIVE_LIBRARY", "/usr/local/lib/libmesos.so"))
+        return env + super().get_build_env()
+
+    def get_env(self):
+        """Overrides of the settings of wt-spark-defaults, see SPARK_OVERRIDES."""
+        return super().get_env() + [
+            (key, self.wt_env[key]) for key in SPARK_OVERRIDES if key in self.wt_env
+        ]
@@ -1,8 +1,14 @@
-import os
-from .jupyter import JupyterWTStackBuildPack
+from .artifacts import ARTIFACTS_DIR, artifacts_mount
+from .desktop import DesktopWTStackBuildPack, desktop_launcher
 
+# No checksum is published for it, WT_LIBPNG12_SHA256 pins it
+LIBPNG12_URL = (
+    "https://launchpad.net/~ubuntu-security/+archive/ubuntu/ppa/+build/15108504/"
+    "+files/libpng12-0_1.2.54-1ubuntu1.1_amd64.deb"
+)
 
-class StataWTStackBuildPack(JupyterWTStackBuildPack):
+
+class StataWTStackBuildPack(DesktopWTStackBuildPack):
     """
     Setup Stata for use with a repository.
 
@@ -13,7 +19,7 @@ class StataWTStackBuildPack(JupyterWTStackBuildPack):
     * `environment.json` contains `buildpack=StataBuildPack`.
 
     Prerequisites:
-    * Docker with buildkit support
+    * Docker with buildkit support (and COPY --link, i.e. Docker 23+)
     * `repo2docker` with the `repo2docker_wholetale` plugin
     * `stata-install:<version>` image build using the
       [stata-install](https://github.com/whole-tale/stata-install)
@@ -23,7 +29,8 @@ class StataWTStackBuildPack(JupyterWTStackBuildPack):
             --config ./repo2docker_config.py ./path-to-repo
     """
 
-    _wt_env = None
+    secret_build_args = ("STATA_LICENSE_ENCODED",)
+    default_version = "16"
 
     def detect(self):
         return super().detect(buildpack="StataBuildPack")
@@ -32,43 +39,48 @@ class StataWTStackBuildPack(JupyterWTStackBuildPack):
         """Add path to STATA binaries to user's PATH."""
         return super().get_path() + ["/usr/local/stata/"]
 
+    def get_linked_copies(self):
+        """Pre-installed core Stata product, from the stata-install image."""
+        return super().get_linked_copies() + [
+            (
+                "stata-install:{}".format(self.stack_version),
+                "/usr/local/stata",
+                "/usr/local/stata",
+            )
+        ]
+
+    def get_stages(self):
+        """Downloads libpng12 while the desktop and the image are set up."""
+        return super().get_stages() + [
+            self.fetch_stage(
+                "wt-fetch-libpng12",
+                self.pinned_artifact(LIBPNG12_URL, "sha256", "WT_LIBPNG12_SHA256"),
+                "libpng12.deb",
+            )
+        ]
+
     def get_build_scripts(self):
         """
-        Uses Docker buildkit to mount stata-install image.
-
-        Copy pre-installed core Stata product. Also installs
-        Jupyter kernel.
+        Installs Jupyter kernel and sets up Stata's ado directories.
         """
         return super().get_build_scripts() + [
             (
                 "root",
                 r"""
-                wget -q https://xpra.org/gpg.asc -O- | apt-key add - && \
-                add-apt-repository "deb https://xpra.org/ bionic main" && \
-                DEBIAN_FRONTEND=noninteractive apt-get install -y  xpra xpra-html5 && \
-                mkdir -p /run/xpra && chmod 755 /run/xpra && \
-                mkdir -p /run/user/${NB_UID} && chown ${NB_UID} /run/user/${NB_UID} && chmod 700 /run/user/${NB_UID}  && \
-                mkdir -p /usr/local/stata
-                """
-            ),
-            (
-                "root",
-                r""" --mount=type=bind,target=/stata-install,source=/usr/local/stata/,from=stata-install:{stata_version} cp -r /stata-install/* /usr/local/stata""".format(stata_version=self.wt_env.get("VERSION", "16"))
-            ),
-            (
-                "root",
-                r"""
-                cd /tmp && \
-                wget -q https://launchpad.net/~ubuntu-security/+archive/ubuntu/ppa/+build/15108504/+files/libpng12-0_1.2.54-1ubuntu1.1_amd64.deb && \
-                dpkg -i libpng12-0_1.2.54-1ubuntu1.1_amd64.deb && \
-                rm -rf /tmp/libpng12-0_1.2.54-1ubuntu1.1_amd64.deb
-                """  # See #28
+                {} \
+                dpkg -i {}/libpng12.deb
+                """.format(
+                    artifacts_mount("wt-fetch-libpng12"), ARTIFACTS_DIR
+                ),  # See #28
             ),
             (
                 "${NB_USER}",
-                r"""
-                ${NB_PYTHON_PREFIX}/bin/pip install stata_kernel==1.10.5 && ${NB_PYTHON_PREFIX}/bin/python -m stata_kernel.install
-                """,
+                self.with_cache_mounts(
+                    r"""
+                    ${NB_PYTHON_PREFIX}/bin/pip install stata_kernel==1.10.5 && ${NB_PYTHON_PREFIX}/bin/python -m stata_kernel.install
+                    """,
+                    "pip",
+                ),
             ),
             (
                 "${NB_USER}",
@@ -82,84 +94,7 @@ class StataWTStackBuildPack(JupyterWTStackBuildPack):
                 sed -i "s/tray = yes/tray = no/g" /etc/xpra/conf.d/05_features.conf
                 """,
             ),
-            (
-                "${NB_USER}",
-                r"""
-                mkdir -p ${HOME}/Desktop && \
-                printf "[Desktop Entry]\n\
-                Version=1.0\n\
-                Type=Application\n\
-                Name=STATA\n\
-                Comment=\n\
-                Exec=xstata\n\
-                Icon=/usr/local/stata/stata16.png\n\
-                Path=${HOME}/work/workspace\n\
-                Terminal=false\n\
-                StartupNotify=false\n"\
-                > ${HOME}/Desktop/STATA.desktop && \
-                printf "[Desktop Entry]\n\
-                Version=1.0\n\
-                Type=Application\n\
-                Name=Terminal\n\
-                Comment=\n\
-                Exec=exo-open --launch TerminalEmulator\n\
-                Icon=utilities-terminal\n\
-                Path=${HOME}/work/workspace\n\
-                Terminal=false\n\
-                StartupNotify=false\n"\
-                > ${HOME}/Desktop/Terminal.desktop && \
-                printf "[Desktop Entry]\n\
-                Version=1.0\n\
-                Type=Application\n\
-                Name=Firefox\n\
-                Comment=\n\
-                Exec=firefox %u\n\
-                Icon=firefox\n\
-                Path=\n\
-                Terminal=false\n\
-                StartupNotify=false\n"\
-                > ${HOME}/Desktop/Firefox.desktop && \
-                chmod +x ${HOME}/Desktop/*.desktop
-                """,
-            ),
-            (
-                "${NB_USER}",
-                r"""
-                mkdir -p ${HOME}/.config/xfce4/xfconf/xfce-perchannel-xml/ && \
-                printf "<?xml version='1.0' encoding='UTF-8'?> \
-                <channel name='xfce4-panel' version='1.0'> \
-                  <property name='configver' type='int' value='2'/> \
-                  <property name='panels' type='array'> \
-                    <value type='int' value='1'/> \
-                    <property name='panel-1' type='empty'> \
-                      <property name='position' type='string' value='p=8;x=720;y=750'/> \
-                      <property name='length' type='uint' value='100'/> \
-                      <property name='position-locked' type='bool' value='false'/> \
-                      <property name='size' type='uint' value='36'/> \
-                      <property name='plugin-ids' type='array'> \
-                        <value type='int' value='1'/> \
-                        <value type='int' value='3'/> \
-                        <value type='int' value='15'/> \
-                        <value type='int' value='6'/> \
-                      </property> \
-                      <property name='disable-struts' type='bool' value='false'/> \
-                      <property name='nrows' type='uint' value='1'/> \
-                      <property name='length-adjust' type='bool' value='true'/> \
-                    </property> \
-                  </property> \
-                  <property name='plugins' type='empty'> \
-                    <property name='plugin-1' type='string' value='applicationsmenu'/> \
-                    <property name='plugin-3' type='string' value='tasklist'/> \
-                    <property name='plugin-15' type='string' value='separator'> \
-                      <property name='expand' type='bool' value='true'/> \
-                      <property name='style' type='uint' value='0'/> \
-                    </property> \
-                    <property name='plugin-6' type='string' value='systray'/> \
-                  </property> \
-                </channel>\n" \
-                > ${HOME}/.config/xfce4/xfconf/xfce-perchannel-xml/xfce4-panel.xml
-                """,
-            ),
+            desktop_launcher("STATA", "xstata", "/usr/local/stata/stata16.png"),
             (
                 "root",
                 r"""
@@ -180,7 +115,7 @@ class StataWTStackBuildPack(JupyterWTStackBuildPack):
         scripts = []
 
         installdo_path = self.binder_path("install.do")
-        if os.path.exists(installdo_path):
+        if self.repo_index.exists(installdo_path):
             scripts += [
                 (
                     "root",
@@ -205,31 +140,15 @@ class StataWTStackBuildPack(JupyterWTStackBuildPack):
     def get_preassemble_script_files(self):
         files = super().get_preassemble_script_files()
         installdo_path = self.binder_path("install.do")
-        if os.path.exists(installdo_path):
+        if self.repo_index.exists(installdo_path):
             files[installdo_path] = installdo_path
 
         return files
 
     def get_base_packages(self):
         return {
-            'apt-transport-https',
-            'dbus-x11',
-            'gnupg',
             'libpng16-16',
             'libgtk2.0-0',
             'libtinfo5',
-            'python-websockify',
-            'software-properties-common',
-            'wget',
-            'x11-apps',
-            'x11-utils',
-            'xubuntu-icon-theme',
-            'firefox',
-            'mousepad',
-            'xfce4',
-            'xfce4-goodies',
-            'xfce4-panel',
-            'xfonts-base',
-            'xvfb',
             'xxd',
         }.union(super().get_base_packages())
@@ -0,0 +1,89 @@
+"""Parsed and validated environment.json of a tale."""
+import json
+import os
+import threading
+
+
+class TaleConfigError(ValueError):
+    """environment.json of a tale is malformed."""
+
+
+class TaleConfig:
+    """
+    Configuration of a tale, as stored in its environment.json.
+
+    All buildpacks detecting and rendering the same tale share a single
+    instance: ``load`` parses the file only once per path and modification
+    time. The file is validated up front, so that a malformed config fails
+    with a clear message rather than a KeyError deep in a render.
+    """
+
+    _cache = {}
+    _lock = threading.Lock()
+    # Number of times a file was actually parsed
+    parses = 0
+
+    def __init__(self, path, buildpack=None, environment=None):
+        self.path = path
+        self.buildpack = buildpack
+        self.environment = environment or {}
+
+    @classmethod
+    def load(cls, path):
+        """Return the config stored in ``path``, or None if there's no such file."""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with cls._lock:
+            cached = cls._cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with open(path, "r") as fp:
+            try:
+                data = json.load(fp)
+            except ValueError as e:
+                raise TaleConfigError("{} is not valid JSON: {}".format(path, e))
+        config = cls.parse(data, path)
+        with cls._lock:
+            TaleConfig.parses += 1
+            cls._cache[path] = (stamp, config)
+        return config
+
+    @classmethod
+    def parse(cls, data, path="environment.json"):
+        """Validate the content of environment.json."""
+        if not isinstance(data, dict):
+            raise TaleConfigError("{} must contain an object".format(path))
+        config = data.get("config")
+        if config is None:
+            # Not a tale config, no buildpack will detect it
+            return cls(path)
+        if not isinstance(config, dict):
+            raise TaleConfigError("config in {} must be an object".format(path))
+
+        buildpack = config.get("buildpack")
+        if buildpack is not None and not isinstance(buildpack, str):
+            raise TaleConfigError(
+                "config.buildpack in {} must be a string".format(path)
+            )
+
+        environment = {}
+        entries = config.get("environment") or []
+        if not isinstance(entries, list):
+            raise TaleConfigError(
+                "config.environment in {} must be a list".format(path)
+            )
+        for entry in entries:
+            if not isinstance(entry, str) or "=" not in entry:
+                raise TaleConfigError(
+                    "Invalid config.environment entry {!r} in {}, "
+                    "expected NAME=value".format(entry, path)
+                )
+            # Values may contain "=" too (e.g. URLs with a query)
+            name, _, value = entry.partition("=")
+            environment[name] = value
+        return cls(path, buildpack, environment)
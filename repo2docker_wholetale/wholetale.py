@@ -3,35 +3,584 @@
 """Main module."""
 
 import datetime
-import json
+import io
 import re
 import os
-import shutil
-import tempfile
+import tarfile
+import textwrap
 
-from repo2docker.buildpacks.base import BuildPack
+from repo2docker.buildpacks.base import BuildPack, DEFAULT_NB_UID, HERE, TEMPLATE
 from repo2docker.buildpacks.r import RBuildPack
 from repo2docker.buildpacks.python import PythonBuildPack
 
+from .artifacts import ARTIFACTS_DIR, FETCH_IMAGE, FETCH_SCRIPT, Artifact
+from .cache import build_cache_key, workspace_digest
+from .dockercli import DockerCLIEngine
+from .render import (
+    coalesce_scripts,
+    render_template,
+    script_directives,
+    stage_dependencies,
+    stage_graph,
+)
+from .repoindex import RepoIndex
+from .taleconfig import TaleConfig
+
+
+# Download caches of the package managers: (name, target, sharing) of the
+# cache mounts and the variable pointing the tool at them. R has none, as
+# install.packages() downloads every package again anyway.
+CACHE_MOUNTS = {
+    "apt": (
+        [
+            ("apt-cache", "/var/cache/apt", "locked"),
+            ("apt-lists", "/var/lib/apt/lists", "locked"),
+        ],
+        None,
+    ),
+    "pip": ([("pip", "/var/cache/wt/pip", "shared")], "PIP_CACHE_DIR"),
+    "conda": ([("conda", "/var/cache/wt/conda", "locked")], "CONDA_PKGS_DIRS"),
+    # Files fetched by wt-fetch, see artifacts.py
+    "artifacts": (
+        [("artifacts", "/var/cache/wt/artifacts", "shared")],
+        "WT_ARTIFACT_CACHE",
+    ),
+}
+# Deletes the packages apt downloaded after each install in Debian images
+DOCKER_CLEAN = "/etc/apt/apt.conf.d/docker-clean"
+
+
+# First snapshot of the binary packages in Posit Package Manager
+PPM_FIRST_SNAPSHOT = datetime.date(2017, 10, 10)
+
+
+def r_binary_repo(repo, snapshot_date):
+    """
+    WT_R_BINARY_REPO ``repo`` for the checkpoint date, None if it can't be used.
+
+    A ``{date}`` in it is replaced with ``snapshot_date``, so it needs one that
+    isn't earlier than the first binary snapshot.
+    """
+    if not repo:
+        return None
+    if "{date}" not in repo:
+        return repo
+    if not snapshot_date or snapshot_date < PPM_FIRST_SNAPSHOT:
+        return None
+    return repo.format(date=snapshot_date.isoformat())
+
+
+def r_setup_script(repo=None):
+    """
+    Configure R to install packages in parallel and, optionally, from ``repo``.
+
+    The number of jobs is exported by with_parallel_make() as WT_NCPUS, so
+    outside of the install steps R keeps its default of a single one.
+    """
+    script = r"""
+        echo 'options(Ncpus = as.integer(Sys.getenv("WT_NCPUS", "1")))' >> "$(R RHOME)/etc/Rprofile.site"
+        """
+    if repo:
+        # Binary repositories tell the platform apart by the user agent
+        script = script.rstrip() + r""" && \
+        echo 'options(repos = c(CRAN = "{}"))' >> "$(R RHOME)/etc/Rprofile.site" && \
+        echo 'options(HTTPUserAgent = sprintf("R/%s R (%s)", getRversion(), paste(getRversion(), R.version$platform, R.version$arch, R.version$os)))' >> "$(R RHOME)/etc/Rprofile.site"
+        """.format(
+            repo
+        )
+    return ("root", script)
+
+
+def with_parallel_make(script):
+    """Run an R package installation with as many jobs as the build can afford."""
+    return "export WT_NCPUS=$(wt-ncpus) && export MAKEFLAGS=-j${WT_NCPUS} && " + script
+
+
+def workspace_usage(path=".", exclude=()):
+    """Number and total size of the files in the workspace, minus ``exclude``."""
+    exclude = {os.path.normpath(os.path.join(path, name)) for name in exclude}
+    files = size = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            fname = os.path.normpath(os.path.join(root, name))
+            if fname in exclude or os.path.islink(fname):
+                continue
+            files += 1
+            size += os.lstat(fname).st_size
+    return files, size
 
-class WholeTaleBuildPack(BuildPack):
+
+_SCRIPT_GETTERS = (
+    "get_build_scripts",
+    "get_preassemble_scripts",
+    "get_assemble_scripts",
+)
+
+
+class WholeTaleMixin:
+    """Behaviour shared by all Whole Tale buildpacks."""
 
     major_pythons = {"2": "2.7", "3": "3.8"}
-    _wt_env = None
+    default_version = "latest"
+    _repo_index = None
+    _tale_config = None
+
+    # Files of a tale read by the build steps, the rest is just copied
+    dependency_files = (
+        "apt.txt",
+        "install.R",
+        "DESCRIPTION",
+        "postBuild",
+        "start",
+        "toolboxes.txt",
+        "install.do",
+        "requirements.txt",
+        "requirements3.txt",
+        "setup.py",
+        "Pipfile",
+        "Pipfile.lock",
+        "environment.yml",
+        "runtime.txt",
+        "Project.toml",
+        "Manifest.toml",
+        "REQUIRE",
+    )
+    # Build args that must not end up in cache keys
+    secret_build_args = ()
+    # Build options, set from the traits of the same name of DockerCLIEngine
+    # when building with it, see there
+    engine_options = (
+        "copy_workspace",
+        "use_cache_mounts",
+        "coalesce_runs",
+        "artifact_mirror",
+        "artifact_checksums",
+    )
+    copy_workspace = True
+    use_cache_mounts = False
+    coalesce_runs = False
+    artifact_mirror = ""
+    artifact_checksums = {}
+    # Unprivileged user of the build, set from its build args by build()
+    user_id = DEFAULT_NB_UID
+    base_image = "buildpack-deps:bionic"
+    # Stage (or image) the image starts from instead of base_image
+    base_stage = None
 
     def get_build_args(self):
         return {}
 
+    @property
+    def repo_index(self):
+        """Index of the files of the tale, shared by all the lookups below."""
+        if self._repo_index is None:
+            self._repo_index = RepoIndex.load()
+        return self._repo_index
+
     def binder_path(self, path):
         """
         Locate a build file in a default dir.
 
         .wholetale takes precedence over default binder behaviour
         """
-        for possible_config_dir in (".wholetale", "binder"):
-            if os.path.exists(possible_config_dir):
-                return os.path.join(possible_config_dir, path)
-        return path
+        return self.repo_index.binder_path(path)
+
+    @property
+    def binder_dir(self):
+        # Same as repo2docker's, but from the index
+        has_binder = self.repo_index.isdir("binder")
+        has_dotbinder = self.repo_index.isdir(".binder")
+        if has_binder and has_dotbinder:
+            raise RuntimeError(
+                "The repository contains both a 'binder' and a '.binder' "
+                "directory. However they are exclusive."
+            )
+        if has_dotbinder:
+            return ".binder"
+        elif has_binder:
+            return "binder"
+        else:
+            return ""
+
+    @property
+    def tale_config(self):
+        """Configuration of the tale (environment.json), None if there's none."""
+        if self._tale_config is None:
+            path = self.binder_path("environment.json")
+            if self.repo_index.isfile(path):
+                self._tale_config = TaleConfig.load(path)
+        return self._tale_config
+
+    def detect_buildpack(self, buildpack):
+        """Whether the tale is configured to use ``buildpack``."""
+        config = self.tale_config
+        return config is not None and config.buildpack == buildpack
+
+    @property
+    def wt_env(self):
+        config = self.tale_config
+        return config.environment if config is not None else {}
+
+    @property
+    def stack_version(self):
+        """Version of the main component of the stack (e.g. R, MATLAB)."""
+        return self.wt_env.get("VERSION", self.default_version)
+
+    @property
+    def cache_scope(self):
+        """Name of the layer cache shared by builds of the same stack and version."""
+        try:
+            version = self.stack_version
+        except (OSError, KeyError, TypeError, ValueError):
+            version = self.default_version
+        return "{}-{}".format(type(self).__name__, version).lower()
+
+    def with_cache_mounts(self, script, *kinds):
+        """
+        Mount the download caches of the given tools for a script.
+
+        Returns the script unchanged unless use_cache_mounts is set. Cache ids
+        include the base image, so that different distros never share a cache.
+        The apt caches are kept by setting DOCKER_CLEAN aside, and putting it
+        back at the end of the step.
+        """
+        if not self.use_cache_mounts:
+            return script
+        slug = re.sub(r"[^a-z0-9.]+", "-", self.base_image.lower())
+        mounts = []
+        setup = []
+        steps = [textwrap.dedent(script.strip("\n")).rstrip()]
+        for kind in kinds:
+            targets, variable = CACHE_MOUNTS[kind]
+            for name, target, sharing in targets:
+                options = "type=cache,id=wt-{}-{},target={},sharing={}".format(
+                    name, slug, target, sharing
+                )
+                if variable:
+                    # Used by the unprivileged user
+                    options += ",uid={0},gid={0}".format(self.user_id)
+                mounts.append("--mount=" + options)
+            if variable:
+                setup.append("export {}={}".format(variable, targets[0][1]))
+            else:
+                aside = "/tmp/wt-docker-clean"
+                setup.append(
+                    "if [ -f {0} ]; then mv {0} {1}; fi".format(DOCKER_CLEAN, aside)
+                )
+                steps.append(
+                    "if [ -f {1} ]; then mv {1} {0}; fi".format(DOCKER_CLEAN, aside)
+                )
+        return "{} \\\n{} && \\\n{}".format(
+            " ".join(mounts), " && ".join(setup), " && \\\n".join(steps)
+        )
+
+    def coalesced(self, scripts):
+        """``scripts`` with adjacent steps merged if coalesce_runs is set."""
+        return coalesce_scripts(scripts) if self.coalesce_runs else scripts
+
+    def run_counts(self):
+        """Number of RUN steps of the scripts, before and after coalescing."""
+        before = after = 0
+        for name in _SCRIPT_GETTERS:
+            scripts = getattr(self, name)()
+            before += len(scripts)
+            after += len(coalesce_scripts(scripts))
+        return before, after
+
+    def get_stages(self):
+        """Dockerfile stages preceding the image, e.g. the one of base_stage."""
+        return []
+
+    def get_linked_copies(self):
+        """
+        List of (image or stage, source, destination) to copy into the image.
+
+        They are copied with COPY --link right after FROM, so the builder
+        reuses the copied layer as is, whatever the layers below it.
+        """
+        return []
+
+    def with_stages(self, dockerfile):
+        """Prepend the stages to the Dockerfile, starting it from base_stage."""
+        start = "FROM {}\n".format(self.base_image)
+        if self.base_stage is not None:
+            dockerfile = dockerfile.replace(
+                start, "FROM {}\n".format(self.base_stage), 1
+            )
+            start = "FROM {}\n".format(self.base_stage)
+        copies = "".join(
+            "COPY --link --from={} {} {}\n".format(*copy)
+            for copy in self.get_linked_copies()
+        )
+        if copies:
+            dockerfile = dockerfile.replace(start, start + copies, 1)
+        stages = self.get_stages()
+        if not stages:
+            return dockerfile
+        dockerfile = "\n".join(stages + [dockerfile])
+        return "{}\n{}".format(self.stage_report(dockerfile), dockerfile)
+
+    @staticmethod
+    def stage_report(dockerfile):
+        """
+        Comment listing the stages of the build and where they wait for others.
+
+        E.g. ``# Stage image (RUN steps: 24): starts from wt-desktop-1, step 2
+        needs wt-matlab``, the steps before the second one run while wt-matlab
+        is being built.
+        """
+        graph = stage_graph(dockerfile)
+        lines = []
+        for name, dependencies in stage_dependencies(graph).items():
+            waits = [
+                "starts from {}".format(use)
+                if step == 0
+                else "step {} needs {}".format(step, use)
+                for step, use in dependencies
+            ]
+            lines.append(
+                "# Stage {} (RUN steps: {}): {}".format(
+                    name,
+                    sum(run for _, run in graph[name]),
+                    ", ".join(waits) or "needs no other stage",
+                )
+            )
+        return "\n".join(lines)
+
+    def fetch_stage(self, name, artifact, filename, script=None):
+        """
+        Stage named ``name`` downloading an artifact to ARTIFACTS_DIR/filename.
+
+        It doesn't depend on the image, so BuildKit fetches the artifact while
+        the image's own steps run. ``script`` then runs in ARTIFACTS_DIR, e.g.
+        to unpack the artifact. The image uses the result through
+        artifacts_mount() or get_linked_copies().
+        """
+        fetch_script = self.generate_build_context_filename(FETCH_SCRIPT)[0]
+        steps = [
+            "mkdir -p {0} && cd {0}".format(ARTIFACTS_DIR),
+            self.fetch_artifact(artifact, filename),
+        ]
+        if script:
+            steps.append(textwrap.dedent(script.strip("\n")).strip())
+        return "\n".join(
+            [
+                "FROM {} AS {}".format(FETCH_IMAGE, name),
+                "COPY {} /usr/local/bin/wt-fetch".format(fetch_script),
+                "RUN {}".format(
+                    self.with_cache_mounts(" && \\\n".join(steps), "artifacts")
+                ),
+                "",
+            ]
+        )
+
+    def render(self, build_args=None):
+        """Same as BuildPack.render, apart from coalesced scripts and the stages."""
+        build_args = build_args or {}
+        build_script_files = {
+            self.generate_build_context_filename(k)[0]: v
+            for k, v in self.get_build_script_files().items()
+        }
+        self._check_stencila()
+        dockerfile = render_template(
+            TEMPLATE,
+            packages=sorted(self.get_packages()),
+            path=self.get_path(),
+            build_env=self.get_build_env(),
+            env=self.get_env(),
+            labels=self.get_labels(),
+            build_script_directives=script_directives(
+                self.coalesced(self.get_build_scripts())
+            ),
+            preassemble_script_files=self.get_preassemble_script_files(),
+            preassemble_script_directives=script_directives(
+                self.coalesced(self.get_preassemble_scripts())
+            ),
+            assemble_script_directives=script_directives(
+                self.coalesced(self.get_assemble_scripts())
+            ),
+            build_script_files=build_script_files,
+            base_packages=sorted(self.get_base_packages()),
+            post_build_scripts=self.get_post_build_scripts(),
+            start_script=self.get_start_script(),
+            appendix=self.appendix,
+            user=build_args.get("NB_UID", DEFAULT_NB_UID),
+        )
+        return self.with_stages(dockerfile)
+
+    def fetch_artifact(self, artifact, dest):
+        """
+        Shell command downloading an artifact to ``dest``.
+
+        It tries artifact_mirror, if set, before the artifact's URL. Steps
+        using it go through with_cache_mounts(script, "artifacts"), so that
+        the download is cached on the node.
+        """
+        return artifact.fetch(dest, self.artifact_mirror or None)
+
+    def pinned_artifact(self, url, algorithm, variable, default=None):
+        """
+        Artifact checked against the digest set by ``variable``, or ``default``.
+
+        Without either, the checksum comes from artifact_checksums, and without
+        that it's an error rather than a download verified by nothing.
+        """
+        digest = self.wt_env.get(variable) or default
+        if digest:
+            return Artifact(url, "{}:{}".format(algorithm, digest))
+        if url in self.artifact_checksums:
+            return Artifact(url, self.artifact_checksums[url])
+        raise ValueError(
+            "No checksum known for {}, set {} in the environment of environment.json "
+            "or pin it in DockerCLIEngine.artifact_checksums".format(url, variable)
+        )
+
+    def get_context_files(self):
+        """
+        Files added to the build context without being copied into the image.
+
+        They are used by the stages, e.g. wt-fetch by the fetch stages, and
+        are named like the build script files.
+        """
+        return [FETCH_SCRIPT]
+
+    def get_dependency_files(self):
+        """List of existing files of the tale that are used by the build steps."""
+        files = []
+        for name in self.dependency_files:
+            for path in (self.binder_path(name), name):
+                if path not in files and self.repo_index.isfile(path):
+                    files.append(path)
+        return files
+
+    def content_key(self, build_args):
+        """
+        Key identifying the image built from the current tale.
+
+        With copy_workspace, the whole workspace ends up in the image, so the
+        key covers all of it, not only the files used by the build steps.
+        """
+        files = {
+            dst: self.generate_build_context_filename(src)[1]
+            for src, dst in self.get_build_script_files().items()
+        }
+        files.update(
+            self.generate_build_context_filename(src)
+            for src in self.get_context_files()
+        )
+        files.update({path: path for path in self.get_dependency_files()})
+        return build_cache_key(
+            self.render(build_args),
+            build_args,
+            files,
+            self.secret_build_args,
+            workspace=workspace_digest() if self.copy_workspace else None,
+        )
+
+    def build(
+        self,
+        client,
+        image_spec,
+        memory_limit,
+        build_args,
+        cache_from,
+        extra_build_kwargs,
+    ):
+        self.configure(client)
+        if build_args:
+            for k, v in self.get_build_args().items():
+                build_args.setdefault(k, v)
+        else:
+            build_args = self.get_build_args()
+        self.user_id = self.build_user_id(build_args)
+        if isinstance(client, DockerCLIEngine):
+            extra_build_kwargs = dict(extra_build_kwargs, cache_scope=self.cache_scope)
+            if client.result_cache:
+                extra_build_kwargs["content_key"] = self.content_key(build_args)
+        if self.coalesce_runs:
+            yield {
+                "stream": "Coalesced {} RUN steps into {}\n".format(*self.run_counts())
+            }
+        staged = None
+        if not self.copy_workspace:
+            staged = self.get_staged_files()
+            skipped_files, skipped_bytes = workspace_usage(exclude=staged)
+            yield {
+                "stream": "Skipped copying {} files ({} bytes) of the "
+                "workspace\n".format(skipped_files, skipped_bytes)
+            }
+        # Same as BuildPack.build, apart from the context
+        if not isinstance(memory_limit, int):
+            raise ValueError(
+                "The memory limit has to be specified as an"
+                "integer but is '{}'".format(type(memory_limit))
+            )
+        limits = {}
+        if memory_limit:
+            limits = {"memory": memory_limit, "memswap": memory_limit}
+        build_kwargs = dict(
+            fileobj=self._build_context(build_args, staged),
+            tag=image_spec,
+            custom_context=True,
+            buildargs=build_args,
+            container_limits=limits,
+            cache_from=cache_from,
+        )
+        build_kwargs.update(extra_build_kwargs)
+        yield from client.build(**build_kwargs)
+
+    def build_user_id(self, build_args):
+        """Id of the user the image is built for, by default the NB_UID build arg."""
+        return int(build_args.get("NB_UID", DEFAULT_NB_UID))
+
+    def configure(self, client):
+        """Take the build options from the engine, if it has them."""
+        if isinstance(client, DockerCLIEngine):
+            for name in self.engine_options:
+                setattr(self, name, getattr(client, name))
+
+    def get_staged_files(self):
+        """Files of the tale staged into the image if the workspace isn't."""
+        return self.get_dependency_files()
+
+    def _build_context(self, build_args, staged=None):
+        """
+        Build context with the context files and the tale under src/.
+
+        Only the ``staged`` files of the tale are added, unless it's None.
+        """
+        tarf = io.BytesIO()
+        tar = tarfile.open(fileobj=tarf, mode="w")
+        dockerfile = self.render(build_args).encode("utf-8")
+        dockerfile_tarinfo = tarfile.TarInfo("Dockerfile")
+        dockerfile_tarinfo.size = len(dockerfile)
+        tar.addfile(dockerfile_tarinfo, io.BytesIO(dockerfile))
+
+        def _filter_tar(tar):
+            tar.uname = ""
+            tar.gname = ""
+            tar.uid = int(build_args.get("NB_UID", DEFAULT_NB_UID))
+            tar.gid = int(build_args.get("NB_UID", DEFAULT_NB_UID))
+            return tar
+
+        sources = set(self.get_build_script_files()) | set(self.get_context_files())
+        for src in sorted(sources):
+            dest_path, src_path = self.generate_build_context_filename(src)
+            tar.add(src_path, dest_path, filter=_filter_tar)
+        for fname in ("repo2docker-entrypoint", "python3-login"):
+            tar.add(os.path.join(HERE, fname), fname, filter=_filter_tar)
+        if staged is None:
+            tar.add(".", "src/", filter=_filter_tar)
+        else:
+            tar.add(".", "src/", recursive=False, filter=_filter_tar)
+            for path in sorted(staged):
+                tar.add(path, "src/" + os.path.normpath(path), filter=_filter_tar)
+        tar.close()
+        tarf.seek(0)
+        return tarf
+
+
+class WholeTaleBuildPack(WholeTaleMixin, BuildPack):
 
     def get_build_script_files(self):
         """
@@ -49,13 +598,13 @@ class WholeTaleBuildPack(BuildPack):
             {
                 os.path.join(
                     os.path.dirname(__file__), "base/healthcheck.py"
-                ): "/healthcheck.py"
+                ): "/healthcheck.py",
             }
         )
         return files
 
     def apt_assemble_script(self):
-        if os.path.exists(self.binder_path("apt.txt")):
+        if self.repo_index.exists(self.binder_path("apt.txt")):
             with open(self.binder_path("apt.txt")) as f:
                 apt_packages = []
                 for l in f:
@@ -73,102 +622,105 @@ class WholeTaleBuildPack(BuildPack):
                     apt_packages.append(package)
 
             if apt_packages:
-                return (
-                    "root",
-                    # This apt-get install is *not* quiet, since users explicitly asked for this
-                    r"""
+                # This apt-get install is *not* quiet, since users explicitly asked for this
+                script = r"""
                     apt-get -qq update && \
                     apt-get install --yes --no-install-recommends {} && \
-                    apt-get -qq purge && \
-                    apt-get -qq clean && \
-                    rm -rf /var/lib/apt/lists/*
+                    apt-get -qq purge
                     """.format(
-                        " ".join(apt_packages)
-                    ),
+                    " ".join(apt_packages)
                 )
+                if not self.use_cache_mounts:
+                    script = script.rstrip() + r""" && \
+                    apt-get -qq clean && \
+                    rm -rf /var/lib/apt/lists/*
+                    """
+                return ("root", self.with_cache_mounts(script, "apt"))
 
     def installR_assemble_script(self):
         installR_path = self.binder_path("install.R")
-        if os.path.exists(installR_path):
-            return ("${NB_USER}", "Rscript %s" % installR_path)
+        if self.repo_index.exists(installR_path):
+            return ("${NB_USER}", with_parallel_make("Rscript %s" % installR_path))
 
     def get_post_build_scripts(self):
         post_build = self.binder_path("postBuild")
-        if os.path.exists(post_build):
+        if self.repo_index.exists(post_build):
             return [post_build]
         return []
 
     def descriptionR_assemble_script(self):
         description_R = "DESCRIPTION"
-        if not self.binder_dir and os.path.exists(description_R):
-            return ("${NB_USER}", 'R --quiet -e "devtools::install_local(getwd())"')
+        if not self.binder_dir and self.repo_index.exists(description_R):
+            # Only the dependencies, the package itself needs the whole workspace
+            return (
+                "${NB_USER}",
+                with_parallel_make('R --quiet -e "devtools::install_deps(getwd())"'),
+            )
 
-    @property
-    def wt_env(self):
-        if self._wt_env is None:
-            with open(self.binder_path("environment.json"), "r") as fp:
-                env = json.load(fp)
-            self._wt_env = dict([_.split("=") for _ in env["config"]["environment"]])
-        return self._wt_env
-
-    def _build(self, *args, **kwargs):
-        """Not used right now...."""
-        tempdir = tempfile.mkdtemp()
 
-        with open(os.path.join(tempdir, "Dockerfile"), "wb") as f:
-            f.write(self.render().encode("utf-8"))
+class WholeTaleRBuildPack(WholeTaleMixin, RBuildPack):
 
-        shutil.copytree(".", os.path.join(tempdir, "src"))
+    @property
+    def python_version(self):
+        """If environment.yaml is present, use PythonBuildPack's parent (conda) python_version"""
+        if self.environment_yaml:
+            return super(PythonBuildPack, self).python_version
+        else:
+            return super(RBuildPack, self).python_version
 
-        args[-1].update({"path": tempdir})  # extra_build_kwargs
-        yield from super().build(*args, **kwargs)
+    def get_cran_mirror_url(self, snapshot_date):
+        """
+        Repository of the checkpoint date, WT_R_BINARY_REPO if set.
 
-        shutil.rmtree(tempdir, ignore_errors=True)
+        A ``{date}`` in WT_R_BINARY_REPO is replaced with the checkpoint date.
+        Without it, or for dates before binary snapshots exist, repo2docker
+        looks the snapshot up itself.
+        """
+        repo = r_binary_repo(self.wt_env.get("WT_R_BINARY_REPO"), snapshot_date)
+        return repo or super().get_cran_mirror_url(snapshot_date)
 
-    def build(
-        self,
-        client,
-        image_spec,
-        memory_limit,
-        build_args,
-        cache_from,
-        extra_build_kwargs,
-    ):
-        if build_args:
-            for k, v in self.get_build_args().items():
-                build_args.setdefault(k, v)
-        else:
-            build_args = self.get_build_args()
-        yield from super().build(
-            client, image_spec, memory_limit, build_args, cache_from, extra_build_kwargs
+    def get_build_script_files(self):
+        files = super().get_build_script_files()
+        files[os.path.join(os.path.dirname(__file__), "r/ncpus.sh")] = (
+            "/usr/local/bin/wt-ncpus"
         )
+        return files
 
+    def get_build_scripts(self):
+        # repo2docker has already set the repository
+        return super().get_build_scripts() + [r_setup_script()]
 
-class WholeTaleRBuildPack(RBuildPack):
+    def get_preassemble_scripts(self):
+        return [self._parallel_R(s) for s in super().get_preassemble_scripts()]
 
-    major_pythons = {"2": "2.7", "3": "3.8"}
+    def get_assemble_scripts(self):
+        scripts = super().get_assemble_scripts()
+        if not self.copy_workspace:
+            scripts = [self._without_workspace(s) for s in scripts]
+        return [self._parallel_R(s) for s in scripts if s is not None]
 
-    def binder_path(self, path):
+    @staticmethod
+    def _without_workspace(script):
         """
-        Locate a build file in a default dir.
+        repo2docker's step as it runs with only the staged files, None if it can't.
 
-        .wholetale takes precedence over default binder behaviour
+        setup.py and the sources of an R package aren't staged, so only the
+        dependencies of the latter are installed.
         """
-        for possible_config_dir in (".wholetale", "binder"):
-            if os.path.exists(possible_config_dir):
-                return os.path.join(possible_config_dir, path)
-        return path
-
-    def get_build_args(self):
-        return {}
+        user, script = script
+        if script.endswith("/bin/pip install --no-cache-dir ."):
+            return None
+        return user, script.replace(
+            "devtools::install_local(getwd())", "devtools::install_deps(getwd())"
+        )
 
-    @property
-    def python_version(self):
-        """If environment.yaml is present, use PythonBuildPack's parent (conda) python_version"""
-        if self.environment_yaml:
-            return super(PythonBuildPack, self).python_version
-        else:
-            return super(RBuildPack, self).python_version
+    @staticmethod
+    def _parallel_R(script):
+        user, script = script
+        installs = ("Rscript", "devtools::install_local", "devtools::install_deps")
+        if "WT_NCPUS" not in script and any(name in script for name in installs):
+            script = with_parallel_make(script)
+        return user, script
 
     def set_checkpoint_date(self):
         if not self.checkpoint_date:
@@ -179,33 +731,7 @@ class WholeTaleRBuildPack(RBuildPack):
             self._runtime = "r-{}".format(str(self._checkpoint_date))
 
     def detect(self, buildpack=None):
-        if not os.path.exists(self.binder_path("environment.json")):
-            return False
-
-        with open(self.binder_path("environment.json"), "r") as fp:
-            env = json.load(fp)
-
-        try:
-            if env["config"]["buildpack"] == buildpack:
-                self.set_checkpoint_date()
-                return True
-        except (KeyError, TypeError):
-            return False
-
-    def build(
-        self,
-        client,
-        image_spec,
-        memory_limit,
-        build_args,
-        cache_from,
-        extra_build_kwargs,
-    ):
-        if build_args:
-            for k, v in self.get_build_args().items():
-                build_args.setdefault(k, v)
-        else:
-            build_args = self.get_build_args()
-        yield from super().build(
-            client, image_spec, memory_limit, build_args, cache_from, extra_build_kwargs
-        )
+        if self.detect_buildpack(buildpack):
+            self.set_checkpoint_date()
+            return True
+        return False
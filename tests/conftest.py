@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""Shared fixtures for `repo2docker_wholetale` tests."""
+
+import json
+import os
+import stat
+import sys
+import textwrap
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import docker
+import pytest
+from repo2docker.buildpacks.r import RBuildPack
+
+from repo2docker_wholetale import dockercli
+from repo2docker_wholetale.desktop import DESKTOP_VERSIONS
+from repo2docker_wholetale.dockercli import DockerCLIEngine
+from repo2docker_wholetale.openrefine import OPENREFINE_URL
+from repo2docker_wholetale.stata import LIBPNG12_URL
+from repo2docker_wholetale.wholetale import WholeTaleMixin
+
+# Checksums of the downloads that have none pinned, as a deployment sets them
+ARTIFACT_CHECKSUMS = {
+    LIBPNG12_URL: "sha256:" + "1" * 64,
+    DESKTOP_VERSIONS["1"]["xpra_key"]: "sha256:" + "3" * 64,
+    OPENREFINE_URL.format(version="2.8"): "sha256:" + "2" * 64,
+}
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark", action="store_true", help="run the tests marked benchmark"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: timing gate, only run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # Timings depend on the machine, the default run stays deterministic
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+FAKE_DOCKER = textwrap.dedent(
+    """\
+    #!{python}
+    import fcntl, json, os, sys, tarfile, time, urllib.request
+
+    def option_values(args, flag):
+        return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == flag]
+
+    def manifest_url(ref):
+        host, _, path = ref.partition("/")
+        repo, _, tag = path.rpartition(":")
+        return "http://{{}}/v2/{{}}/manifests/{{}}".format(host, repo, tag)
+
+    def parse(spec):
+        return dict(item.split("=", 1) for item in spec.split(","))
+
+    def import_cache(spec):
+        spec = parse(spec)
+        if spec["type"] == "local":
+            return os.path.exists(os.path.join(spec["src"], "index.json"))
+        try:
+            urllib.request.urlopen(manifest_url(spec["ref"]))
+        except OSError:
+            return False
+        return True
+
+    def export_cache(spec):
+        spec = parse(spec)
+        if spec["type"] == "local":
+            os.makedirs(spec["dest"], exist_ok=True)
+            with open(os.path.join(spec["dest"], "index.json"), "w") as fp:
+                fp.write("{{}}")
+        else:
+            req = urllib.request.Request(
+                manifest_url(spec["ref"]), data=b"{{}}", method="PUT"
+            )
+            urllib.request.urlopen(req)
+
+    def update_images(update):
+        with open(os.environ["FAKE_DOCKER_IMAGES"], "a+") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            images = set(json.loads(fp.read() or "[]"))
+            result = update(images)
+            fp.seek(0)
+            fp.truncate()
+            fp.write(json.dumps(sorted(images)))
+        return result
+
+    def image_command(args, images):
+        if args[:2] == ["image", "inspect"]:
+            return args[2] in images
+        if args[0] == "tag" and args[1] in images:
+            images.add(args[2])
+            return True
+        if args[0] == "pull" and import_cache("type=registry,ref=" + args[1]):
+            images.add(args[1])
+            return True
+        if args[0] == "push" and args[1] in images:
+            export_cache("type=registry,ref=" + args[1])
+            return True
+        return False
+
+    args = sys.argv[1:]
+    if args[0] != "build":
+        ok = update_images(lambda images: image_command(args, images))
+        with open(os.environ["FAKE_DOCKER_LOG"], "a") as fp:
+            fp.write(json.dumps({{"args": args}}) + "\\n")
+        sys.exit(0 if ok else 1)
+
+    record = {{"args": args, "cwd": os.getcwd(), "members": None}}
+    record["start"] = time.monotonic()
+    if args[-1] == "-":
+        with tarfile.open(fileobj=sys.stdin.buffer, mode="r|") as tar:
+            record["members"] = [m.name for m in tar]
+    elif os.path.isdir(args[-1]):
+        record["members"] = sorted(os.listdir(args[-1]))
+    record["cache_hits"] = [
+        spec for spec in option_values(args, "--cache-from") if import_cache(spec)
+    ]
+    time.sleep(float(os.environ.get("FAKE_DOCKER_SLEEP", "0")))
+    for spec in option_values(args, "--cache-to"):
+        export_cache(spec)
+    record["end"] = time.monotonic()
+    log = os.environ["FAKE_DOCKER_LOG"]
+    with open(log, "a") as fp:
+        fp.write(json.dumps(record) + "\\n")
+    if "FAKE_DOCKER_OUTPUT" in os.environ:
+        with open(os.environ["FAKE_DOCKER_OUTPUT"]) as fp:
+            sys.stdout.write(fp.read())
+    else:
+        print("#1 [internal] load build definition from Dockerfile")
+        print("#1 DONE 0.0s")
+    rc = int(os.environ.get("FAKE_DOCKER_RC", "0"))
+    if rc == 0 and "--tag" in args:
+        update_images(lambda images: images.add(option_values(args, "--tag")[0]))
+    sys.exit(rc)
+    """
+)
+
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch):
+    """Put a fake `docker` binary that records its invocations on PATH."""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    exe = bindir / "docker"
+    exe.write_text(FAKE_DOCKER.format(python=sys.executable))
+    exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+    log = tmp_path / "docker.log"
+    monkeypatch.setenv("PATH", "{}{}{}".format(bindir, os.pathsep, os.environ["PATH"]))
+    monkeypatch.setenv("FAKE_DOCKER_LOG", str(log))
+    monkeypatch.setenv("FAKE_DOCKER_IMAGES", str(tmp_path / "images.json"))
+
+    def calls(command="build"):
+        """Recorded invocations of the given docker command (None for all)."""
+        if not log.exists():
+            return []
+        records = [json.loads(line) for line in log.read_text().splitlines()]
+        return [r for r in records if command is None or r["args"][0] == command]
+
+    return calls
+
+
+@pytest.fixture(autouse=True)
+def offline_cran(monkeypatch):
+    """Rendering R based stacks looks up CRAN snapshots online, keep tests offline."""
+    monkeypatch.setattr(
+        RBuildPack,
+        "get_cran_mirror_url",
+        lambda self, date: "https://cran.example.org/snapshot/{}".format(date),
+    )
+
+
+@pytest.fixture(autouse=True)
+def artifact_checksums(monkeypatch):
+    monkeypatch.setattr(WholeTaleMixin, "artifact_checksums", ARTIFACT_CHECKSUMS)
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """DockerCLIEngine that doesn't need a running docker daemon."""
+    monkeypatch.setattr(docker, "APIClient", lambda **kwargs: None)
+    monkeypatch.setattr(dockercli, "_schedulers", {})
+    engine = DockerCLIEngine(parent=None)
+    engine.artifact_checksums = ARTIFACT_CHECKSUMS
+    return engine
+
+
+@pytest.fixture
+def make_tale(tmp_path, monkeypatch):
+    """Create a tale with the given buildpack and files and chdir into it."""
+
+    def make_tale(buildpack, environment=(), files=None, name="tale"):
+        tale = tmp_path / name
+        (tale / ".wholetale").mkdir(parents=True)
+        config = {"config": {"buildpack": buildpack, "environment": list(environment)}}
+        (tale / ".wholetale" / "environment.json").write_text(json.dumps(config))
+        # Pin the R snapshot, so that detect() doesn't need to compute it
+        (tale / ".wholetale" / "runtime.txt").write_text("r-2022-01-01\n")
+        for path, content in (files or {}).items():
+            (tale / path).parent.mkdir(parents=True, exist_ok=True)
+            (tale / path).write_text(content)
+        monkeypatch.chdir(tale)
+        return tale
+
+    return make_tale
+
+
+class Registry(BaseHTTPRequestHandler):
+    """Minimal stand-in for a registry, storing manifests in memory."""
+
+    manifests = {}
+
+    def do_GET(self):
+        if self.path in self.manifests:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(self.manifests[self.path])
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.manifests[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def registry():
+    Registry.manifests = {}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Registry)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+
+
+class Origin(BaseHTTPRequestHandler):
+    """Stand-in for the servers of the artifacts, recording the requests."""
+
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path in self.files:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(self.files[self.path])
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    """Serve Origin.files on a local port, yielding the handler class."""
+    Origin.files = {}
+    Origin.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    Origin.url = "http://127.0.0.1:{}".format(server.server_port)
+    yield Origin
+    server.shutdown()
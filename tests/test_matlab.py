@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.matlab`."""
+
+import pytest
+
+from repo2docker_wholetale import MatlabWTStackBuildPack
+
+
+def matlab_stage(make_tale, name, toolboxes=None):
+    files = {}
+    if toolboxes is not None:
+        files[".wholetale/toolboxes.txt"] = toolboxes
+    make_tale("MatlabBuildPack", ["VERSION=R2021a"], files, name=name)
+    bp = MatlabWTStackBuildPack()
+    assert bp.detect()
+    dockerfile = bp.render()
+    assert "COPY --link --from=wt-matlab /usr/local/MATLAB" in dockerfile
+    (stage,) = [stage for stage in bp.get_stages() if "AS wt-matlab" in stage]
+    return dockerfile, stage
+
+
+def test_single_installer_run(make_tale):
+    dockerfile, stage = matlab_stage(
+        make_tale, "tale", "product.Simulink\nproduct.Deep_Learning_Toolbox\n"
+    )
+
+    assert dockerfile.count("./install -mode silent") == 1
+    assert "-product.MATLAB -product.Deep_Learning_Toolbox -product.Simulink" in stage
+    assert "from=matlab-install:R2021a" in stage
+
+
+def test_stage_keyed_on_toolbox_set(make_tale):
+    _, first = matlab_stage(
+        make_tale, "first", "product.Simulink\nproduct.Econometrics_Toolbox\n"
+    )
+    _, second = matlab_stage(
+        make_tale,
+        "second",
+        "product.Econometrics_Toolbox\n\nproduct.Simulink\nproduct.MATLAB\n",
+    )
+    assert first == second
+    _, core = matlab_stage(make_tale, "core")
+    assert "-product.MATLAB \\\n" in core
+
+
+def test_invalid_toolbox(make_tale):
+    with pytest.raises(ValueError, match="invalid product"):
+        matlab_stage(make_tale, "tale", "product.Simulink; rm -rf /\n")
+
+
+def render_profile(make_tale, profile):
+    make_tale("MatlabBuildPack", ["WT_MATLAB_PROFILE={}".format(profile)], name=profile)
+    bp = MatlabWTStackBuildPack()
+    assert bp.detect()
+    return bp, bp.render()
+
+
+def test_headless_profile(make_tale):
+    desktop, desktop_dockerfile = render_profile(make_tale, "desktop")
+    headless, dockerfile = render_profile(make_tale, "headless")
+
+    assert "wt-desktop" in desktop_dockerfile
+    assert "wt-desktop" not in dockerfile
+    assert "\nFROM buildpack-deps:bionic\n" in dockerfile
+    for name in ("xfce4", "xpra", "MATLAB.desktop", "matlab-support"):
+        assert name not in dockerfile
+    assert "jupyter-matlab-proxy" not in dockerfile
+    assert "matlab_kernel==" in dockerfile
+    assert "COPY --link --from=wt-matlab /usr/local/MATLAB" in dockerfile
+    packages = headless.get_base_packages()
+    assert packages < desktop.get_base_packages()
+    assert not {"x11vnc", "gcc", "gfortran"} & packages
+
+
+def test_unknown_profile(make_tale):
+    with pytest.raises(ValueError, match="WT_MATLAB_PROFILE 'minimal'"):
+        render_profile(make_tale, "minimal")
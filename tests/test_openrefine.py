@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.openrefine`."""
+
+import pytest
+
+from repo2docker_wholetale import OpenRefineWTStackBuildPack
+
+
+def render(make_tale, environment=()):
+    make_tale("OpenRefineBuildPack", environment)
+    bp = OpenRefineWTStackBuildPack()
+    assert bp.detect()
+    return bp.render()
+
+
+def test_release_archive_in_jre_image(make_tale):
+    dockerfile = render(make_tale)
+
+    assert (
+        'wt-fetch "https://github.com/OpenRefine/OpenRefine/releases/download/'
+        '2.8/openrefine-linux-2.8.tar.gz" sha256:' + "2" * 64
+    ) in dockerfile
+    assert (
+        "\nFROM eclipse-temurin:8-jre-jammy\n"
+        "COPY --link --from=wt-openrefine /artifacts/openrefine /app/openrefine\n"
+    ) in dockerfile
+    assert "CMD /app/openrefine/refine -i 0.0.0.0" in dockerfile
+    assert "refine build" not in dockerfile
+    assert "ant" not in dockerfile.split()
+    assert "openjdk-8-jdk" not in dockerfile
+
+
+def test_version_from_environment(make_tale):
+    dockerfile = render(
+        make_tale, ["VERSION=3.7.2", "WT_OPENREFINE_SHA256=" + "AB" * 32]
+    )
+
+    assert (
+        "releases/download/3.7.2/openrefine-linux-3.7.2.tar.gz\" sha256:" + "ab" * 32
+    ) in dockerfile
+    assert "\nFROM eclipse-temurin:11-jre-jammy\n" in dockerfile
+    assert "ENV OR_VER=3.7.2\n" in dockerfile
+
+
+def test_checksum_required(make_tale, monkeypatch):
+    monkeypatch.setattr(OpenRefineWTStackBuildPack, "artifact_checksums", {})
+    with pytest.raises(ValueError, match="set WT_OPENREFINE_SHA256"):
+        render(make_tale, ["VERSION=3.7.2"])
+
+
+def test_invalid_version(make_tale):
+    with pytest.raises(ValueError, match="Invalid OpenRefine VERSION"):
+        render(make_tale, ["VERSION=3.7.2 && rm -rf /"])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.progress`."""
+
+import json
+
+import pytest
+
+from repo2docker_wholetale.progress import BuildKitProgress, parse_timestamp
+
+
+def status(**kwargs):
+    return json.dumps(kwargs)
+
+
+def test_parse_timestamp():
+    assert parse_timestamp("1970-01-01T00:00:01.123456789Z") == pytest.approx(1.123456)
+    assert parse_timestamp("1970-01-01T00:00:01Z") == 1.0
+    assert parse_timestamp(None) is None
+    assert parse_timestamp("yesterday") is None
+
+
+def test_events_are_emitted_once():
+    parser = BuildKitProgress()
+    vertex = {
+        "digest": "sha256:a",
+        "name": "[1/3] FROM rocker/geospatial",
+        "started": "1970-01-01T00:00:01Z",
+        "cached": True,
+    }
+    _, events = parser.feed(status(vertexes=[vertex]))
+    assert [e["type"] for e in events] == ["step_started", "step_cached"]
+
+    _, events = parser.feed(status(vertexes=[vertex]))
+    assert events == []
+
+    vertex["completed"] = "1970-01-01T00:00:01.5Z"
+    text, events = parser.feed(status(vertexes=[vertex]))
+    assert [e["type"] for e in events] == ["step_finished"]
+    assert events[0]["cached"]
+    assert "CACHED" in text
+
+
+def test_timings_slowest_first():
+    parser = BuildKitProgress()
+    for digest, completed in (("sha256:a", "00:00:02Z"), ("sha256:b", "00:01:00Z")):
+        parser.feed(
+            status(
+                vertexes=[
+                    {
+                        "digest": digest,
+                        "name": digest,
+                        "started": "1970-01-01T00:00:00Z",
+                        "completed": "1970-01-01T" + completed,
+                    }
+                ]
+            )
+        )
+    parser.feed(
+        status(vertexes=[{"digest": "sha256:c", "started": "1970-01-01T00:00:00Z"}])
+    )
+
+    assert [(t["digest"], t["duration"]) for t in parser.timings()] == [
+        ("sha256:b", 60.0),
+        ("sha256:a", 2.0),
+    ]
+
+
+def test_plain_lines_pass_through():
+    parser = BuildKitProgress()
+    assert parser.feed("ERROR: failed to solve\n") == ("ERROR: failed to solve\n", [])
+    assert parser.error() is None
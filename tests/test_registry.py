@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.registry`."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from repo2docker_wholetale.registry import BUILDPACKS, WholeTaleBuildPackSelector
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def python(code, *options, cwd=ROOT):
+    return subprocess.run(
+        [sys.executable] + list(options) + ["-c", code],
+        cwd=cwd,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_import_is_lazy():
+    proc = python("import repo2docker_wholetale", "-X", "importtime")
+
+    imported = set()
+    for line in proc.stderr.splitlines()[1:]:
+        imported.add(line.split("|")[2].strip())
+    assert "repo2docker_wholetale" in imported
+    # Importing every stack takes ~0.4s, mostly repo2docker itself
+    for module in ("repo2docker", "jinja2", "distutils"):
+        assert module not in imported
+    assert "repo2docker_wholetale.rocker" not in imported
+
+
+@pytest.mark.parametrize("name", sorted(BUILDPACKS))
+def test_selects_configured_buildpack(make_tale, name):
+    make_tale(name)
+
+    bp = WholeTaleBuildPackSelector()
+
+    module, cls = BUILDPACKS[name].split(":")
+    assert type(bp).__name__ == cls
+    assert bp.detect()
+
+
+def test_selects_only_configured_module(make_tale):
+    tale = make_tale("MatlabBuildPack")
+    proc = python(
+        "import json, sys; import repo2docker_wholetale as wt;"
+        "bp = wt.WholeTaleBuildPackSelector();"
+        "print(json.dumps(sorted(sys.modules)))",
+        cwd=str(tale),
+    )
+
+    modules = json.loads(proc.stdout)
+    assert "repo2docker_wholetale.matlab" in modules
+    for other in ("rocker", "stata", "spark", "openrefine", "rkernel", "julia"):
+        assert "repo2docker_wholetale." + other not in modules
+
+
+@pytest.mark.parametrize("buildpack", [None, "JuliaProjectBuildPack"])
+def test_leaves_other_repositories_to_repo2docker(make_tale, buildpack):
+    make_tale(buildpack)
+
+    bp = WholeTaleBuildPackSelector()
+
+    assert isinstance(bp, WholeTaleBuildPackSelector)
+    assert not bp.detect()
+
+
+def test_without_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    assert not WholeTaleBuildPackSelector().detect()
+
+
+def test_lazy_exports():
+    import repo2docker_wholetale
+
+    assert repo2docker_wholetale.RockerWTStackBuildPack.__name__ == (
+        "RockerWTStackBuildPack"
+    )
+    assert "StataWTStackBuildPack" in dir(repo2docker_wholetale)
+    with pytest.raises(AttributeError):
+        repo2docker_wholetale.NoSuchBuildPack
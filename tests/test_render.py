@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.render`."""
+
+import subprocess
+import time
+
+import pytest
+
+from repo2docker_wholetale.registry import BUILDPACKS, load_buildpack
+from repo2docker_wholetale.render import (
+    Renderer,
+    coalesce_scripts,
+    renderer,
+    script_directives,
+    stage_dependencies,
+    stage_graph,
+)
+
+
+def test_script_directives():
+    scripts = [
+        ("root", "\n    apt-get update\n"),
+        ("${NB_USER}", "Rscript install.R"),
+        ("${NB_USER}", "echo done"),
+    ]
+
+    assert script_directives(scripts) == [
+        "RUN apt-get update",
+        "USER ${NB_USER}",
+        "RUN Rscript install.R",
+        "RUN echo done",
+    ]
+
+
+def test_coalesce_scripts():
+    scripts = [
+        ("root", "\n    mkdir /WholeTale && \\\n    chown rstudio /WholeTale\n"),
+        ("root", "chown -R rstudio /etc/rstudio"),
+        ("root", "--mount=type=cache,target=/var/cache/apt apt-get install -y git"),
+        ("root", "echo one"),
+        ("${NB_USER}", "echo two"),
+        ("${NB_USER}", "echo three"),
+        ("${NB_USER}", "Rscript install.R"),
+        ("${NB_USER}", "echo four"),
+    ]
+
+    assert coalesce_scripts(scripts) == [
+        (
+            "root",
+            "( mkdir /WholeTale && \\\nchown rstudio /WholeTale ) && \\\n"
+            "( chown -R rstudio /etc/rstudio )",
+        ),
+        ("root", "--mount=type=cache,target=/var/cache/apt apt-get install -y git"),
+        ("root", "echo one"),
+        ("${NB_USER}", "( echo two ) && \\\n( echo three )"),
+        ("${NB_USER}", "Rscript install.R"),
+        ("${NB_USER}", "echo four"),
+    ]
+
+
+def test_stage_dependencies():
+    dockerfile = "\n".join(
+        [
+            "FROM buildpack-deps:bionic AS desktop",
+            "RUN apt-get install -y xfce4",
+            "RUN mkdir /etc/skel/Desktop",
+            "FROM buildpack-deps:bionic-curl AS fetch",
+            "RUN wt-fetch https://example.org/file.deb md5:0 file.deb",
+            "FROM desktop",
+            "COPY --link --from=installer:1 /opt/app /opt/app",
+            "RUN --mount=type=bind,from=fetch,source=/artifacts,target=/artifacts \\",
+            "    dpkg -i /artifacts/file.deb",
+            "RUN echo done",
+        ]
+    )
+    graph = stage_graph(dockerfile)
+
+    assert list(graph) == ["desktop", "fetch", "image"]
+    assert graph["image"] == [
+        ({"desktop"}, False),
+        (set(), False),
+        ({"fetch"}, True),
+        (set(), True),
+    ]
+    # The image only waits for the fetch once it's done with the desktop
+    assert stage_dependencies(graph) == {
+        "desktop": [],
+        "fetch": [],
+        "image": [(0, "desktop"), (2, "fetch")],
+    }
+    assert stage_dependencies(stage_graph("FROM scratch\nRUN true\n")) == {
+        "image": []
+    }
+
+
+def test_coalesced_steps_run_in_subshells(tmp_path):
+    scripts = [("root", "cd /tmp && export STEP=one"), ("root", "pwd && echo $STEP")]
+    (user, script), = coalesce_scripts(scripts)
+
+    # As run by the Dockerfile RUN
+    output = subprocess.check_output(
+        ["sh", "-c", script.replace("\\\n", "")], cwd=str(tmp_path)
+    )
+    assert output.decode() == "{}\n\n".format(tmp_path)
+
+
+def test_memoized_by_inputs(tmp_path):
+    r = Renderer(max_size=2, cache_dir=str(tmp_path))
+    source = "FROM {{ image }}\n{% for p in packages %}{{ p }} {% endfor %}"
+
+    first = r.render(source, image="ubuntu", packages={"b", "a"})
+    assert r.render(source, image="ubuntu", packages={"a", "b"}) == first
+    assert r.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    r.render(source, image="debian", packages=[])
+    r.render(source, image="alpine", packages=[])
+    r.render(source, image="ubuntu", packages={"a", "b"})
+    assert r.stats() == {"hits": 1, "misses": 4, "size": 2}
+
+
+def test_templates_compiled_once(tmp_path):
+    r = Renderer(cache_dir=str(tmp_path))
+    source = "FROM {{ image }}"
+
+    assert r.template(source) is r.template(source)
+    assert list(tmp_path.glob("__jinja2_*.cache"))
+
+
+@pytest.mark.parametrize("name", sorted(BUILDPACKS))
+def test_renders_per_second(make_tale, name):
+    make_tale(
+        name,
+        ["WT_ROCKER_VER=4.0.2"],
+        {".wholetale/apt.txt": "libgdal-dev\n", ".wholetale/install.R": ""},
+    )
+    bp = load_buildpack(name)()
+    assert bp.detect()
+    hits = renderer.hits
+
+    renders = 20
+    start = time.perf_counter()
+    dockerfiles = {bp.render() for _ in range(renders)}
+    elapsed = time.perf_counter() - start
+
+    assert len(dockerfiles) == 1
+    if name in ("RockerBuildPack", "OpenRefineBuildPack"):
+        assert renderer.hits >= hits + renders - 1
+    print("{}: {:.0f} renders/s".format(name, renders / elapsed))
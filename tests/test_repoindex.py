@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.repoindex`."""
+
+import os
+
+import pytest
+
+from repo2docker_wholetale import RockerWTStackBuildPack
+from repo2docker_wholetale.repoindex import RepoIndex
+
+TALE_FILES = {
+    ".wholetale/apt.txt": "libgdal-dev\n",
+    ".wholetale/install.R": "",
+    ".wholetale/postBuild": "",
+    "DESCRIPTION": "Package: analysis\n",
+    "data/big.csv": "",
+}
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(RepoIndex, "_cache", {})
+
+
+@pytest.fixture
+def fs_calls(monkeypatch):
+    """Record the stat and scandir calls on paths of the tale."""
+    calls = []
+    stat, scandir = os.stat, os.scandir
+
+    def record(name, func):
+        def wrapper(path=".", *args, **kwargs):
+            path = os.fspath(path)
+            if not os.path.isabs(path) or path.startswith(os.getcwd()):
+                calls.append((name, path))
+            return func(path, *args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(os, "stat", record("stat", stat))
+    monkeypatch.setattr(os, "scandir", record("scandir", scandir))
+    return calls
+
+
+def test_index(make_tale):
+    make_tale("RockerBuildPack", files=TALE_FILES)
+
+    index = RepoIndex.load()
+
+    assert index.config_dir == ".wholetale"
+    assert index.binder_path("apt.txt") == ".wholetale/apt.txt"
+    assert index.config_files == [
+        "apt.txt",
+        "environment.json",
+        "install.R",
+        "postBuild",
+        "runtime.txt",
+    ]
+    assert index.isfile("DESCRIPTION")
+    assert index.exists("data") and not index.isfile("data")
+    assert index.isfile("data/big.csv")
+    assert not index.exists(".wholetale/start")
+    assert RepoIndex.load() is index
+
+
+def test_binder_dir(tmp_path):
+    (tmp_path / "binder").mkdir()
+    (tmp_path / "binder" / "apt.txt").write_text("")
+
+    index = RepoIndex.load(str(tmp_path))
+
+    assert index.binder_path("apt.txt") == "binder/apt.txt"
+    assert index.config_files == ["apt.txt"]
+
+
+def test_rescanned_after_changes(make_tale):
+    tale = make_tale("RockerBuildPack", files=TALE_FILES)
+    index = RepoIndex.load()
+    (tale / ".wholetale" / "start").write_text("")
+    os.utime(tale / ".wholetale", ns=(0, 0))
+
+    assert RepoIndex.load() is not index
+    assert RepoIndex.load().exists(".wholetale/start")
+
+
+def test_fixed_number_of_fs_calls(make_tale, fs_calls):
+    make_tale("RockerBuildPack", ["WT_ROCKER_VER=4.0.2"], TALE_FILES)
+    bp = RockerWTStackBuildPack()
+    assert bp.detect()
+    dockerfile = bp.render()
+    first = list(fs_calls)
+
+    # repo, .wholetale and binder stamps, two listings and environment.json
+    assert [call for call, _ in first] == ["stat"] * 3 + ["scandir"] * 2 + ["stat"]
+
+    for _ in range(10):
+        assert bp.render() == dockerfile
+        bp.get_dependency_files()
+        bp.get_post_build_scripts()
+    assert fs_calls == first
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.rocker`."""
+
+import hashlib
+import os
+
+from repo2docker_wholetale import RockerWTStackBuildPack
+
+
+def test_build_passes_cache_scope(make_tale, engine, fake_docker, tmp_path):
+    make_tale("RockerBuildPack", ["WT_ROCKER_VER=4.0.2"])
+    engine.cache_backend = "local"
+    engine.cache_dir = str(tmp_path / "cache")
+    bp = RockerWTStackBuildPack()
+    assert bp.detect()
+
+    events = list(bp.build(engine, "wt:test", 0, {}, [], {}))
+
+    assert "error" not in events[-1]
+    (call,) = fake_docker()
+    location = os.path.join(engine.cache_dir, "rockerwtstackbuildpack-4.0.2")
+    assert "type=local,dest={},mode=max".format(location) in call["args"]
+
+
+def dependency_layers(dockerfile, tale):
+    """
+    Approximate the cache keys of the layers built before the workspace copy.
+
+    Like in the builder, the key of a COPY also covers the content of the
+    copied files, so each layer is keyed by its instruction and that content.
+    """
+    layers = []
+    for line in dockerfile.splitlines():
+        if line.startswith("COPY") and " src/ " in line:
+            return layers
+        if line.startswith("COPY src/"):
+            src = line.split()[1][len("src/"):]
+            line += " " + hashlib.sha256((tale / src).read_bytes()).hexdigest()
+        layers.append(line)
+    raise AssertionError("The workspace is never copied")
+
+
+def render_tale(make_tale, name, files):
+    tale = make_tale("RockerBuildPack", ["WT_ROCKER_VER=4.0.2"], files, name=name)
+    bp = RockerWTStackBuildPack()
+    assert bp.detect()
+    return dependency_layers(bp.render(), tale)
+
+
+def test_workspace_changes_keep_dependency_layers(make_tale):
+    files = {
+        ".wholetale/install.R": 'install.packages("sf")\n',
+        "DESCRIPTION": "Package: analysis\nImports: dplyr\n",
+        "data.csv": "a,b\n1,2\n",
+    }
+    layers = render_tale(make_tale, "first", files)
+    files["data.csv"] = "a,b\n3,4\n"
+    assert render_tale(make_tale, "second", files) == layers
+
+    # all the assemble scripts are part of the dependency layers
+    assert any(".wholetale/install.R" in line for line in layers)
+    assert any("devtools::install_deps" in line for line in layers)
+
+    files[".wholetale/install.R"] = 'install.packages("terra")\n'
+    assert render_tale(make_tale, "third", files) != layers
+
+
+def test_rstudio_fetched_in_parallel(make_tale):
+    make_tale("RockerBuildPack", ["WT_ROCKER_VER=4.0.2"])
+    bp = RockerWTStackBuildPack()
+    assert bp.detect()
+    dockerfile = bp.render()
+
+    assert dockerfile.startswith(
+        "# Stage wt-fetch-rstudio (RUN steps: 1): needs no other stage\n"
+        "# Stage image (RUN steps: 7): step 17 needs wt-fetch-rstudio\n"
+        "FROM buildpack-deps:bionic-curl AS wt-fetch-rstudio\n"
+    )
+    assert "/tmp/rstudio.deb" not in dockerfile
+    assert (
+        "RUN --mount=type=bind,from=wt-fetch-rstudio,source=/artifacts,"
+        "target=/artifacts \\\ndpkg -i /artifacts/rstudio.deb"
+    ) in dockerfile
+
+
+def test_binary_repo_of_checkpoint_date(make_tale):
+    repo = "WT_R_BINARY_REPO=https://ppm.example.org/cran/__linux__/bionic/{date}"
+    make_tale("RockerBuildPack", [repo], {".wholetale/runtime.txt": "r-2021-06-01\n"})
+    bp = RockerWTStackBuildPack()
+    assert bp.detect()
+    assert (
+        "options(repos = c(CRAN = "
+        '"https://ppm.example.org/cran/__linux__/bionic/2021-06-01"))'
+    ) in bp.render()
+
+    # Without a date the image keeps its own repository
+    make_tale("RockerBuildPack", [repo], {".wholetale/runtime.txt": ""}, name="undated")
+    bp = RockerWTStackBuildPack()
+    assert bp.detect()
+    assert "options(repos" not in bp.render()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.scheduler`."""
+
+import io
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from repo2docker_wholetale.scheduler import BuildScheduler
+
+
+def fake_build(runs, duration=0.1, fail=False):
+    def build():
+        runs.append(threading.get_ident())
+        yield {"stream": "step 1\n"}
+        time.sleep(duration)
+        yield {"error": "boom\n"} if fail else {"stream": "step 2\n"}
+
+    return build
+
+
+def test_identical_builds_are_coalesced():
+    runs, retagged = [], []
+    scheduler = BuildScheduler(
+        max_concurrent=4, retag=lambda src, dst: retagged.append((src, dst)) or True
+    )
+
+    def submit(i):
+        return list(scheduler.run("same-key", "wt:{}".format(i), fake_build(runs)))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(submit, range(8)))
+
+    assert len(runs) == 1
+    for events in results:
+        streams = [e.get("stream") for e in events]
+        assert "step 1\n" in streams and "step 2\n" in streams
+    metrics = scheduler.metrics()
+    assert metrics["builds"] == 1
+    assert metrics["coalesced"] == 7
+    leader = {src for src, _ in retagged}
+    assert len(leader) == 1
+    assert sorted(dst for _, dst in retagged) == sorted(
+        "wt:{}".format(i) for i in range(8) if "wt:{}".format(i) not in leader
+    )
+
+
+def test_failed_build_is_not_retagged():
+    runs, retagged = [], []
+    scheduler = BuildScheduler(retag=lambda src, dst: retagged.append(dst) or True)
+    leader = scheduler.run("key", "wt:0", fake_build(runs, fail=True))
+    assert next(leader) == {"stream": "step 1\n"}
+    follower = scheduler.run("key", "wt:1", fake_build(runs))
+    assert next(follower)["stream"] == "Waiting for identical build of wt:0\n"
+
+    leader_events = list(leader)
+    follower_events = list(follower)
+
+    assert len(runs) == 1
+    assert leader_events[-1] == follower_events[-1] == {"error": "boom\n"}
+    assert retagged == []
+    # once finished, the same key builds again
+    list(scheduler.run("key", "wt:2", fake_build(runs)))
+    assert len(runs) == 2
+
+
+def test_concurrency_is_bounded():
+    runs = []
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def build():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        yield from fake_build(runs, duration=0.05)()
+        with lock:
+            running.pop()
+
+    scheduler = BuildScheduler(max_concurrent=2)
+
+    def submit(i):
+        return list(scheduler.run("key-{}".format(i), "wt:{}".format(i), build))
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(submit, range(6)))
+
+    assert len(runs) == 6
+    assert max(peak) == 2
+    metrics = scheduler.metrics()
+    assert metrics["builds"] == 6
+    assert metrics["queue_depth"] == 0
+    assert metrics["max_queue_depth"] >= 1
+    assert metrics["wait_time_max"] > 0
+    assert any(e["stream"].startswith("Waiting for a build slot") for e in results[-1])
+
+
+def context(dockerfile=b"FROM scratch\n"):
+    tarf = io.BytesIO()
+    with tarfile.open(fileobj=tarf, mode="w") as tar:
+        info = tarfile.TarInfo("Dockerfile")
+        info.size = len(dockerfile)
+        tar.addfile(info, io.BytesIO(dockerfile))
+    tarf.seek(0)
+    return tarf
+
+
+def test_engine_coalesces_identical_builds(engine, fake_docker, monkeypatch):
+    monkeypatch.setenv("FAKE_DOCKER_SLEEP", "0.5")
+
+    def submit(i):
+        return list(engine.build(fileobj=context(), tag="wt:{}".format(i)))
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = list(pool.map(submit, range(5)))
+
+    assert all("error" not in events[-1] for events in results)
+    assert len(fake_docker()) == 1
+    assert len(fake_docker("tag")) == 4
+    assert engine.build_metrics()["coalesced"] == 4
+
+
+def test_engine_compares_contexts_of_the_same_size(engine, fake_docker, monkeypatch):
+    monkeypatch.setenv("FAKE_DOCKER_SLEEP", "0.5")
+    dockerfiles = [b"FROM scratch\n", b"FROM scratch\n", b"FROM busybox\n"]
+
+    def submit(i):
+        tag = "wt:{}".format(i)
+        return list(engine.build(fileobj=context(dockerfiles[i]), tag=tag))
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        results = list(pool.map(submit, range(3)))
+
+    assert all("error" not in events[-1] for events in results)
+    assert len(fake_docker()) == 2
+    assert engine.build_metrics()["coalesced"] == 1
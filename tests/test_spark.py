@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.spark`."""
+
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+from repo2docker_wholetale.spark import SPARK_OVERRIDES, JupyterSparkWTStackBuildPack
+
+SPARK_DEFAULTS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "repo2docker_wholetale",
+    "base",
+    "spark_defaults.py",
+)
+
+
+def render(make_tale, environment=()):
+    make_tale("SparkBuildPack", environment)
+    bp = JupyterSparkWTStackBuildPack()
+    assert bp.detect()
+    return bp.render()
+
+
+def test_spark_unpacked_in_parallel(make_tale):
+    dockerfile = render(make_tale)
+
+    assert dockerfile.startswith(
+        "# Stage wt-spark (RUN steps: 1): needs no other stage\n"
+        "# Stage image (RUN steps: 24): step 59 needs wt-spark\n"
+        "FROM buildpack-deps:bionic-curl AS wt-spark\n"
+    )
+    assert (
+        "RUN --mount=type=bind,from=wt-spark,source=/artifacts,target=/artifacts \\\n"
+        "cp -a /artifacts/spark-2.4.3-bin-hadoop2.7 /usr/local/ && \\\n"
+    ) in dockerfile
+    assert "/tmp/spark.tgz" not in dockerfile
+
+
+def test_local_mode_without_mesos(make_tale):
+    dockerfile = render(make_tale)
+
+    assert "mesos" not in dockerfile
+    assert (
+        "ENV PYTHONPATH $SPARK_HOME/python:$SPARK_HOME/python/lib/py4j-src.zip\n"
+    ) in dockerfile
+    assert "ln -s $(basename spark/python/lib/py4j-*-src.zip)" in dockerfile
+
+
+def test_mesos_opt_in(make_tale):
+    dockerfile = render(make_tale, ["WT_SPARK_MESOS=1"])
+
+    assert "apt-get --no-install-recommends -y install mesos=1.2\\*" in dockerfile
+    assert "ENV MESOS_NATIVE_LIBRARY /usr/local/lib/libmesos.so\n" in dockerfile
+    assert re.search(r"COPY .*mesos-2ekey\S* /tmp/mesos.key\n", dockerfile)
+
+
+def test_spark_version_from_environment(make_tale):
+    dockerfile = render(
+        make_tale,
+        [
+            "WT_SPARK_VERSION=3.3.2",
+            "WT_HADOOP_VERSION=3",
+            "WT_SPARK_SHA512=" + "AB" * 64,
+        ],
+    )
+
+    assert (
+        'wt-fetch "https://archive.apache.org/dist/spark/spark-3.3.2/'
+        'spark-3.3.2-bin-hadoop3.tgz" sha512:' + "ab" * 64
+    ) in dockerfile
+    assert "ENV APACHE_SPARK_VERSION 3.3.2\n" in dockerfile
+    assert "'pyarrow>=1'" in dockerfile
+    assert "ARROW_PRE_0_15_IPC_FORMAT" not in dockerfile
+
+
+@pytest.mark.parametrize(
+    "environment, message",
+    [
+        (["WT_SPARK_VERSION=3.3.2"], "No checksum known for Spark 3.3.2"),
+        (["WT_HADOOP_VERSION=2.7; rm -rf /"], "Invalid WT_HADOOP_VERSION"),
+    ],
+)
+def test_invalid_spark_version(make_tale, environment, message):
+    with pytest.raises(ValueError, match=message):
+        render(make_tale, environment)
+
+
+def spark_defaults(tmp_path, cgroup, **environ):
+    """Run wt-spark-defaults against a fake cgroup, returning its settings."""
+    root = tmp_path / "cgroup"
+    root.mkdir()
+    for name, content in cgroup.items():
+        (root / name).write_text(content)
+    env = {k: v for k, v in os.environ.items() if k not in SPARK_OVERRIDES}
+    env.update(environ, WT_CGROUP_ROOT=str(root))
+    conf = tmp_path / "spark-defaults.conf"
+    subprocess.check_call([sys.executable, SPARK_DEFAULTS, str(conf)], env=env)
+    lines = conf.read_text().splitlines()
+    assert lines[0].startswith("# Generated by wt-spark-defaults")
+    return dict(line.split(" ", 1) for line in lines[1:])
+
+
+def test_spark_defaults_follow_limits(tmp_path):
+    settings = spark_defaults(
+        tmp_path,
+        {"cpu.max": "100000 100000\n", "memory.max": "{}\n".format(6 << 30)},
+        APACHE_SPARK_VERSION="2.4.3",
+    )
+
+    assert settings == {
+        "spark.master": "local[1]",
+        "spark.driver.memory": "3072m",
+        "spark.driver.maxResultSize": "1536m",
+        "spark.sql.shuffle.partitions": "2",
+        "spark.default.parallelism": "2",
+        "spark.sql.execution.arrow.enabled": "true",
+        "spark.sql.execution.arrow.fallback.enabled": "true",
+    }
+
+
+def test_spark_defaults_overrides(tmp_path):
+    settings = spark_defaults(
+        tmp_path,
+        {"memory.max": "max\n"},
+        APACHE_SPARK_VERSION="3.3.2",
+        WT_SPARK_MASTER="local[*]",
+        WT_SPARK_DRIVER_MEMORY="2g",
+        WT_SPARK_SHUFFLE_PARTITIONS="64",
+        WT_SPARK_ARROW="false",
+    )
+
+    assert settings["spark.master"] == "local[*]"
+    assert settings["spark.driver.memory"] == "2g"
+    assert settings["spark.driver.maxResultSize"] == "1024m"
+    assert settings["spark.sql.shuffle.partitions"] == "64"
+    assert settings["spark.sql.execution.arrow.pyspark.enabled"] == "false"
+
+
+def test_runtime_settings_from_environment(make_tale):
+    dockerfile = render(
+        make_tale, ["WT_SPARK_DRIVER_MEMORY=8g", "WT_SPARK_ARROW=false"]
+    )
+
+    assert "-Xmx" not in dockerfile
+    assert "ENV WT_SPARK_DRIVER_MEMORY 8g\n" in dockerfile
+    assert "ENV WT_SPARK_ARROW false\n" in dockerfile
+    assert re.search(
+        r"COPY .*spark-5fdefaults\S* /usr/local/bin/wt-spark-defaults\n", dockerfile
+    )
+    assert "> /etc/profile.d/wt-spark-defaults.sh" in dockerfile
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.stata`."""
+
+from repo2docker_wholetale import StataWTStackBuildPack
+
+
+def test_stata_linked_from_install_image(make_tale):
+    make_tale("StataBuildPack", ["VERSION=17"])
+    bp = StataWTStackBuildPack()
+    assert bp.detect()
+    dockerfile = bp.render()
+
+    # Right after FROM, so that the layer doesn't depend on anything below it
+    assert (
+        "\nFROM wt-desktop-1\n"
+        "COPY --link --from=stata-install:17 /usr/local/stata /usr/local/stata\n"
+    ) in dockerfile
+    assert "cp -r" not in dockerfile
+    assert "/stata-install" not in dockerfile
+    # Same version as the layer cache
+    assert bp.cache_scope == "statawtstackbuildpack-17"
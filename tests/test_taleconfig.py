@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.taleconfig`."""
+
+import json
+import time
+
+import pytest
+
+from repo2docker_wholetale import (
+    JupyterSparkWTStackBuildPack,
+    JupyterWTStackBuildPack,
+    MatlabWTStackBuildPack,
+    OpenRefineWTStackBuildPack,
+    RJupyterWTStackBuildPack,
+    RockerWTStackBuildPack,
+    StataWTStackBuildPack,
+)
+from repo2docker_wholetale.taleconfig import TaleConfig, TaleConfigError
+
+# In the order of repo2docker_config.py
+BUILDPACKS = [
+    StataWTStackBuildPack,
+    MatlabWTStackBuildPack,
+    OpenRefineWTStackBuildPack,
+    RJupyterWTStackBuildPack,
+    JupyterSparkWTStackBuildPack,
+    JupyterWTStackBuildPack,
+    RockerWTStackBuildPack,
+]
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(TaleConfig, "_cache", {})
+    monkeypatch.setattr(TaleConfig, "parses", 0)
+
+
+def test_environment_values_may_contain_equal_signs():
+    config = TaleConfig.parse(
+        {
+            "config": {
+                "buildpack": "RBuildPack",
+                "environment": ["URL=https://example.org/?a=b", "EMPTY="],
+            }
+        }
+    )
+
+    assert config.buildpack == "RBuildPack"
+    assert config.environment == {"URL": "https://example.org/?a=b", "EMPTY": ""}
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        [],
+        {"config": "RBuildPack"},
+        {"config": {"buildpack": 1}},
+        {"config": {"environment": "VERSION=1"}},
+        {"config": {"environment": ["VERSION"]}},
+    ],
+)
+def test_invalid_config(data):
+    with pytest.raises(TaleConfigError):
+        TaleConfig.parse(data)
+
+
+def test_missing_config(tmp_path):
+    assert TaleConfig.load(str(tmp_path / "environment.json")) is None
+
+
+def test_invalid_json(tmp_path):
+    path = tmp_path / "environment.json"
+    path.write_text("{")
+
+    with pytest.raises(TaleConfigError):
+        TaleConfig.load(str(path))
+
+
+def detect_and_render(make_tale, repeat=1):
+    for _ in range(repeat):
+        detected = [bp for bp in (cls() for cls in BUILDPACKS) if bp.detect()]
+    (bp,) = detected
+    bp.render()
+    return bp
+
+
+def test_parsed_once_by_the_buildpack_chain(make_tale):
+    tale = make_tale("RockerBuildPack", ["WT_ROCKER_VER=4.0.2"])
+
+    start = time.perf_counter()
+    bp = detect_and_render(make_tale, repeat=100)
+    elapsed = time.perf_counter() - start
+
+    # Every buildpack detects the tale and the detected one renders it, but
+    # the file is parsed only once (it used to be parsed by every detect and
+    # by the first access to wt_env of the rendering buildpack).
+    assert isinstance(bp, RockerWTStackBuildPack)
+    assert TaleConfig.parses == 1
+    print(
+        "{} detects, 1 parse instead of {}: {:.1f}ms".format(
+            100 * len(BUILDPACKS), 100 * len(BUILDPACKS) + 1, elapsed * 1000
+        )
+    )
+
+    # Modified configs are parsed again
+    config = tale / ".wholetale" / "environment.json"
+    data = json.loads(config.read_text())
+    data["config"]["environment"] = ["WT_ROCKER_VER=4.1.0"]
+    config.write_text(json.dumps(data))
+    assert detect_and_render(make_tale).stack_version == "4.1.0"
+    assert TaleConfig.parses == 2
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `repo2docker_wholetale.wholetale`."""
+
+import os
+import re
+import subprocess
+
+import pytest
+
+import repo2docker_wholetale
+from repo2docker_wholetale import RJupyterWTStackBuildPack, RockerWTStackBuildPack
+from repo2docker_wholetale.artifacts import FETCH_SCRIPT
+from repo2docker_wholetale.registry import BUILDPACKS, load_buildpack
+
+
+def build_tale(make_tale, engine, copy_workspace, name):
+    make_tale(
+        "RockerBuildPack",
+        ["WT_ROCKER_VER=4.0.2"],
+        {
+            ".wholetale/install.R": 'install.packages("sf")\n',
+            "data/big.csv": "a,b\n" * 10000,
+            "analysis.R": "library(sf)\n",
+        },
+        name=name,
+    )
+    bp = RockerWTStackBuildPack()
+    engine.copy_workspace = copy_workspace
+    assert bp.detect()
+    return list(bp.build(engine, "wt:test", 0, {}, [], {}))
+
+
+def test_workspace_copied_by_default(make_tale, engine, fake_docker):
+    events = build_tale(make_tale, engine, True, "copied")
+
+    assert "error" not in events[-1]
+    (call,) = fake_docker()
+    assert "src/data/big.csv" in call["members"]
+    assert "src/analysis.R" in call["members"]
+    # For the fetch stage, not copied into the image
+    fetch_script = RockerWTStackBuildPack.generate_build_context_filename(FETCH_SCRIPT)
+    assert fetch_script[0] in call["members"]
+
+
+def test_staged_files_only(make_tale, engine, fake_docker):
+    events = build_tale(make_tale, engine, False, "staged")
+
+    assert "error" not in events[-1]
+    (call,) = fake_docker()
+    src = [name for name in call["members"] if name.startswith("src")]
+    assert src == ["src", "src/.wholetale/install.R", "src/.wholetale/runtime.txt"]
+    # data/big.csv, analysis.R and environment.json
+    skipped = 40000 + 12 + os.path.getsize(".wholetale/environment.json")
+    assert events[0] == {
+        "stream": "Skipped copying 3 files ({} bytes) of the workspace\n".format(
+            skipped
+        )
+    }
+
+
+def test_staged_python_requirements(make_tale, engine, fake_docker):
+    make_tale(
+        "PythonBuildPack",
+        files={"requirements3.txt": "numpy\n", "analysis.ipynb": "{}\n"},
+    )
+    bp = load_buildpack("PythonBuildPack")()
+    engine.copy_workspace = False
+    assert bp.detect()
+
+    events = list(bp.build(engine, "wt:test", 0, {}, [], {}))
+
+    assert "error" not in events[-1]
+    (call,) = fake_docker()
+    assert "src/requirements3.txt" in call["members"]
+    assert "src/analysis.ipynb" not in call["members"]
+
+
+def test_package_not_installed_without_workspace(make_tale, engine, fake_docker):
+    make_tale(
+        "PythonBuildPack",
+        files={
+            "setup.py": "from setuptools import setup\nsetup(name='tale')\n",
+            "DESCRIPTION": "Package: tale\n",
+        },
+    )
+    bp = load_buildpack("PythonBuildPack")()
+    assert bp.detect()
+    assert "pip install --no-cache-dir ." in bp.render()
+    assert "devtools::install_local(getwd())" in bp.render()
+
+    engine.copy_workspace = False
+    events = list(bp.build(engine, "wt:test", 0, {}, [], {}))
+
+    assert "error" not in events[-1]
+    assert not bp.copy_workspace
+    dockerfile = bp.render()
+    assert "pip install --no-cache-dir ." not in dockerfile
+    assert "devtools::install_local" not in dockerfile
+    assert (
+        "export WT_NCPUS=$(wt-ncpus) && export MAKEFLAGS=-j${WT_NCPUS} && "
+        'R --quiet -e "devtools::install_deps(getwd())"'
+    ) in dockerfile
+
+
+def render_with_cache_mounts(make_tale, version):
+    make_tale(
+        "RockerBuildPack",
+        ["WT_ROCKER_VER={}".format(version)],
+        {".wholetale/apt.txt": "libgdal-dev\n", ".wholetale/install.R": ""},
+        name=version,
+    )
+    bp = RockerWTStackBuildPack()
+    bp.use_cache_mounts = True
+    assert bp.detect()
+    return bp.render()
+
+
+def test_cache_mounts(make_tale):
+    dockerfile = render_with_cache_mounts(make_tale, "4.0.2")
+
+    assert (
+        "RUN --mount=type=cache,id=wt-apt-cache-rocker-geospatial-4.0.2,"
+        "target=/var/cache/apt,sharing=locked "
+        "--mount=type=cache,id=wt-apt-lists-rocker-geospatial-4.0.2,"
+        "target=/var/lib/apt/lists,sharing=locked \\\n"
+        "if [ -f /etc/apt/apt.conf.d/docker-clean ]; "
+        "then mv /etc/apt/apt.conf.d/docker-clean /tmp/wt-docker-clean; fi && \\\n"
+        "apt-get -qq update && \\\n"
+        "apt-get install --yes --no-install-recommends libgdal-dev && \\\n"
+        "apt-get -qq purge && \\\n"
+        # Not left out of the image
+        "if [ -f /tmp/wt-docker-clean ]; "
+        "then mv /tmp/wt-docker-clean /etc/apt/apt.conf.d/docker-clean; fi\n"
+    ) in dockerfile
+    # install.packages() has no download cache to mount
+    assert (
+        "RUN export WT_NCPUS=$(wt-ncpus) && export MAKEFLAGS=-j${WT_NCPUS} && "
+        "Rscript .wholetale/install.R\n"
+    ) in dockerfile
+    # Caches are not shared between base images
+    other = render_with_cache_mounts(make_tale, "4.1.0")
+    assert "rocker-geospatial-4.1.0" in other
+    assert "rocker-geospatial-4.0.2" not in other
+
+
+def test_cache_mounts_owned_by_user(make_tale, engine, fake_docker):
+    make_tale("StataBuildPack")
+    bp = load_buildpack("StataBuildPack")()
+    assert bp.detect()
+    engine.use_cache_mounts = True
+
+    events = list(bp.build(engine, "wt:test", 0, {"NB_UID": "1001"}, [], {}))
+
+    assert "error" not in events[-1]
+    assert "target=/var/cache/wt/pip,sharing=shared,uid=1001,gid=1001" in bp.render()
+
+
+def test_cache_mounts_disabled_by_default(make_tale):
+    make_tale("RockerBuildPack", files={".wholetale/apt.txt": "libgdal-dev\n"})
+    dockerfile = RockerWTStackBuildPack().render()
+
+    assert "type=cache" not in dockerfile
+    assert "rm -rf /var/lib/apt/lists/*" in dockerfile
+
+
+@pytest.mark.parametrize("name", sorted(BUILDPACKS))
+def test_coalesce_runs(make_tale, name):
+    make_tale(
+        name,
+        ["WT_ROCKER_VER=4.0.2"],
+        {".wholetale/apt.txt": "libgdal-dev\n", ".wholetale/install.R": ""},
+    )
+    bp = load_buildpack(name)()
+    assert bp.detect()
+    dockerfile = bp.render()
+    bp.coalesce_runs = True
+    coalesced = bp.render()
+
+    def runs(dockerfile):
+        return sum(line.startswith("RUN ") for line in dockerfile.splitlines())
+
+    before, after = bp.run_counts()
+    assert runs(dockerfile) - runs(coalesced) == before - after
+    if before:
+        assert after < before
+    # Mounts only apply to the step carrying them
+    assert coalesced.count("--mount=") == dockerfile.count("--mount=")
+    # Rendering doesn't patch the buildpack
+    assert not [name for name in vars(bp) if name.startswith("get_")]
+    print("{}: {} -> {} RUN steps".format(name, runs(dockerfile), runs(coalesced)))
+
+
+def test_binary_r_repository(make_tale):
+    make_tale("RBuildPack", files={".wholetale/install.R": ""})
+    bp = RJupyterWTStackBuildPack()
+    assert bp.detect()
+    dockerfile = bp.render()
+
+    # Looked up by repo2docker, see offline_cran
+    repo = "https://cran.example.org/snapshot/2022-01-01"
+    assert 'options(repos = c(CRAN = "{}"))'.format(repo) in dockerfile
+    assert re.search(r"COPY .*ncpus\S* /usr/local/bin/wt-ncpus\n", dockerfile)
+    assert (
+        "export WT_NCPUS=$(wt-ncpus) && export MAKEFLAGS=-j${WT_NCPUS} && "
+        "Rscript .wholetale/install.R"
+    ) in dockerfile
+
+
+@pytest.mark.parametrize(
+    "environment, runtime, repo",
+    [
+        (
+            ["WT_R_BINARY_REPO=https://ppm.example.org/cran/__linux__/jammy/{date}"],
+            "r-2022-01-01",
+            "https://ppm.example.org/cran/__linux__/jammy/2022-01-01",
+        ),
+        (
+            ["WT_R_BINARY_REPO=https://ppm.example.org/cran/__linux__/jammy/{date}"],
+            "r-2017-01-01",
+            "https://cran.example.org/snapshot/2017-01-01",
+        ),
+        ([], "r-2022-01-01", "https://cran.example.org/snapshot/2022-01-01"),
+    ],
+)
+def test_r_repository_fallbacks(make_tale, environment, runtime, repo):
+    make_tale(
+        "RBuildPack", environment, files={".wholetale/runtime.txt": runtime + "\n"}
+    )
+    bp = RJupyterWTStackBuildPack()
+    assert bp.detect()
+
+    assert bp.get_cran_mirror_url(bp.checkpoint_date) == repo
+
+
+@pytest.mark.parametrize(
+    "cpu_max, memory_max, jobs",
+    [
+        ("max 100000", "max", "8"),
+        ("200000 100000", "max", "2"),
+        ("150000 100000", "max", "2"),
+        ("max 100000", str(3 * 1024**3), "1"),
+        ("max 100000", "1", "1"),
+    ],
+)
+def test_ncpus(tmp_path, cpu_max, memory_max, jobs):
+    (tmp_path / "cpu.max").write_text(cpu_max + "\n")
+    (tmp_path / "memory.max").write_text(memory_max + "\n")
+    script = os.path.join(os.path.dirname(repo2docker_wholetale.__file__), "r/ncpus.sh")
+    env = dict(os.environ, WT_CGROUP_ROOT=str(tmp_path), OMP_NUM_THREADS="8")
+
+    output = subprocess.check_output(["sh", script], env=env)
+
+    assert output.decode().strip() == jobs